@@ -12,6 +12,7 @@ or to used as a baseline for profiling and optimization.
 """
 
 import brain
+import os
 from lazy_brain import LazyBrain
 from non_lazy_brain import NonLazyBrain
 import brain_util as bu
@@ -21,6 +22,13 @@ import random
 import copy
 import matplotlib.pyplot as plt
 from collections import OrderedDict
+from result_cache import ResultCache
+
+# Results of seeded simulations, reused across runs (see result_cache). Its directory is only created on first use.
+# A memoized simulation must be determined by its seed: its LazyBrains draw from the stream of the seed
+# (random_draws='stream') rather than from the global random generators.
+simulation_cache = ResultCache(os.environ.get('ASSEMBLIES_CACHE_DIR',
+                                              os.path.join(os.path.expanduser('~'), '.cache', 'assemblies')))
 
 
 def get_default_brain_params(n=10000, k=100, p=0.01, beta=0.05):
@@ -49,9 +57,9 @@ def check_hypotheses():
     print(f'Expect the support to be huge. Got {A.support_size}, which is {A.support_size/k}% of k*100')
     print(f'Expect number of new winners to be about k*(A.support_size/n)={k*(A.support_size/n)}. '
           f'Got {A.num_first_winners}')
-    max_weight = np.max(b.connectomes['A']['A'])
-    print(f'Expect maximum weight to be low. Got {max_weight}, which is (1+beta)^'
-          f'{int(np.round(np.log(max_weight)/np.log(1+beta)))}')
+    stats = b.connectome_stats[('A', 'A')]
+    print(f'Expect maximum weight to be low. Got {stats.max_weight}, which is (1+beta)^'
+          f'{len(stats.level_histogram) - 1}')
 
     # ==================================================================
     # Constant stimulus input with recurrent connection creates assembly
@@ -100,13 +108,13 @@ def check_hypotheses():
 
 
 
-def project_sim(n=1000000, k=1000, p=0.01, beta=0.05, t=50, lazy=True):
+@simulation_cache.memoize
+def project_sim(n=1000000, k=1000, p=0.01, beta=0.05, t=50, lazy=True, seed=None):
+    logging.basicConfig(level=logging.INFO)
     if lazy:
-        brain_class = LazyBrain
+        b = LazyBrain(p, seed=seed, random_draws='stream')
     else:
-        brain_class = NonLazyBrain
-    logging.basicConfig(level=logging.INFO)
-    b = brain_class(p)
+        b = NonLazyBrain(p, seed=seed)
     b.add_stimulus("stim", k)
     b.add_area("A", n, k, beta)
     area_a: brain.Area = b.areas["A"]
@@ -118,11 +126,11 @@ def project_sim(n=1000000, k=1000, p=0.01, beta=0.05, t=50, lazy=True):
     return support_size_list
 
 
-def project_beta_sim(n=100000, k=317, p=0.01, t=100):
+def project_beta_sim(n=100000, k=317, p=0.01, t=100, seed=None):
     results = {}
     for beta in [0.25, 0.1, 0.075, 0.05, 0.03, 0.01, 0.007, 0.005, 0.003, 0.001]:
         print("Working on " + str(beta) + "\n")
-        out = project_sim(n, k, p, beta, t)
+        out = project_sim(n, k, p, beta, t, seed=seed)
         results[beta] = out
     return results
 
@@ -277,8 +285,9 @@ def association_sim(n=100000, k=317, p=0.05, beta=0.1, overlap_iter=10):
     return b.areas["C"].saved_w, b.areas["C"].saved_winners
 
 
-def association_grand_sim(n=100000, k=317, p=0.01, beta=0.05, min_iter=10, max_iter=20):
-    b = brain.Brain(p)
+@simulation_cache.memoize
+def association_grand_sim(n=100000, k=317, p=0.01, beta=0.05, min_iter=10, max_iter=20, seed=None):
+    b = brain.Brain(p, seed=seed)
     b.add_stimulus("stimA", k)
     b.add_area("A", n, k, beta)
     b.add_stimulus("stimB", k)
@@ -472,28 +481,22 @@ def plot_overlap(show=True, save="", use_text_font=True):
         plt.savefig(save)
 
 
-def density(n=100000, k=317, p=0.01, beta=0.05):
-    b = brain.Brain(p)
+@simulation_cache.memoize
+def density(n=100000, k=317, p=0.01, beta=0.05, seed=None):
+    b = NonLazyBrain(p, seed=seed)
     b.add_stimulus("stim", k)
     b.add_area("A", n, k, beta)
     b.project({"stim": ["A"]}, {})
     for i in range(9):
         b.project({"stim": ["A"]}, {"A": ["A"]})
-    conn = b.connectomes["A"]["A"]
-    final_winners = b.areas["A"].winners
-    edges = 0
-    for i in final_winners:
-        for j in final_winners:
-            if conn[i][j] != 0:
-                edges += 1
-    return float(edges) / float(k ** 2)
+    return b.assembly_density("A")
 
 
-def density_sim(n=100000, k=317, p=0.01, beta_values=[0, 0.025, 0.05, 0.075, 0.1]):
+def density_sim(n=100000, k=317, p=0.01, beta_values=[0, 0.025, 0.05, 0.075, 0.1], seed=None):
     results = {}
     for beta in beta_values:
         print("Working on " + str(beta) + "\n")
-        out = density(n, k, p, beta)
+        out = density(n, k, p, beta, seed=seed)
         results[beta] = out
     return results
 
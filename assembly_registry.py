@@ -0,0 +1,179 @@
+""" A registry of the assemblies of an area, indexed for fast matching of winner sets.
+
+Pattern completion and association experiments repeatedly ask which stored assembly the current winners of an area
+are closest to. Comparing the winners with every stored assembly costs O(number of assemblies * k). An
+AssemblyRegistry keeps an inverted index from every neuron to the assemblies containing it, so that the overlap of a
+set of winners with all stored assemblies is found by visiting the k postings of the winners only: the cost is
+proportional to k (times the number of assemblies sharing a neuron), regardless of how many assemblies are stored.
+
+Assemblies are registered explicitly with 'register', or automatically by 'observe': fed the winners of an area after
+every projection, it registers them once they have been stable for a few rounds and do not match a stored assembly.
+'attach' makes a brain feed them after every round. The assemblies of a LazyBrain area are indices into its support,
+which compaction renumbers: an attached registry renumbers its assemblies along (see 'remap').
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from numpy import ndarray
+from brain import Brain
+from lazy_brain import LazyBrain
+from round_metrics import RoundMetrics
+
+
+class AssemblyRegistry:
+    """ Named assemblies (sets of neurons) of a single area, with an inverted index from neurons to assemblies.
+
+    Attributes:
+        area: Name of the area the assemblies belong to
+        names: The name of every assembly, indexed by assembly id
+        assemblies: The neurons of every assembly, as sorted int64 arrays, indexed by assembly id
+        stable_rounds: Number of consecutive rounds with (nearly) the same winners after which 'observe' registers them
+        stability: Minimal overlap fraction between the winners of consecutive rounds for them to count as stable
+        match_fraction: Minimal overlap fraction with a stored assembly for 'observe' to consider winners known
+    """
+
+    def __init__(self, area: str, stable_rounds: int = 3, stability: float = 0.95, match_fraction: float = 0.8):
+        self.area = area
+        self.names: List[str] = []
+        self.assemblies: List[ndarray] = []
+        self.stable_rounds = stable_rounds
+        self.stability = stability
+        self.match_fraction = match_fraction
+        self._ids: Dict[str, int] = {}
+        self._postings: Dict[int, List[int]] = {}
+        self._last_winners: Optional[ndarray] = None
+        self._stable_for: int = 0
+        self._brain: Optional[Brain] = None
+
+    def __len__(self) -> int:
+        return len(self.assemblies)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._ids
+
+    def __getitem__(self, name: str) -> ndarray:
+        return self.assemblies[self._ids[name]]
+
+    def register(self, winners: Sequence[int], name: Optional[str] = None) -> str:
+        """ Store a set of neurons as an assembly.
+
+        :param winners: The neurons of the assembly
+        :param name: Name of the assembly. Defaults to '<area>#<id>'.
+        :return: The name of the assembly
+        """
+        name = f'{self.area}#{len(self.assemblies)}' if name is None else name
+        if name in self._ids:
+            raise ValueError(f'Assembly {name} already registered in {self.area}')
+        assembly_id = len(self.assemblies)
+        neurons = np.unique(np.asarray(winners, dtype=np.int64))
+        self._ids[name] = assembly_id
+        self.names.append(name)
+        self.assemblies.append(neurons)
+        for neuron in neurons.tolist():
+            self._postings.setdefault(neuron, []).append(assembly_id)
+        return name
+
+    def overlaps(self, winners: Sequence[int]) -> Tuple[ndarray, ndarray]:
+        """ The overlaps of 'winners' with every stored assembly sharing at least one neuron with them.
+
+        :return: (assembly ids, overlaps), both int64 arrays
+        """
+        postings = [self._postings[neuron] for neuron in np.unique(np.asarray(winners, dtype=np.int64)).tolist()
+                    if neuron in self._postings]
+        if not postings:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(postings), return_counts=True)
+
+    def best_match(self, winners: Sequence[int]) -> Optional[Tuple[str, int]]:
+        """ The stored assembly with the largest overlap with 'winners' (the first registered one on ties).
+
+        :return: (name, overlap), or None if no assembly shares a neuron with 'winners'
+        """
+        ids, counts = self.overlaps(winners)
+        if len(ids) == 0:
+            return None
+        best = int(np.argmax(counts))
+        return self.names[ids[best]], int(counts[best])
+
+    def matches(self, winners: Sequence[int], min_fraction: float) -> List[Tuple[str, int]]:
+        """ All stored assemblies whose overlap with 'winners' is at least 'min_fraction' of the number of winners,
+        by decreasing overlap.
+
+        :return: List of (name, overlap)
+        """
+        ids, counts = self.overlaps(winners)
+        keep = counts >= min_fraction * len(np.unique(np.asarray(winners)))
+        ids, counts = ids[keep], counts[keep]
+        order = np.lexsort((ids, -counts))
+        return [(self.names[ids[i]], int(counts[i])) for i in order]
+
+    def overlap_histogram(self, winners: Sequence[int]) -> ndarray:
+        """ histogram[o] is the number of stored assemblies with an overlap of exactly 'o' neurons with 'winners'. """
+        ids, counts = self.overlaps(winners)
+        histogram = np.bincount(counts, minlength=len(np.unique(np.asarray(winners))) + 1)
+        histogram[0] = len(self.assemblies) - len(ids)
+        return histogram
+
+    def observe(self, winners: Sequence[int]) -> Optional[str]:
+        """ Feed the winners of the area after a projection. Once the winners have been stable for 'stable_rounds'
+        consecutive rounds, they are registered, unless they match a stored assembly.
+
+        :return: The name of the newly registered assembly, if any
+        """
+        winners = np.unique(np.asarray(winners, dtype=np.int64))
+        previous, self._last_winners = self._last_winners, winners
+        if previous is None or len(winners) == 0 or \
+                len(np.intersect1d(previous, winners, assume_unique=True)) < self.stability * len(winners):
+            self._stable_for = 0
+            return None
+        self._stable_for += 1
+        if self._stable_for < self.stable_rounds:
+            return None
+        match = self.best_match(winners)
+        if match is not None and match[1] >= self.match_fraction * len(winners):
+            return None
+        return self.register(winners)
+
+    def remap(self, index_map: ndarray) -> None:
+        """ Renumber the neurons of all assemblies, e.g. after a compaction of the support of the area.
+
+        :param index_map: index_map[i] is the new index of neuron i, or -1 if it was removed (and is dropped from
+            the assemblies containing it)
+        """
+        index_map = np.asarray(index_map, dtype=np.int64)
+        self._postings = {}
+        for assembly_id, neurons in enumerate(self.assemblies):
+            neurons = index_map[neurons]
+            self.assemblies[assembly_id] = neurons = np.sort(neurons[neurons >= 0])
+            for neuron in neurons.tolist():
+                self._postings.setdefault(neuron, []).append(assembly_id)
+        if self._last_winners is not None:
+            last_winners = index_map[self._last_winners]
+            self._last_winners = np.sort(last_winners[last_winners >= 0])
+
+    def attach(self, brain: Brain) -> None:
+        """ Observe the winners of the area after every round of 'brain' in which it was projected into, and remap
+        the assemblies whenever the area is compacted (for a LazyBrain).
+        """
+        self.detach()
+        self._brain = brain
+        brain.add_metrics_listener(self._on_round)
+        if isinstance(brain, LazyBrain):
+            brain.compaction_listeners.append(self._on_compaction)
+
+    def detach(self) -> None:
+        """ Stop following the brain given to 'attach', if any. """
+        if self._brain is None:
+            return
+        if self._on_round in self._brain.metrics_listeners:
+            self._brain.remove_metrics_listener(self._on_round)
+        if isinstance(self._brain, LazyBrain) and self._on_compaction in self._brain.compaction_listeners:
+            self._brain.compaction_listeners.remove(self._on_compaction)
+        self._brain = None
+
+    def _on_round(self, metrics: RoundMetrics) -> None:
+        if self.area in metrics.num_first_winners:
+            self.observe(self._brain.areas[self.area].winner_array)
+
+    def _on_compaction(self, area: str, index_map: ndarray) -> None:
+        if area == self.area:
+            self.remap(index_map)
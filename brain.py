@@ -18,9 +18,19 @@ This module contains classes to represent different elements of a brain simulati
         meaning that all neurons that have their original, random connectome weights (0 or 1) are not saved explicitly.
     - Assembly - TODO define and express in code
 """
-from typing import List, Mapping, Dict
+from typing import Callable, List, Mapping, Dict, Optional, Sequence, Set, Tuple
 from collections import defaultdict
+import time
+import numpy as np
 from numpy.core._multiarray_umath import ndarray
+from connectome_stats import ConnectomeStats, assembly_density
+from round_metrics import MetricsListener, collect_round_metrics
+from memory_accounting import MEMORY_POLICIES, MemoryBudgetExceeded, MemoryReport, format_nbytes, memory_report
+from winner_selection import ThresholdTopK
+
+# Called with (source, target, from_stimulus, rows) whenever rows of a connectome change, rows being None if any of
+# them may have changed
+ChangeListener = Callable[[str, str, bool, Optional[Sequence[int]]], None]
 
 
 class Stimulus:
@@ -42,11 +52,24 @@ class Stimulus:
         self.k = k
 
 
+class WinnerList(list):
+    """ The winners of an area as a list, which cannot be changed in place (see Area.winners). """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Area.winners is a read only copy of the winners, assign area.winners to change them')
+
+    append = extend = insert = remove = pop = clear = sort = reverse = _read_only
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
 class Area:
     """Represents an individual area of the brain.
 
-    The list of neurons that are firing is given by 'winners'. It is updated through application of 'Brain.project',
-    where the set of '_new_winners' is calculated and only updated once all brain areas settle on their new winners.
+    The neurons that are firing are given by 'winners'. They are updated through application of 'Brain.project',
+    where the '_new_winners' are calculated and only committed once all brain areas settle on their new winners.
     The winners are the 'k' neurons with the highest value going in each round.
 
     Initially, most computation are represented implicitly. Winners are represented explicitly, and the changes in
@@ -57,7 +80,12 @@ class Area:
     number 'k' of winners in any given round (meaning the k neurons with heights values will fire),
     and the parameter 'beta' of plasticity controlling connectome weight updates.
 
-    TODO: remove '_new_winners'.
+    The winners and the new winners live in two preallocated int32 buffers: a projection writes the new winners into
+    the back buffer, and 'update_winners' commits them by swapping the buffers, so no round allocates winner lists.
+    'winner_array' and '_new_winners' are views of the buffers that can index connectomes directly. A view of the
+    winners is only valid until the next commit but one, which writes into its buffer again. 'winners' is a read only
+    list copy (a WinnerList): changing the winners in place would not reach the buffers, so assign 'winners' instead.
+
     TODO: remove 'name'. We prefer to use variable names to refer to areas.
 
     Attributes:
@@ -66,12 +94,16 @@ class Area:
         beta: plasticity parameter for self-connections
         stimulus_beta: plasticity parameters for connections from each incoming stimulus
         area_beta: plasticity parameters for connections from each incoming area
+        support: bool array marking the neurons that ever won
         support_size: The number of neurons that are represented explicitly (= total number of previous winners)
-        winners: List of current winners. That is, 'k' top neurons from previous round.
+        winners: Read only list of current winners. That is, 'k' top neurons from previous round.
+        winner_array: The current winners, as an int32 view of the front buffer
         _new_support_size: the size of the support for the new update. Should be 'support_size' + 'num_first_winners'.
-        _new_winners: During the projection process, a new set of winners is formed. The winners are only
-            updated when the projection ends, so that the newly computed winners won't affect computation
+        _new_winners: During the projection process, a new set of winners is formed (in the back buffer). The winners
+            are only updated when the projection ends, so that the newly computed winners won't affect computation.
+            Outside of a projection, these are the current winners.
         num_first_winners: should be equal to 'len(_new_winners)'
+        selector: Selects the 'k' winners out of the inputs of a round, tracking the previous k-th largest input.
     """
 
     def __init__(self, name: str, n: int, k: int, beta: float = 0.05):
@@ -81,19 +113,83 @@ class Area:
         self.beta = beta
         self.stimulus_beta: Dict[str, float] = {}
         self.area_beta: Dict[str, float] = {}
-        self.support = [0] * self.n
+        self.support = np.zeros(self.n, dtype=bool)
         self.support_size: int = 0
-        self.winners: List[int] = []
         self._new_support_size: int = 0
-        self._new_winners: List[int] = []
         self.num_first_winners: int = -1
+        self.selector = ThresholdTopK()
+        self._allocate_winners(())
 
-    def update_winners(self) -> None:
-        """ This function updates the list of winners for this area after a projection step.
+    def _allocate_winners(self, batch_shape: Tuple[int, ...]) -> None:
+        """ Allocate the two winner buffers, of shape 'batch_shape' + (k,) each, with no winners in either. """
+        self._winner_buffers = np.zeros((2,) + batch_shape + (self.k,), dtype=np.int32)
+        self._front: int = 0
+        self._num_winners: int = 0
+        self._num_new_winners: int = 0
+        self._pending: bool = False
+
+    def _store(self, buffer: int, winners) -> int:
+        """ Copy 'winners' into a buffer, growing the buffers if they do not fit. :return: the number of winners """
+        winners = np.asarray(winners)
+        count = winners.shape[-1] if winners.ndim else 0
+        if count > self._winner_buffers.shape[-1]:
+            grown = np.zeros(self._winner_buffers.shape[:-1] + (count,), dtype=np.int32)
+            grown[..., :self._winner_buffers.shape[-1]] = self._winner_buffers
+            self._winner_buffers = grown
+        self._winner_buffers[buffer, ..., :count] = winners
+        return count
 
-            TODO: redesign this so that the list of new winners is not saved in area.
+    @property
+    def winner_array(self) -> ndarray:
+        return self._winner_buffers[self._front, ..., :self._num_winners]
+
+    @property
+    def winners(self) -> 'WinnerList':
+        return WinnerList(self.winner_array.tolist())
+
+    @winners.setter
+    def winners(self, winners) -> None:
+        self._num_winners = self._store(self._front, winners)
+        self._pending = False
+
+    @property
+    def _new_winners(self) -> ndarray:
+        if not self._pending:
+            return self.winner_array
+        return self._winner_buffers[1 - self._front, ..., :self._num_new_winners]
+
+    @_new_winners.setter
+    def _new_winners(self, winners) -> None:
+        self._num_new_winners = self._store(1 - self._front, winners)
+        self._pending = True
+
+    def __setstate__(self, state: Dict) -> None:
+        # areas pickled before the winners were buffered kept them as plain attributes
+        winners, new_winners = state.pop('winners', None), state.pop('_new_winners', None)
+        self.__dict__.update(state)
+        if winners is not None:
+            self._allocate_winners(np.shape(winners)[:-1])
+            self.winners = winners
+            if new_winners is not None and new_winners is not winners:
+                self._new_winners = new_winners
+
+    @property
+    def num_explicit(self) -> int:
+        """ Number of neurons represented explicitly, i.e. the number of rows / columns of connectomes of this area.
+        All neurons are explicit unless the area is represented lazily.
         """
-        self.winners = self._new_winners
+        return self.n
+
+    def neuron_ids(self, indices: ndarray) -> ndarray:
+        """ Stable ids of the explicit neurons at 'indices'. Without a lazy representation these are the indices. """
+        return indices
+
+    def update_winners(self) -> None:
+        """ Commit the new winners of a projection step, by swapping the winner buffers. """
+        if self._pending:
+            self._front = 1 - self._front
+            self._num_winners = self._num_new_winners
+            self._pending = False
         self.support_size = self._new_support_size
 
 
@@ -118,13 +214,34 @@ class Brain:
     connectomes: Maps each pair of areas to the ndarray representing the synaptic weights among neurons in
         the support.
     p: Probability of connectome (edge) existing between two neurons (vertices)
+    seed: Seed from which the random connectomes of the brain are derived. If none is given, it is drawn from the
+        global NumPy generator, so that np.random.seed still makes runs reproducible.
+    connectome_stats: Running statistics (see connectome_stats.ConnectomeStats) of the connectome between every pair
+        of areas, keyed by (from_area, to_area), maintained as the connectomes are potentiated.
+    stimulus_connectome_stats: The same for the connectomes from stimuli to areas, keyed by (stimulus, area), where
+        the synapses of stimuli are represented explicitly.
+    memory_budget: Maximal number of bytes the brain may hold (see memory_accounting), or None for no limit.
+    memory_policy: What to do when the budget is exceeded: 'raise' a MemoryBudgetExceeded error, or 'reclaim' memory
+        first (see reclaim_memory) and raise only if that is not enough.
+    rounds: Number of rounds (calls to 'project') so far
+    metrics_listeners: Called with the round_metrics.RoundMetrics of every round
+    change_listeners: Called whenever synapses of a connectome change (see connectome_changed), e.g. by the
+        incremental checkpoints of checkpointing.DeltaCheckpointer
     """
-    def __init__(self, p: float):
+    def __init__(self, p: float, seed: Optional[int] = None):
         self.areas: Dict[str, Area] = {}
         self.stimuli: Dict[str, Stimulus] = {}
         self.stimuli_connectomes: Dict[str, Dict[str, ndarray]] = {}
         self.connectomes: Dict[str, Dict[str, ndarray]] = {}
         self.p: float = p
+        self.seed: int = int(np.random.randint(np.iinfo(np.int64).max)) if seed is None else seed
+        self.connectome_stats: Dict[Tuple[str, str], ConnectomeStats] = defaultdict(ConnectomeStats)
+        self.stimulus_connectome_stats: Dict[Tuple[str, str], ConnectomeStats] = defaultdict(ConnectomeStats)
+        self.memory_budget: Optional[int] = None
+        self.memory_policy: str = 'raise'
+        self.rounds: int = 0
+        self.metrics_listeners: List[MetricsListener] = []
+        self.change_listeners: List[ChangeListener] = []
 
     def add_stimulus(self, name: str, k: int) -> None:
         pass
@@ -166,14 +283,78 @@ class Brain:
 
         # to_update is the set of all areas that receive input
         to_update = set().union(list(stim_in.keys()), list(area_in.keys()))
+        start_time = time.perf_counter()
 
         for area in to_update:
             num_first_winners = self.project_into(self.areas[area], stim_in[area], area_in[area])
             self.areas[area].num_first_winners = num_first_winners
 
+        metrics = None
+        if self.metrics_listeners:
+            metrics = collect_round_metrics(self, self.rounds, to_update, time.perf_counter() - start_time)
         # once done everything, for each area in to_update: area.update_winners()
         for area in to_update:
             self.areas[area].update_winners()
+        self.rounds += 1
+        self.end_round(to_update)
+        for listener in self.metrics_listeners:
+            listener(metrics)
+
+    def end_round(self, updated_areas: Set[str]) -> None:
+        """ Called at the end of every 'project', once the winners of 'updated_areas' were updated. """
+        self.check_memory_budget()
 
     def project_into(self, area: Area, from_stimuli: List[str], from_areas: List[str]) -> int:
         return 0
+
+    def assembly_density(self, area_name: str, winners: Optional[Sequence[int]] = None) -> float:
+        """ The fraction of existing synapses among a set of neurons of an area, in its recurrent connectome.
+
+        :param area_name: Name of the area
+        :param winners: Indices of the neurons, by default the current winners of the area
+        """
+        winners = self.areas[area_name].winners if winners is None else winners
+        return assembly_density(self.connectomes[area_name][area_name], winners)
+
+    def add_metrics_listener(self, listener: MetricsListener) -> None:
+        """ Call 'listener' with the round_metrics.RoundMetrics of every following round. """
+        self.metrics_listeners.append(listener)
+
+    def remove_metrics_listener(self, listener: MetricsListener) -> None:
+        self.metrics_listeners.remove(listener)
+
+    def connectome_changed(self, source: str, target: str, from_stimulus: bool = False,
+                           rows: Optional[Sequence[int]] = None) -> None:
+        """ Tell the change listeners that synapses in 'rows' of a connectome were changed (or, if None, that any
+        of its synapses, or its shape, may have changed). Brains call this whenever they update a connectome.
+        """
+        for listener in self.change_listeners:
+            listener(source, target, from_stimulus, rows)
+
+    def memory_report(self) -> MemoryReport:
+        """ The bytes currently held by the connectomes, supports and winners of this brain. """
+        return memory_report(self)
+
+    def reclaim_memory(self) -> int:
+        """ Try to free memory when the memory budget is exceeded.
+        :return: Number of bytes freed (estimated)
+        """
+        return 0
+
+    def check_memory_budget(self, additional: int = 0) -> None:
+        """ Make sure the brain (plus 'additional' bytes about to be allocated) fits its memory budget.
+
+        :raises MemoryBudgetExceeded: if it does not, even after reclaiming memory when memory_policy is 'reclaim'
+        """
+        if self.memory_budget is None:
+            return
+        if self.memory_policy not in MEMORY_POLICIES:
+            raise ValueError(f'Unknown memory policy {self.memory_policy}. '
+                             f'Expected one of: {", ".join(MEMORY_POLICIES)}')
+        used = self.memory_report().total
+        if used + additional > self.memory_budget and self.memory_policy == 'reclaim' and self.reclaim_memory():
+            used = self.memory_report().total
+        if used + additional > self.memory_budget:
+            raise MemoryBudgetExceeded(f'{type(self).__name__} holds {format_nbytes(used)}, and needs '
+                                       f'{format_nbytes(additional)} more, over its budget of '
+                                       f'{format_nbytes(self.memory_budget)}')
@@ -0,0 +1,345 @@
+""" Incremental checkpoints of a brain: a base snapshot, followed by small deltas written in the background.
+
+A full brain_util.sim_save of a large brain blocks the simulation while it pickles every connectome, although
+plasticity only changes a few rows of a few connectomes in every round (the rows of the winners that fired into the
+new winners). A DeltaCheckpointer listens to the changes of the connectomes of a brain (see Brain.connectome_changed)
+and keeps track of their dirty rows. Its first checkpoint is a base segment holding the whole brain, and every
+following one is a delta segment holding only:
+    - the dirty rows of array connectomes (along the second to last axis, for the stacked connectomes of an
+      EnsembleBrain),
+    - the explicit (overlay) entries in the dirty rows of compact and implicit connectomes,
+    - whole connectomes that are new, or that may have changed anywhere (e.g. the growing stimulus connectomes of a
+      LazyBrain, or the connectomes renumbered by a compaction),
+    - everything else (areas, stimuli, statistics, ...), which is small next to the connectomes.
+Taking a checkpoint only copies these parts, in the thread of the simulation, so every segment is a consistent
+snapshot of the brain between two rounds. The segment is then written to disk by a background thread while the
+simulation goes on. 'restore' replays the base and the deltas, in order.
+
+Segments are written to a directory ('segment_<index>.pkl') and listed in an index file, which is replaced atomically
+once a segment is completely written, so a crash while writing a checkpoint leaves the previous checkpoints intact.
+
+For archiving a NonLazyBrain, 'save_compact' does not store its connectomes at all: each one is its random 0/1 base,
+which is regenerated from the seed sequence it was drawn from (see connectome_storage.edge_seed_sequence), plus the
+synapses potentiated since, which are stored sparsely as flat indices and potentiation levels (the number of times
+they were multiplied by 1 + beta). A snapshot is therefore proportional to the number of potentiated synapses rather
+than to n^2. 'load_compact' regenerates the bases, in parallel chunks, and applies the potentiated synapses.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+import io
+import json
+import os
+import pickle
+import numpy as np
+from numpy import ndarray
+from brain import Brain
+from connectome_cache import SpilledConnectome
+from connectome_storage import edge_seed_sequence
+from connectome_stats import potentiation_levels
+from non_lazy_brain import NonLazyBrain
+from round_metrics import RoundMetrics
+
+INDEX_FILE = 'index.json'
+
+# A connectome is identified by (source, target, from_stimulus)
+ConnectomeKey = Tuple[str, str, bool]
+
+# Attributes of a brain that are not part of its checkpoints, and their values in a restored brain
+_DETACHED = {'metrics_listeners': list, 'change_listeners': list, 'compaction_listeners': list,
+             'connectome_cache': lambda: None}
+
+
+def _generated_connectomes(brain: Brain) -> Iterator[Tuple[ConnectomeKey, Any]]:
+    for from_stimulus, all_connectomes in ((False, brain.connectomes), (True, brain.stimuli_connectomes)):
+        for source, connectomes in all_connectomes.items():
+            # dict.items, so that looking at the connectomes neither generates them nor goes through a cache
+            for target, connectome in dict.items(connectomes):
+                yield (source, target, from_stimulus), connectome
+
+
+def _row_index(array: ndarray, rows: ndarray) -> tuple:
+    """ Index of 'rows' of an array connectome, along its second to last axis (its only axis, if it has one). """
+    return (slice(None),) * max(array.ndim - 2, 0) + (rows,)
+
+
+class _Pickler(pickle.Pickler):
+    """ Pickles the parts of a brain, referring to its connectomes and areas by key instead of copying them. """
+
+    def __init__(self, file, references: Dict[int, tuple]):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.references = references
+
+    def persistent_id(self, obj) -> Optional[tuple]:
+        return self.references.get(id(obj))
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, brain: Optional[Brain] = None):
+        super().__init__(file)
+        self.brain = brain
+
+    def persistent_load(self, reference: tuple):
+        kind, key = reference
+        # connectomes are put in place once all segments were replayed
+        return self.brain.areas[key] if kind == 'area' else None
+
+
+def _dumps(obj, references: Dict[int, tuple]) -> bytes:
+    buffer = io.BytesIO()
+    _Pickler(buffer, references).dump(obj)
+    return buffer.getvalue()
+
+
+def _brain_state(brain: Brain, references: Dict[int, tuple]) -> bytes:
+    """ Pickle everything of a brain but its listeners, its connectome cache and the connectomes in 'references'. """
+    detached = {name: getattr(brain, name) for name in _DETACHED if hasattr(brain, name)}
+    try:
+        for name in detached:
+            setattr(brain, name, _DETACHED[name]())
+        return _dumps(brain, references)
+    finally:
+        for name, value in detached.items():
+            setattr(brain, name, value)
+
+
+class DeltaCheckpointer:
+    """ Writes a base checkpoint of a brain and then incremental (delta) checkpoints of it to a directory.
+
+    Attributes:
+        brain: The brain checkpointed
+        directory: Directory of the segments and the index
+        every: Take a checkpoint at the end of every this many rounds, or None to only take them with 'checkpoint'
+        segments: Number of checkpoints taken so far (the first one being the base)
+
+    Once a segment fails to be written, no later segment is published (a delta is only meaningful after all the
+    previous ones), and 'checkpoint' raises the error of the failed segment.
+    """
+
+    def __init__(self, brain: Brain, directory: str, every: Optional[int] = None):
+        if os.path.exists(os.path.join(directory, INDEX_FILE)):
+            raise FileExistsError(f'{directory} already holds a checkpoint')
+        os.makedirs(directory, exist_ok=True)
+        self.brain = brain
+        self.directory = directory
+        self.every = every
+        self.segments: int = 0
+        self._dirty: Dict[ConnectomeKey, Optional[List[ndarray]]] = {}
+        self._written: Set[ConnectomeKey] = set()
+        self._files: List[str] = []
+        self._pending: List[Future] = []
+        self._failure: Optional[BaseException] = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        brain.change_listeners.append(self._mark)
+        if every is not None:
+            brain.add_metrics_listener(self._on_round)
+
+    def _mark(self, source: str, target: str, from_stimulus: bool, rows: Optional[Sequence[int]]) -> None:
+        key = (source, target, from_stimulus)
+        if rows is None:
+            self._dirty[key] = None
+        elif key not in self._dirty:
+            self._dirty[key] = [np.asarray(rows, dtype=np.int64)]
+        elif self._dirty[key] is not None:
+            self._dirty[key].append(np.asarray(rows, dtype=np.int64))
+
+    def _on_round(self, metrics: RoundMetrics) -> None:
+        if self.brain.rounds % self.every == 0:
+            self.checkpoint()
+
+    def _snapshot(self, connectome, dirty_rows: Optional[List[ndarray]]) -> tuple:
+        """ A copy of the parts of a connectome that changed since the last checkpoint. """
+        if isinstance(connectome, SpilledConnectome):
+            connectome = connectome.load()
+        if dirty_rows is not None:
+            rows = np.unique(np.concatenate(dirty_rows))
+            if isinstance(connectome, ndarray):
+                return 'rows', rows, connectome[_row_index(connectome, rows)]
+            if hasattr(connectome, 'overlay'):
+                overlay = connectome.overlay
+                in_rows = np.isin(overlay.keys // overlay.cols, rows)
+                return 'entries', overlay.keys[in_rows], overlay.values[in_rows]
+        if isinstance(connectome, ndarray):
+            return 'array', connectome.copy()
+        # e.g. the implicit connectomes of a LazyBrain refer to their areas, which are restored with the brain
+        return 'object', _dumps(connectome, {id(area): ('area', name) for name, area in self.brain.areas.items()})
+
+    def checkpoint(self) -> Future:
+        """ Take a checkpoint: copy what changed since the previous one, and write it in the background.
+
+        :return: A future of the writing of the checkpoint
+        :raises RuntimeError: if a previous checkpoint failed to be written
+        """
+        if self._failure is not None:
+            raise RuntimeError(f'A previous checkpoint in {self.directory} failed to be written') from self._failure
+        entries: Dict[ConnectomeKey, tuple] = {}
+        references: Dict[int, tuple] = {}
+        for key, connectome in _generated_connectomes(self.brain):
+            references[id(connectome)] = ('connectome', key)
+            if key not in self._written:
+                entries[key] = self._snapshot(connectome, None)
+            elif key in self._dirty:
+                entries[key] = self._snapshot(connectome, self._dirty[key])
+        state = _brain_state(self.brain, references)
+        self._dirty = {}
+        self._written.update(entries)
+        index = self.segments
+        self.segments += 1
+        future = self._executor.submit(self._write, index, {'state': state, 'connectomes': entries})
+        self._pending.append(future)
+        return future
+
+    def _write(self, index: int, segment: Dict[str, Any]) -> None:
+        if self._failure is not None:
+            raise RuntimeError(f'Segment {index} follows a segment that failed to be written') from self._failure
+        file_name = f'segment_{index:06d}.pkl'
+        path = os.path.join(self.directory, file_name)
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(segment, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump({'segments': self._files + [file_name]}, f)
+            os.replace(index_path + '.tmp', index_path)
+        except BaseException as error:
+            self._failure = error
+            for temp_path in (path + '.tmp', index_path + '.tmp'):
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            raise
+        self._files.append(file_name)
+
+    def wait(self) -> None:
+        """ Wait until all the checkpoints taken so far are written, raising the error of any that failed. """
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self) -> None:
+        """ Stop tracking the brain, and wait for the checkpoints taken so far. """
+        if self._mark in self.brain.change_listeners:
+            self.brain.change_listeners.remove(self._mark)
+        if self._on_round in self.brain.metrics_listeners:
+            self.brain.remove_metrics_listener(self._on_round)
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self) -> 'DeltaCheckpointer':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def restore(directory: str) -> Brain:
+    """ Restore the brain of the last complete checkpoint in 'directory', by replaying its base and deltas.
+
+    The restored brain has no metrics or change listeners and no connectome cache.
+    """
+    with open(os.path.join(directory, INDEX_FILE)) as f:
+        files = json.load(f)['segments']
+
+    def load(file_name: str) -> Dict[str, Any]:
+        with open(os.path.join(directory, file_name), 'rb') as segment_file:
+            return pickle.load(segment_file)
+
+    brain = _Unpickler(io.BytesIO(load(files[-1])['state'])).load()
+    connectomes: Dict[ConnectomeKey, Any] = {}
+    for file_name in files:
+        for key, entry in load(file_name)['connectomes'].items():
+            kind = entry[0]
+            if kind == 'array':
+                connectomes[key] = entry[1]
+            elif kind == 'object':
+                connectomes[key] = _Unpickler(io.BytesIO(entry[1]), brain).load()
+            elif kind == 'rows':
+                _, rows, weights = entry
+                connectomes[key][_row_index(connectomes[key], rows)] = weights
+            else:
+                _, keys, values = entry
+                connectomes[key].overlay.set(keys, values)
+    for (source, target, from_stimulus), connectome in connectomes.items():
+        all_connectomes = brain.stimuli_connectomes if from_stimulus else brain.connectomes
+        dict.__setitem__(all_connectomes[source], target, connectome)
+    return brain
+
+
+def _level_weights(factor: float, max_level: int) -> ndarray:
+    """ The float32 weight of a synapse potentiated L times by 'factor', for every L up to 'max_level'. """
+    weights = np.ones(max_level + 1, dtype=np.float32)
+    for level in range(1, max_level + 1):
+        # the same float32 products as repeated potentiation
+        weights[level] = weights[level - 1] * np.float32(factor)
+    return weights
+
+
+def _potentiated(connectome) -> Tuple[ndarray, ndarray]:
+    """ The flat indices and the weights of all synapses of a connectome whose weight is neither 0 nor 1. """
+    if isinstance(connectome, ndarray):
+        flat = connectome.reshape(-1)
+        indices = np.flatnonzero((flat != 0) & (flat != 1))
+        return indices, flat[indices]
+    keep = connectome.overlay.values != 1
+    return connectome.overlay.keys[keep], connectome.overlay.values[keep]
+
+
+def save_compact(brain: NonLazyBrain, path: str) -> None:
+    """ Save a NonLazyBrain as the seeds of its connectomes plus its potentiated synapses, see 'load_compact'.
+
+    Synapses whose weight is not an exact power of their connectome's current 1 + beta (e.g. because beta was changed
+    during the run) are stored with their weights, so the brain is always restored exactly.
+    """
+    if not isinstance(brain, NonLazyBrain):
+        raise TypeError(f'Compact snapshots are only supported for NonLazyBrain, not {type(brain).__name__}')
+    connectomes: Dict[ConnectomeKey, Dict[str, Any]] = {}
+    references: Dict[int, tuple] = {}
+    for key, stored in _generated_connectomes(brain):
+        references[id(stored)] = ('connectome', key)
+        connectome = stored.load() if isinstance(stored, SpilledConnectome) else stored
+        source, target, from_stimulus = key
+        if len(connectome.shape) != 2:
+            raise ValueError(f'Connectome {source}->{target} has shape {connectome.shape}, expected a matrix')
+        seed_sequence = edge_seed_sequence(brain.seed, 'stimulus' if from_stimulus else 'area', source, target)
+        factor = 1 + (brain.areas[target].stimulus_beta[source] if from_stimulus else
+                      brain.areas[target].area_beta[source])
+        indices, weights = _potentiated(connectome)
+        levels = potentiation_levels(weights, factor) if factor > 1 else np.zeros(len(weights), dtype=np.int64)
+        levels = np.maximum(levels, 0)
+        regular = _level_weights(factor, int(levels.max(initial=0)))[levels] == weights
+        connectomes[key] = {'shape': tuple(connectome.shape), 'entropy': seed_sequence.entropy,
+                            'spawn_key': seed_sequence.spawn_key, 'factor': factor,
+                            'indices': indices[regular],
+                            'levels': levels[regular].astype(np.min_scalar_type(int(levels.max(initial=0)))),
+                            'irregular_indices': indices[~regular], 'irregular_weights': weights[~regular]}
+    snapshot = {'state': _brain_state(brain, references), 'connectomes': connectomes}
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def load_compact(path: str, init_threads: Optional[int] = None) -> NonLazyBrain:
+    """ Load a brain saved by 'save_compact', regenerating the random base of every connectome.
+
+    :param init_threads: Number of threads generating each connectome (the brain's init_threads if None)
+    """
+    with open(path, 'rb') as f:
+        snapshot = pickle.load(f)
+    brain = _Unpickler(io.BytesIO(snapshot['state'])).load()
+    if init_threads is not None:
+        brain.init_threads = init_threads
+    for (source, target, from_stimulus), saved in snapshot['connectomes'].items():
+        seed_sequence = np.random.SeedSequence(saved['entropy'], spawn_key=saved['spawn_key'])
+        connectome = brain.random_connectome(saved['shape'], seed_sequence)
+        levels = saved['levels'].astype(np.int64)
+        weights = _level_weights(saved['factor'], int(levels.max(initial=0)))[levels]
+        indices = np.concatenate((saved['indices'], saved['irregular_indices']))
+        weights = np.concatenate((weights, saved['irregular_weights']))
+        if isinstance(connectome, ndarray):
+            connectome.reshape(-1)[indices] = weights
+        else:
+            connectome.overlay.set(indices, weights)
+        dict.__setitem__((brain.stimuli_connectomes if from_stimulus else brain.connectomes)[source], target,
+                         connectome)
+    return brain
@@ -0,0 +1,139 @@
+""" A memory budget for the dense connectomes of a NonLazyBrain, spilling the least recently used ones to disk.
+
+In a brain with many areas, only a few pairs of areas are active in any phase of an experiment (e.g. A->C, then B->C),
+yet every connectome ever generated stays in memory. With a ConnectomeCache attached to the brain, every connectome
+lookup goes through the cache, which keeps the resident connectomes in least recently used order. When the resident
+connectomes exceed the budget, the least recently used ones are written to memory mapped files and replaced by
+SpilledConnectome placeholders, and they are transparently read back the next time a projection looks them up.
+A brain several times larger than the memory can therefore run, as long as the working set of every phase fits.
+
+Only dense (ndarray) connectomes owning their memory are spilled. Compact connectomes are small, and views onto memory
+owned by someone else (e.g. the shared memory of a ShardedBrain) must stay where they are.
+"""
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import os
+import shutil
+import tempfile
+import weakref
+import numpy as np
+from numpy import ndarray
+
+# A connectome is identified by (source, target, from_stimulus)
+ConnectomeKey = Tuple[str, str, bool]
+
+
+class SpilledConnectome:
+    """ Placeholder of a connectome that was spilled to disk.
+
+    Attributes:
+        key: The key of the connectome
+        path: Path of the .npy file holding the weights (a unique name, since area names may contain any character)
+        shape: Shape of the connectome
+    """
+
+    nbytes = 0
+
+    def __init__(self, key: ConnectomeKey, path: str, shape: Tuple[int, ...]):
+        self.key = key
+        self.path = path
+        self.shape = shape
+
+    def load(self) -> ndarray:
+        return np.array(np.load(self.path, mmap_mode='r'))
+
+    def __repr__(self) -> str:
+        return f'SpilledConnectome({self.key}, {self.path}, shape={self.shape})'
+
+
+class ConnectomeCache:
+    """ Keeps the dense connectomes of a brain within a memory budget, in least recently used order.
+
+    Attributes:
+        budget: Maximal number of bytes of resident dense connectomes
+        directory: Directory of the spilled connectomes. A temporary directory, removed with the cache, if None.
+        hits: Number of lookups of a resident connectome
+        misses: Number of lookups of a spilled connectome, which had to be read back
+        evictions: Number of connectomes spilled to disk
+        resident: The bytes of every resident connectome, from least to most recently used
+    """
+
+    def __init__(self, budget: int, directory: Optional[str] = None):
+        self.budget = budget
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='connectomes-')
+            self._cleanup = weakref.finalize(self, shutil.rmtree, directory, True)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self._cleanup = None
+        self.directory = directory
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.resident: 'OrderedDict[ConnectomeKey, int]' = OrderedDict()
+        self._paths: Dict[ConnectomeKey, str] = {}
+
+    @property
+    def resident_nbytes(self) -> int:
+        return sum(self.resident.values())
+
+    def lookup(self, connectomes: dict, key: ConnectomeKey, connectome):
+        """ Record the use of a connectome, read it back if it was spilled, and spill others to stay in budget.
+
+        :param connectomes: The (LazyConnectomes) mapping holding the connectome, keyed by target area
+        :param key: The key of the connectome
+        :param connectome: The connectome, or its SpilledConnectome placeholder
+        :return: The resident connectome
+        """
+        if isinstance(connectome, SpilledConnectome):
+            self.misses += 1
+            connectome = connectome.load()
+            dict.__setitem__(connectomes, key[1], connectome)
+        elif key in self.resident:
+            self.hits += 1
+        if not isinstance(connectome, ndarray) or not connectome.flags.owndata:
+            return connectome
+        self.resident[key] = connectome.nbytes
+        self.resident.move_to_end(key)
+        self.evict(connectomes.brain, self.budget, keep=key)
+        return connectome
+
+    def evict(self, brain, budget: int, keep: Optional[ConnectomeKey] = None) -> int:
+        """ Spill least recently used connectomes of 'brain' until the resident ones fit 'budget'.
+
+        :param keep: A connectome that must stay resident (the one being used)
+        :return: The number of bytes spilled
+        """
+        spilled = 0
+        for key in list(self.resident):
+            if self.resident_nbytes <= budget:
+                break
+            if key == keep:
+                continue
+            spilled += self.spill(brain, key)
+        return spilled
+
+    def spill(self, brain, key: ConnectomeKey) -> int:
+        """ Write a resident connectome to a memory mapped file, and replace it by a placeholder. """
+        source, target, from_stimulus = key
+        connectomes = (brain.stimuli_connectomes if from_stimulus else brain.connectomes)[source]
+        weights = dict.__getitem__(connectomes, target)
+        path = self._paths.get(key)
+        if path is None:
+            # a unique file per connectome, reused when it is spilled again
+            descriptor, path = tempfile.mkstemp(suffix='.npy', prefix='stimulus-' if from_stimulus else 'area-',
+                                                dir=self.directory)
+            os.close(descriptor)
+            self._paths[key] = path
+        spilled = np.lib.format.open_memmap(path, mode='w+', dtype=weights.dtype, shape=weights.shape)
+        spilled[...] = weights
+        spilled.flush()
+        del spilled
+        dict.__setitem__(connectomes, target, SpilledConnectome(key, path, weights.shape))
+        self.evictions += 1
+        return self.resident.pop(key)
+
+    def close(self) -> None:
+        """ Remove the spill directory, if it is a temporary one. """
+        if self._cleanup is not None:
+            self._cleanup()
@@ -0,0 +1,110 @@
+""" A pool of pre-generated random connectomes on disk, mapped copy-on-write by new brains.
+
+Sweeps that only differ in beta or in the number of rounds start from the same random brains, yet every run generates
+its connectomes again. A dense connectome of a NonLazyBrain only depends on its shape, on p and on its seed sequence
+(see connectome_storage.edge_seed_sequence), so a ConnectomePool stores every base it generates as a .npy file keyed
+by exactly these, and a brain using the pool (NonLazyBrain.connectome_pool) maps the file copy-on-write instead of
+sampling the connectome again: plasticity changes the brain's private copy of the pages it writes, never the file.
+
+Reproducibility: every base has a provenance record next to it (its shape, p, seed sequence, a digest of its
+content, and when it was generated), and a brain keeps the provenance of every base it mapped in
+NonLazyBrain.connectome_provenance, to be saved with its results.
+
+Independence: a base is only ever shared by brains whose connectome would be identical anyway, since brains with
+different seeds have different keys. Trials that must be independent therefore only need different seeds, which
+'check_independent' verifies from the provenance of their brains.
+"""
+from typing import Any, Dict, Optional, Tuple
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from numpy import ndarray
+from connectome_storage import dense_random
+
+PROVENANCE_SUFFIX = '.json'
+
+
+def pool_key(shape: Tuple[int, int], p: float, seed_sequence: np.random.SeedSequence) -> str:
+    """ The key of the base connectome of the given shape, p and seed sequence. """
+    identity = {'shape': list(shape), 'p': repr(float(p)), 'entropy': str(seed_sequence.entropy),
+                'spawn_key': [int(word) for word in seed_sequence.spawn_key], 'pool_size': seed_sequence.pool_size}
+    return hashlib.blake2b(json.dumps(identity, sort_keys=True).encode(), digest_size=20).hexdigest()
+
+
+class ConnectomePool:
+    """ Pre-generated dense random connectomes, stored as memory mappable .npy files.
+
+    Attributes:
+        directory: Directory of the bases and their provenance records
+        hits: Number of bases mapped from the pool by this process
+        misses: Number of bases generated into the pool by this process
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.npy')
+
+    def base(self, shape: Tuple[int, int], p: float, seed_sequence: np.random.SeedSequence,
+             threads: Optional[int] = None) -> ndarray:
+        """ The random base connectome, the same as connectome_storage.dense_random(shape, p, seed_sequence),
+        mapped copy-on-write. It is generated into the pool first if the pool does not hold it yet.
+        """
+        key = pool_key(shape, p, seed_sequence)
+        path = self._path(key)
+        if os.path.exists(path):
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._generate(key, shape, p, seed_sequence, threads)
+        return np.load(path, mmap_mode='c')
+
+    def _generate(self, key: str, shape: Tuple[int, int], p: float, seed_sequence: np.random.SeedSequence,
+                  threads: Optional[int]) -> None:
+        # generated under unique temporary names (concurrent threads or processes may generate the same base) and
+        # renamed into place, the record first, so they either see a complete base with its record or no base at all
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(descriptor)
+        try:
+            weights = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32, shape=tuple(shape))
+            dense_random(tuple(shape), p, seed_sequence, threads, out=weights)
+            weights.flush()
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        record = {'key': key, 'shape': list(shape), 'p': float(p), 'entropy': str(seed_sequence.entropy),
+                  'spawn_key': [int(word) for word in seed_sequence.spawn_key],
+                  'digest': hashlib.blake2b(weights.data, digest_size=20).hexdigest(), 'generated': time.time()}
+        del weights
+        record_path = os.path.join(self.directory, key + PROVENANCE_SUFFIX)
+        descriptor, temp_record_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as f:
+            json.dump(record, f)
+        os.replace(temp_record_path, record_path)
+        os.replace(temp_path, self._path(key))
+
+    def provenance(self, shape: Tuple[int, int], p: float, seed_sequence: np.random.SeedSequence) -> Dict[str, Any]:
+        """ The provenance record of a base in the pool. """
+        with open(os.path.join(self.directory, pool_key(shape, p, seed_sequence) + PROVENANCE_SUFFIX)) as f:
+            return json.load(f)
+
+
+def check_independent(*brains) -> None:
+    """ Make sure that no two of the given brains were built on the same pooled base connectome.
+
+    :raises ValueError: naming the first base shared by two of the brains
+    """
+    users: Dict[str, int] = {}
+    for index, brain in enumerate(brains):
+        for (source, target, _), record in getattr(brain, 'connectome_provenance', {}).items():
+            other = users.setdefault(record['digest'], index)
+            if other != index:
+                raise ValueError(f'Brains {other} and {index} share the base connectome {record["key"]} '
+                                 f'({source}->{target}). Independent trials need different seeds.')
@@ -0,0 +1,86 @@
+""" Statistics of connectomes, maintained incrementally as plasticity updates them.
+
+Analyses and monitoring often need global properties of a connectome, such as its largest weight, after every round.
+Computing them from scratch scans the whole matrix. Plasticity only ever changes the block of synapses between the
+winners of the source and the new winners of the target, so the brains instead update a ConnectomeStats from the old
+weights of that block whenever they potentiate it, at a cost proportional to the size of the block.
+
+A synapse that was potentiated 'L' times by a factor (1 + beta) has weight (1 + beta)^L, so its potentiation level is
+read back from its weight. Levels are exact as long as the plasticity parameter of a connectome is not changed.
+"""
+from typing import Optional, Sequence
+import numpy as np
+from numpy import ndarray
+from connectome_storage import Connectome, block
+
+
+def potentiation_levels(weights: ndarray, factor: float) -> ndarray:
+    """ The number of times each (non zero) weight was multiplied by 'factor', starting from 1. """
+    return np.rint(np.log(weights) / np.log(factor)).astype(np.int64)
+
+
+class ConnectomeStats:
+    """ Running statistics of the synapses of a single connectome.
+
+    Attributes:
+        max_weight: The largest weight of the connectome (1 while nothing is potentiated, assuming at least one
+            synapse exists)
+        num_potentiated: The number of synapses with a weight above 1
+        level_histogram: level_histogram[L] is the number of synapses potentiated exactly L times, for L >= 1
+            (level_histogram[0] is always 0, unpotentiated synapses are not counted)
+    """
+
+    def __init__(self):
+        self.max_weight: float = 1.0
+        self.num_potentiated: int = 0
+        self.level_histogram: ndarray = np.zeros(1, dtype=np.int64)
+
+    def _add_levels(self, weights: ndarray, factor: float, sign: int) -> None:
+        levels = potentiation_levels(weights[weights > 1], factor)
+        if len(levels) == 0:
+            return
+        counts = np.bincount(levels)
+        if len(counts) > len(self.level_histogram):
+            self.level_histogram = np.pad(self.level_histogram, (0, len(counts) - len(self.level_histogram)))
+        self.level_histogram[:len(counts)] += sign * counts
+
+    def update(self, old_weights: ndarray, factor: float) -> None:
+        """ Account for the potentiation of a block of synapses.
+
+        :param old_weights: The weights of the block before it was multiplied by 'factor'
+        :param factor: The potentiation factor, 1 + beta
+        """
+        if factor == 1 or old_weights.size == 0:
+            return
+        old_weights = np.asarray(old_weights, dtype=np.float32)
+        new_weights = old_weights * np.float32(factor)
+        self.max_weight = max(self.max_weight, float(new_weights.max()))
+        self.num_potentiated += int(np.count_nonzero(new_weights > 1) - np.count_nonzero(old_weights > 1))
+        self._add_levels(old_weights, factor, -1)
+        self._add_levels(new_weights, factor, 1)
+
+    def recompute(self, weights: ndarray, factor: float) -> None:
+        """ Reset the statistics to those of the given weights, e.g. after synapses were removed.
+
+        :param weights: All the weights of the connectome that may be above 1 (in any shape)
+        :param factor: The potentiation factor, 1 + beta
+        """
+        weights = np.asarray(weights, dtype=np.float32)
+        self.__init__()
+        if weights.size:
+            self.max_weight = max(1.0, float(weights.max()))
+        self.num_potentiated = int(np.count_nonzero(weights > 1))
+        if factor != 1:
+            self._add_levels(weights, factor, 1)
+
+
+def assembly_density(connectome: Connectome, winners: Sequence[int], targets: Optional[Sequence[int]] = None) -> float:
+    """ The fraction of existing synapses from 'winners' to 'targets' (by default, among 'winners' themselves).
+
+    :param connectome: A connectome of any storage mode
+    :param winners: Indices of the source neurons
+    :param targets: Indices of the target neurons. Defaults to 'winners', for the density of a recurrent assembly.
+    """
+    targets = winners if targets is None else targets
+    weights = block(connectome, winners, targets)
+    return float(np.count_nonzero(weights)) / weights.size if weights.size else 0.0
@@ -0,0 +1,498 @@
+""" Compact storage backends for the connectomes of NonLazyBrain.
+
+A NonLazyBrain connectome starts out as a random 0/1 matrix in which every entry is 1 with probability 'p'.
+Plasticity only ever multiplies weights by (1 + beta), so an entry that started at 0 stays 0 forever, and an entry
+that started at 1 only changes if both of its neurons were winners at the same time. Storing the whole matrix as
+float32 therefore wastes 32 bits on what is, for almost every synapse, a single random bit.
+
+The backends here split a connectome into:
+    - the base, i.e. the random 0/1 initialization, in a compact representation:
+        * BitPackedConnectome - one bit per possible synapse, appropriate for moderate 'p'.
+        * CSRConnectome - the column indices of the 1 entries of every row, appropriate for small 'p' (e.g. 0.01).
+    - an overlay (SparseOverlay) holding the float weight of every synapse that was potentiated.
+
+Both support computing the total input into every target neuron from a set of firing source neurons directly on the
+compact form, and potentiating the block of synapses between two sets of winners.
+
+The module level functions 'accumulate', 'potentiate', 'block', 'to_dense' and 'connectome_nbytes' accept either a
+compact connectome or a plain dense ndarray, so brain code can handle all storage modes uniformly.
+
+Random connectomes (dense or compact) are generated in fixed size chunks of rows, in parallel on a thread pool.
+Every chunk is drawn from its own child of the connectome's seed sequence, so the result only depends on the seed
+and the shape, and not on the number of threads. Edges are written straight into the final representation, without
+materializing the whole matrix in an intermediate dtype.
+"""
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Type, Union
+import hashlib
+import os
+import numpy as np
+from numpy import ndarray
+
+# Approximate number of matrix entries generated by a single chunk when sampling a random connectome.
+# This bounds the temporary memory of each worker thread.
+CHUNK_ELEMENTS = 1 << 22
+# Number of threads used to generate random connectomes, unless specified otherwise.
+INIT_THREADS = min(8, os.cpu_count() or 1)
+
+
+def _as_indices(indices: Union[Sequence[int], ndarray]) -> ndarray:
+    return np.asarray(indices, dtype=np.int64).reshape(-1)
+
+
+def edge_seed_sequence(seed: int, *names: str) -> np.random.SeedSequence:
+    """ The seed sequence of a single connectome of a brain with seed 'seed'.
+
+    The connectome is identified by names (e.g. its kind, source and target), so that the random connectome does not
+    depend on when, or in which order, the connectomes of the brain are generated.
+    """
+    digest = hashlib.blake2b('\0'.join(names).encode(), digest_size=16).digest()
+    return np.random.SeedSequence(seed, spawn_key=tuple(int(word) for word in np.frombuffer(digest, dtype=np.uint32)))
+
+
+def chunk_seed_sequence(seed_sequence: np.random.SeedSequence, index: int) -> np.random.SeedSequence:
+    """ The 'index'-th child of 'seed_sequence', the same one 'seed_sequence.spawn' would give, without spawning. """
+    return np.random.SeedSequence(seed_sequence.entropy, spawn_key=tuple(seed_sequence.spawn_key) + (index,),
+                                  pool_size=seed_sequence.pool_size)
+
+
+def for_each_chunk(shape: Tuple[int, int], seed_sequence: Optional[np.random.SeedSequence],
+                   generate: Callable[[int, int, np.random.Generator], object],
+                   threads: Optional[int] = None) -> List[object]:
+    """ Run 'generate' on fixed size chunks of rows of a matrix of the given shape, on a thread pool.
+
+    The chunks depend only on the shape, and chunk i is given a generator seeded by the i-th child of
+    'seed_sequence', so the results do not depend on the number of threads.
+
+    :param shape: Shape of the generated matrix
+    :param seed_sequence: Seed sequence of the matrix. A fresh one is used if None.
+    :param generate: Called as generate(start_row, end_row, rng)
+    :param threads: Number of worker threads, INIT_THREADS by default
+    :return: The results of 'generate' on all chunks, in row order
+    """
+    seed_sequence = np.random.SeedSequence() if seed_sequence is None else seed_sequence
+    rows, cols = shape
+    step = max(1, CHUNK_ELEMENTS // max(cols, 1))
+    starts = list(range(0, rows, step))
+
+    def run(index: int):
+        start = starts[index]
+        rng = np.random.default_rng(chunk_seed_sequence(seed_sequence, index))
+        return generate(start, min(start + step, rows), rng)
+
+    threads = INIT_THREADS if threads is None else threads
+    if threads <= 1 or len(starts) <= 1:
+        return [run(index) for index in range(len(starts))]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(run, range(len(starts))))
+
+
+def dense_random(shape: Tuple[int, int], p: float, seed_sequence: Optional[np.random.SeedSequence] = None,
+                 threads: Optional[int] = None, out: Optional[ndarray] = None) -> ndarray:
+    """ A random float32 matrix of the given shape, in which every entry is 1 with probability p and 0 otherwise.
+
+    Uniform samples are drawn directly into the result and thresholded in place, so no memory beyond the result
+    itself is needed.
+
+    :param out: C-contiguous float32 array of the given shape to generate into (e.g. one in shared memory).
+        A new array is allocated if None.
+    """
+    weights = np.empty(shape, dtype=np.float32) if out is None else out
+
+    def generate(start: int, end: int, rng: np.random.Generator) -> None:
+        chunk = weights[start:end]
+        rng.random(dtype=np.float32, out=chunk)
+        np.less(chunk, p, out=chunk, casting='unsafe')
+
+    for_each_chunk(shape, seed_sequence, generate, threads)
+    return weights
+
+
+def bernoulli_positions(rng: np.random.Generator, size: int, p: float) -> ndarray:
+    """ Sample the positions of the successes in 'size' independent Bernoulli(p) trials.
+
+    The positions are generated from geometric gaps between consecutive successes, so the time and memory spent
+    are proportional to the number of successes rather than to 'size'.
+
+    :param rng: The random generator to draw from
+    :param size: Number of trials
+    :param p: Success probability of each trial
+    :return: Sorted int64 array of the indices of successful trials
+    """
+    if p <= 0 or size <= 0:
+        return np.empty(0, dtype=np.int64)
+    if p >= 1:
+        return np.arange(size, dtype=np.int64)
+    expected = size * p
+    batch = int(expected + 5 * np.sqrt(expected) + 16)
+    positions = []
+    last = -1
+    while last < size:
+        batch_positions = last + np.cumsum(rng.geometric(p, size=batch))
+        positions.append(batch_positions)
+        last = int(batch_positions[-1])
+    positions = np.concatenate(positions)
+    return positions[:np.searchsorted(positions, size)]
+
+
+class SparseOverlay:
+    """ Explicit float weights for a sparse set of entries of a (rows x cols) matrix.
+
+    Entries are identified by the key 'row * cols + col' and kept sorted by key, which keeps the entries of every
+    row contiguous.
+
+    Attributes:
+        cols: number of columns of the matrix the overlay belongs to
+        keys: sorted int64 array of the keys of the explicit entries
+        values: float32 array of the weights of the explicit entries, aligned with 'keys'
+    """
+
+    def __init__(self, cols: int):
+        self.cols = cols
+        self.keys: ndarray = np.empty(0, dtype=np.int64)
+        self.values: ndarray = np.empty(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.values.nbytes
+
+    def block_keys(self, rows: ndarray, cols: ndarray) -> ndarray:
+        """ Keys of all the entries in the block rows x cols, in row-major order. """
+        return (rows[:, None] * self.cols + cols[None, :]).reshape(-1)
+
+    def lookup(self, keys: ndarray) -> Tuple[ndarray, ndarray]:
+        """ Find the given keys in the overlay.
+
+        :param keys: int64 array of keys
+        :return: (found, positions) - a boolean mask of the keys that have an explicit entry, and their positions
+            in 'self.keys' (only meaningful where found)
+        """
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        return found, positions
+
+    def get(self, keys: ndarray, default: ndarray) -> ndarray:
+        """ The explicit weights of 'keys', or 'default' (aligned with keys) for the ones without an entry. """
+        found, positions = self.lookup(keys)
+        result = np.array(default, dtype=np.float32)
+        result[found] = self.values[positions[found]]
+        return result
+
+    def set(self, keys: ndarray, values: ndarray) -> None:
+        """ Set explicit weights. 'keys' must not contain duplicates. """
+        keys = _as_indices(keys)
+        values = np.broadcast_to(np.asarray(values, dtype=np.float32), keys.shape)
+        found, positions = self.lookup(keys)
+        self.values[positions[found]] = values[found]
+        new = ~found
+        if np.any(new):
+            keys = np.concatenate((self.keys, keys[new]))
+            values = np.concatenate((self.values, values[new]))
+            order = np.argsort(keys, kind='stable')
+            self.keys = keys[order]
+            self.values = values[order]
+
+    def remap(self, row_map: Optional[ndarray] = None, col_map: Optional[ndarray] = None) -> None:
+        """ Renumber the rows and/or columns of all entries in a single vectorized pass.
+
+        :param row_map: row_map[i] is the new index of row i, or -1 to drop the entries of row i. None keeps the rows.
+        :param col_map: The same for columns
+        """
+        rows, cols = self.keys // self.cols, self.keys % self.cols
+        keep = np.ones(len(self.keys), dtype=bool)
+        if row_map is not None:
+            rows = row_map[rows]
+            keep &= rows >= 0
+        if col_map is not None:
+            cols = col_map[cols]
+            keep &= cols >= 0
+        keys = rows[keep] * self.cols + cols[keep]
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.values = self.values[keep][order]
+
+    def row_entries(self, rows: ndarray) -> Tuple[ndarray, ndarray]:
+        """ All the explicit entries in the given rows.
+
+        :param rows: int64 array of row indices (without duplicates)
+        :return: (columns, values) of the entries
+        """
+        starts = np.searchsorted(self.keys, rows * self.cols)
+        ends = np.searchsorted(self.keys, (rows + 1) * self.cols)
+        lengths = ends - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        # positions = concatenation of the ranges [start, end) of all rows
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions = offsets + np.arange(total)
+        return self.keys[positions] % self.cols, self.values[positions]
+
+
+class CompactConnectome(ABC):
+    """ Abstract connectome made of a compact random 0/1 base and a float overlay of potentiated synapses.
+
+    Subclasses implement the base representation through '_base_row_sum', '_base_block', '_base_nbytes' and the
+    construction methods 'from_dense' and 'random'.
+
+    Attributes:
+        shape: (number of source neurons, number of target neurons)
+        overlay: the weights of the synapses that were potentiated. Every overlay entry is a synapse whose base is 1.
+    """
+
+    def __init__(self, shape: Tuple[int, int]):
+        self.shape: Tuple[int, int] = (int(shape[0]), int(shape[1]))
+        self.overlay = SparseOverlay(self.shape[1])
+
+    @classmethod
+    @abstractmethod
+    def from_dense(cls, weights: ndarray) -> 'CompactConnectome':
+        pass
+
+    @classmethod
+    @abstractmethod
+    def random(cls, shape: Tuple[int, int], p: float, seed_sequence: Optional[np.random.SeedSequence] = None,
+               threads: Optional[int] = None) -> 'CompactConnectome':
+        """ A random connectome in which every synapse exists with probability p, generated by 'for_each_chunk'. """
+
+    @abstractmethod
+    def _base_row_sum(self, rows: ndarray) -> ndarray:
+        """ Sum of the base rows 'rows', as a float array of length shape[1]. """
+
+    @abstractmethod
+    def _base_block(self, rows: ndarray, cols: ndarray) -> ndarray:
+        """ The base of the block rows x cols, as a boolean array. """
+
+    @abstractmethod
+    def _base_nbytes(self) -> int:
+        pass
+
+    @property
+    def nbytes(self) -> int:
+        return self._base_nbytes() + self.overlay.nbytes
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def accumulate(self, rows: Optional[Sequence[int]] = None) -> ndarray:
+        """ Total weight flowing into every target neuron when the source neurons 'rows' fire.
+
+        :param rows: Indices of the firing source neurons, or None for all of them
+        :return: float array of length shape[1]
+        """
+        rows = np.arange(self.shape[0]) if rows is None else _as_indices(rows)
+        inputs = self._base_row_sum(rows)
+        cols, values = self.overlay.row_entries(rows)
+        # overlay entries replace a base weight of 1
+        np.add.at(inputs, cols, values - 1)
+        return inputs
+
+    def potentiate(self, rows: Sequence[int], cols: Sequence[int], factor: float) -> None:
+        """ Multiply the weights of all synapses from 'rows' to 'cols' by 'factor'. Absent synapses stay absent. """
+        rows, cols = _as_indices(rows), _as_indices(cols)
+        if len(rows) == 0 or len(cols) == 0:
+            return
+        keys = self.overlay.block_keys(rows, cols)[self._base_block(rows, cols).reshape(-1)]
+        self.overlay.set(keys, self.overlay.get(keys, np.ones(len(keys))) * factor)
+
+    def block(self, rows: Sequence[int], cols: Sequence[int]) -> ndarray:
+        """ The weights of the block rows x cols as a dense float32 array. """
+        rows, cols = _as_indices(rows), _as_indices(cols)
+        base = self._base_block(rows, cols).astype(np.float32)
+        return self.overlay.get(self.overlay.block_keys(rows, cols), base.reshape(-1)).reshape(base.shape)
+
+    def to_dense(self) -> ndarray:
+        return self.block(np.arange(self.shape[0]), np.arange(self.shape[1]))
+
+    def __getitem__(self, row: int) -> ndarray:
+        """ A (read only) dense copy of row 'row'. """
+        return self.block([row], np.arange(self.shape[1]))[0]
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None) -> ndarray:
+        dense = self.to_dense()
+        return dense if dtype is None else dense.astype(dtype)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(shape={self.shape}, potentiated={len(self.overlay)}, nbytes={self.nbytes})'
+
+
+class BitPackedConnectome(CompactConnectome):
+    """ Compact connectome whose base is stored as a bitmap, one bit per possible synapse.
+
+    Attributes:
+        bits: uint8 array of shape (shape[0], ceil(shape[1] / 8)), the bit-packed rows of the base
+    """
+
+    def __init__(self, shape: Tuple[int, int], bits: ndarray):
+        super().__init__(shape)
+        self.bits: ndarray = bits
+
+    @classmethod
+    def from_dense(cls, weights: ndarray) -> 'BitPackedConnectome':
+        weights = np.asarray(weights)
+        connectome = cls(weights.shape, np.packbits(weights != 0, axis=1))
+        potentiated = np.flatnonzero((weights != 0) & (weights != 1))
+        connectome.overlay.set(potentiated, weights.reshape(-1)[potentiated])
+        return connectome
+
+    @classmethod
+    def random(cls, shape: Tuple[int, int], p: float, seed_sequence: Optional[np.random.SeedSequence] = None,
+               threads: Optional[int] = None) -> 'BitPackedConnectome':
+        rows, cols = shape
+        bits = np.empty((rows, (cols + 7) // 8), dtype=np.uint8)
+
+        def generate(start: int, end: int, rng: np.random.Generator) -> None:
+            bits[start:end] = np.packbits(rng.random((end - start, cols), dtype=np.float32) < p, axis=1)
+
+        for_each_chunk(shape, seed_sequence, generate, threads)
+        return cls(shape, bits)
+
+    def _base_row_sum(self, rows: ndarray) -> ndarray:
+        if len(rows) == 0:
+            return np.zeros(self.shape[1])
+        unpacked = np.unpackbits(self.bits[rows], axis=1, count=self.shape[1])
+        return unpacked.sum(axis=0, dtype=np.float64)
+
+    def _base_block(self, rows: ndarray, cols: ndarray) -> ndarray:
+        packed = self.bits[rows][:, cols >> 3]
+        return ((packed >> (7 - (cols & 7)).astype(np.uint8)) & 1).astype(bool)
+
+    def _base_nbytes(self) -> int:
+        return self.bits.nbytes
+
+
+class CSRConnectome(CompactConnectome):
+    """ Compact connectome whose base is stored as a CSR adjacency structure.
+
+    Attributes:
+        indptr: int64 array of length shape[0] + 1. The base 1 entries of row i are indices[indptr[i]:indptr[i+1]].
+        indices: int32 array of column indices, sorted within every row
+    """
+
+    def __init__(self, shape: Tuple[int, int], indptr: ndarray, indices: ndarray):
+        super().__init__(shape)
+        self.indptr: ndarray = indptr
+        self.indices: ndarray = indices
+
+    @classmethod
+    def from_dense(cls, weights: ndarray) -> 'CSRConnectome':
+        weights = np.asarray(weights)
+        rows, cols = np.nonzero(weights)
+        indptr = np.zeros(weights.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=weights.shape[0]), out=indptr[1:])
+        connectome = cls(weights.shape, indptr, cols.astype(np.int32))
+        potentiated = np.flatnonzero((weights != 0) & (weights != 1))
+        connectome.overlay.set(potentiated, weights.reshape(-1)[potentiated])
+        return connectome
+
+    @classmethod
+    def random(cls, shape: Tuple[int, int], p: float, seed_sequence: Optional[np.random.SeedSequence] = None,
+               threads: Optional[int] = None) -> 'CSRConnectome':
+        rows, cols = shape
+        row_lengths = np.zeros(rows, dtype=np.int64)
+
+        def generate(start: int, end: int, rng: np.random.Generator) -> ndarray:
+            positions = bernoulli_positions(rng, (end - start) * cols, p)
+            row_lengths[start:end] = np.bincount(positions // cols, minlength=end - start)
+            return (positions % cols).astype(np.int32)
+
+        chunks = for_each_chunk(shape, seed_sequence, generate, threads)
+        indptr = np.zeros(rows + 1, dtype=np.int64)
+        np.cumsum(row_lengths, out=indptr[1:])
+        indices = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int32)
+        return cls(shape, indptr, indices)
+
+    def _row_indices(self, rows: ndarray) -> ndarray:
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        lengths = ends - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.indices[offsets + np.arange(int(lengths.sum()))]
+
+    def _base_row_sum(self, rows: ndarray) -> ndarray:
+        return np.bincount(self._row_indices(rows), minlength=self.shape[1]).astype(np.float64)
+
+    def _base_block(self, rows: ndarray, cols: ndarray) -> ndarray:
+        block = np.zeros((len(rows), len(cols)), dtype=bool)
+        for r, row in enumerate(rows):
+            row_indices = self.indices[self.indptr[row]:self.indptr[row + 1]]
+            positions = np.searchsorted(row_indices, cols)
+            found = positions < len(row_indices)
+            found[found] = row_indices[positions[found]] == cols[found]
+            block[r] = found
+        return block
+
+    def _base_nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes
+
+
+# Storage modes selectable through NonLazyBrain(p, storage=...). 'dense' connectomes are plain float32 ndarrays.
+CONNECTOME_STORAGES: Dict[str, Type[CompactConnectome]] = {
+    'bitpacked': BitPackedConnectome,
+    'csr': CSRConnectome,
+}
+
+Connectome = Union[ndarray, CompactConnectome]
+
+
+def accumulate(connectome: Connectome, rows: Optional[Sequence[int]] = None) -> ndarray:
+    """ Total weight flowing into every target neuron of 'connectome' when the source neurons 'rows' fire.
+
+    :param connectome: A dense ndarray, or a connectome object (such as a CompactConnectome)
+    :param rows: Indices of the firing source neurons, or None for all of them
+    """
+    if not isinstance(connectome, ndarray):
+        return connectome.accumulate(rows)
+    if rows is None:
+        return connectome.sum(axis=0, dtype=np.float64)
+    return connectome[_as_indices(rows)].sum(axis=0, dtype=np.float64)
+
+
+def potentiate(connectome: Connectome, rows: Sequence[int], cols: Sequence[int], factor: float) -> None:
+    """ Multiply the weights of the synapses from 'rows' to 'cols' of 'connectome' by 'factor', in place. """
+    if not isinstance(connectome, ndarray):
+        connectome.potentiate(rows, cols, factor)
+    else:
+        connectome[np.ix_(_as_indices(rows), _as_indices(cols))] *= factor
+
+
+def block(connectome: Connectome, rows: Sequence[int], cols: Sequence[int]) -> ndarray:
+    """ The weights of the synapses from 'rows' to 'cols' of 'connectome', as a dense (len(rows), len(cols)) array. """
+    if not isinstance(connectome, ndarray):
+        return connectome.block(rows, cols)
+    return connectome[np.ix_(_as_indices(rows), _as_indices(cols))]
+
+
+def to_dense(connectome: Connectome) -> ndarray:
+    if not isinstance(connectome, ndarray):
+        return connectome.to_dense()
+    return connectome
+
+
+def connectome_nbytes(connectome: Connectome) -> int:
+    return connectome.nbytes
+
+
+def estimate_connectome_nbytes(storage: str, shape: Tuple[int, int], p: float) -> int:
+    """ Expected size in bytes of a freshly generated random connectome, before any potentiation.
+
+    :param storage: 'dense' or one of CONNECTOME_STORAGES
+    :param shape: Shape of the connectome
+    :param p: Probability of each synapse
+    """
+    rows, cols = shape
+    if storage == 'dense':
+        return rows * cols * np.dtype(np.float32).itemsize
+    if storage == 'bitpacked':
+        return rows * ((cols + 7) // 8)
+    if storage == 'csr':
+        return (rows + 1) * np.dtype(np.int64).itemsize + int(rows * cols * p) * np.dtype(np.int32).itemsize
+    raise ValueError(f'Unknown connectome storage {storage}')
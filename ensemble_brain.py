@@ -0,0 +1,144 @@
+""" Many independent trials of the same brain, simulated as one stacked computation.
+
+Statistical experiments (e.g. the association and overlap simulations) run the same architecture over and over with
+different random connectomes. For small areas, most of the time of a NonLazyBrain round goes to Python overhead rather
+than to arithmetic. An EnsembleBrain holds B trials of identical topology with a leading trial axis on everything:
+the connectome from area A to area B is a single (trials, A.n, B.n) array, the winners of an area a (trials, k) array,
+and a round of input accumulation, top-k selection and Hebbian updates is a handful of NumPy calls for all trials.
+
+Every trial has its own seed (see 'trial_seeds'), from which its connectomes are derived exactly like those of a
+NonLazyBrain. Trial i of an EnsembleBrain is therefore independent of the other trials, and identical to a
+NonLazyBrain created with seed trial_seeds[i] and projected the same way.
+"""
+from collections import defaultdict
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from numpy import ndarray
+from brain import Area
+from connectome_stats import ConnectomeStats
+from connectome_storage import dense_random, edge_seed_sequence, estimate_connectome_nbytes
+from non_lazy_brain import NonLazyBrain
+from winner_selection import batched_top_k_indices
+
+
+def _trial_stats(trials: int) -> List[ConnectomeStats]:
+    return [ConnectomeStats() for _ in range(trials)]
+
+
+class EnsembleArea(Area):
+    """ An area in every trial of an EnsembleBrain.
+
+    The attributes of Area hold the state of all trials at once:
+        winner_array, _new_winners: int32 arrays of shape (trials, k), or (trials, 0) before the first projection
+            (and winners, as nested lists)
+        support: bool array of shape (trials, n)
+        support_size, _new_support_size, num_first_winners: int arrays of shape (trials,)
+    """
+
+    def __init__(self, name: str, n: int, k: int, beta: float, trials: int):
+        super().__init__(name, n, k, beta)
+        self.trials = trials
+        self.support = np.zeros((trials, n), dtype=bool)
+        self.support_size = np.zeros(trials, dtype=np.int64)
+        self._new_support_size = np.zeros(trials, dtype=np.int64)
+        self._allocate_winners((trials,))
+        self.num_first_winners = np.full(trials, -1)
+
+    def trial_winners(self, trial: int) -> List[int]:
+        """ The winners of a single trial, as a list like Area.winners. """
+        return self.winner_array[trial].tolist()
+
+
+class EnsembleBrain(NonLazyBrain):
+    """ 'trials' independent NonLazyBrains of identical topology, simulated together.
+
+    Areas, stimuli and projections are declared exactly as for a NonLazyBrain, and apply to all trials.
+    Connectomes have shape (trials, rows, columns), and are generated when first used. Only dense storage is supported.
+
+    Attributes:
+        trials: Number of trials
+        trial_seeds: The seed of every trial
+        connectome_stats, stimulus_connectome_stats: As for a NonLazyBrain, but every value is a list with the
+            ConnectomeStats of every trial
+    """
+
+    def __init__(self, p: float, trials: int, seed: Optional[int] = None, init_threads: Optional[int] = None):
+        super().__init__(p, 'dense', seed, init_threads)
+        self.trials: int = trials
+        self.trial_seeds: List[int] = [int(s) for s in
+                                       np.random.SeedSequence(self.seed).generate_state(trials, dtype=np.uint64)]
+        self.connectome_stats: Dict[Tuple[str, str], List[ConnectomeStats]] = defaultdict(partial(_trial_stats, trials))
+        self.stimulus_connectome_stats: Dict[Tuple[str, str], List[ConnectomeStats]] = \
+            defaultdict(partial(_trial_stats, trials))
+
+    def add_area(self, name: str, n: int, k: int, beta: float) -> None:
+        """ Add an area to all trials, see NonLazyBrain.add_area. """
+        self.areas[name] = EnsembleArea(name, n, k, beta, self.trials)
+        self.connectomes_init_area(self.areas[name], beta)
+
+    def create_connectome(self, source: str, target: str, from_stimulus: bool = False) -> ndarray:
+        """ Generate the random connectomes from 'source' into 'target' of all trials, as one stacked array.
+        The connectome of every trial is drawn from the seed of that trial.
+        """
+        if from_stimulus:
+            shape = (self.stimuli[source].k, self.areas[target].n)
+        else:
+            shape = (self.areas[source].n, self.areas[target].n)
+        kind = 'stimulus' if from_stimulus else 'area'
+        self.check_memory_budget(self.trials * estimate_connectome_nbytes('dense', shape, self.p))
+        connectomes = np.empty((self.trials,) + shape, dtype=np.float32)
+        for trial, trial_seed in enumerate(self.trial_seeds):
+            dense_random(shape, self.p, edge_seed_sequence(trial_seed, kind, source, target), self.init_threads,
+                         out=connectomes[trial])
+        return connectomes
+
+    def project_into_calculate_inputs(self, area: EnsembleArea, from_stimuli: List[str],
+                                      from_areas: List[str]) -> ndarray:
+        """ The total input of every neuron of 'area' in every trial, as an array of shape (trials, area.n). """
+        inputs = np.zeros((self.trials, area.n))
+        trial_index = np.arange(self.trials)[:, None]
+        for from_area in from_areas:
+            # the rows of the firing neurons of every trial, of shape (trials, winners, area.n)
+            fired = self.connectomes[from_area][area.name][trial_index, self.areas[from_area].winner_array]
+            inputs += fired.sum(axis=1, dtype=np.float64)
+        for stim in from_stimuli:
+            inputs += self.stimuli_connectomes[stim][area.name].sum(axis=1, dtype=np.float64)
+        return inputs
+
+    def project_into_calculate_winners(self, area: EnsembleArea, inputs: ndarray) -> ndarray:
+        """ Select the winners of all trials, and update the support.
+        :return: the number of first time winners of every trial
+        """
+        area._new_winners = batched_top_k_indices(inputs, min(area.k, area.n))
+        trial_index = np.arange(self.trials)[:, None]
+        num_first_winners = np.count_nonzero(~area.support[trial_index, area._new_winners], axis=1)
+        area.support[trial_index, area._new_winners] = True
+        area._new_support_size = area.support_size + num_first_winners
+        return num_first_winners
+
+    @staticmethod
+    def _update_stats(trial_stats: List[ConnectomeStats], old_weights: ndarray, factor: float) -> None:
+        """ Account for the potentiation of a stacked block, of shape (trials, rows, columns), in every trial. """
+        for stats, trial_weights in zip(trial_stats, old_weights):
+            stats.update(trial_weights, factor)
+
+    def project_into_update_connectomes(self, area: EnsembleArea, from_stimuli: List[str],
+                                        from_areas: List[str]) -> None:
+        trial_index = np.arange(self.trials)[:, None, None]
+        new_winners = area._new_winners[:, None, :]
+        for stim in from_stimuli:
+            connectome = self.stimuli_connectomes[stim][area.name]
+            stimulus_neurons = np.arange(self.stimuli[stim].k)[None, :, None]
+            self._update_stats(self.stimulus_connectome_stats[(stim, area.name)],
+                               connectome[trial_index, stimulus_neurons, new_winners], 1 + area.stimulus_beta[stim])
+            connectome[trial_index, stimulus_neurons, new_winners] *= 1 + area.stimulus_beta[stim]
+            self.connectome_changed(stim, area.name, True, range(self.stimuli[stim].k))
+        for from_area in from_areas:
+            connectome = self.connectomes[from_area][area.name]
+            from_area_winners = self.areas[from_area]._new_winners[:, :, None]
+            self._update_stats(self.connectome_stats[(from_area, area.name)],
+                               connectome[trial_index, from_area_winners, new_winners], 1 + area.area_beta[from_area])
+            connectome[trial_index, from_area_winners, new_winners] *= 1 + area.area_beta[from_area]
+            # the rows potentiated in any trial (rows are the second axis of the stacked connectomes)
+            self.connectome_changed(from_area, area.name, rows=np.unique(from_area_winners))
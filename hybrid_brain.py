@@ -0,0 +1,144 @@
+""" A brain in which every area has its own representation.
+
+Small areas are cheap to simulate exactly, with every neuron and synapse explicit (as in NonLazyBrain), while huge
+areas only fit in memory when represented lazily (as in LazyBrain). HybridBrain lets every area pick its backend:
+    - 'lazy': only the support is explicit, new winners are sampled statistically (LazyArea).
+    - 'dense', 'bitpacked', 'csr': all neurons are explicit, with incoming connectomes stored in that mode
+      (see connectome_storage).
+The backend is either given to 'add_area', or chosen from n, p and the brain's memory budget, see 'choose_backend'.
+
+Connectomes between two explicit areas are stored in the mode of the target area. Any connectome touching a lazy
+area is an ImplicitConnectome over the explicit neurons of both sides (the support of the lazy side, all neurons of
+an explicit side), whose random edges are defined by hashing their neuron ids. Projection into a lazy area runs the
+LazyBrain algorithm, projection into an explicit area the NonLazyBrain one, and both read their inputs through the
+same connectome interface, so areas of different backends can project into each other.
+Like in NonLazyBrain, connectomes are only generated when first used.
+"""
+from typing import Dict, Iterator, List, Optional
+import numpy as np
+from brain import Area, Stimulus
+from connectome_storage import CONNECTOME_STORAGES, Connectome, dense_random, edge_seed_sequence, \
+    estimate_connectome_nbytes
+from implicit_connectome import ImplicitConnectome
+from lazy_brain import LazyBrain, LazyArea
+from non_lazy_brain import NonLazyBrain
+
+BACKENDS = ('lazy', 'dense') + tuple(CONNECTOME_STORAGES)
+
+# Default memory budget, in bytes, for the recurrent connectome of a single explicit area.
+DEFAULT_AREA_MEMORY_BUDGET = 1 << 30
+
+
+class HybridBrain(LazyBrain):
+    """ A brain in which every area is either lazy or explicit, with its own connectome storage.
+
+    Attributes:
+        backends: The backend of every area, one of BACKENDS
+        area_memory_budget: The largest size in bytes of the recurrent connectome of an explicit area chosen
+            automatically. Areas that do not fit are lazy.
+        init_threads: Number of threads generating random connectomes (see NonLazyBrain)
+    """
+
+    connectomes_init_area = NonLazyBrain.connectomes_init_area
+    connectomes_init_stimulus = NonLazyBrain.connectomes_init_stimulus
+    project_into_calculate_inputs = NonLazyBrain.project_into_calculate_inputs
+    project_into_calculate_winners = NonLazyBrain.__dict__['project_into_calculate_winners']
+    project_into_update_connectomes = NonLazyBrain.project_into_update_connectomes
+
+    def __init__(self, p: float, seed: Optional[int] = None, area_memory_budget: int = DEFAULT_AREA_MEMORY_BUDGET,
+                 init_threads: Optional[int] = None, **kwargs):
+        super().__init__(p, seed, **kwargs)
+        self.backends: Dict[str, str] = {}
+        self.area_memory_budget: int = area_memory_budget
+        self.init_threads: Optional[int] = init_threads
+        self.connectome_cache = None
+
+    def choose_backend(self, n: int) -> str:
+        """ The backend of an area of 'n' neurons: the fastest explicit representation whose recurrent connectome
+        fits the memory budget, preferring dense, then the smaller of bit-packed and CSR. Lazy if none fits.
+        """
+        if estimate_connectome_nbytes('dense', (n, n), self.p) <= self.area_memory_budget:
+            return 'dense'
+        storage = min(CONNECTOME_STORAGES, key=lambda name: estimate_connectome_nbytes(name, (n, n), self.p))
+        if estimate_connectome_nbytes(storage, (n, n), self.p) <= self.area_memory_budget:
+            return storage
+        return 'lazy'
+
+    def add_stimulus(self, name: str, k: int) -> None:
+        """ Initialize a random stimulus with 'k' neurons firing. Its connectomes are generated when first used.
+
+        :param name: Name used to refer to stimulus
+        :param k: Number of neurons in the stimulus
+        """
+        self.stimuli[name] = Stimulus(k)
+        self.connectomes_init_stimulus(self.stimuli[name], name)
+
+    def add_area(self, name: str, n: int, k: int, beta: float, backend: Optional[str] = None) -> None:
+        """ Add an area to this brain, randomly connected to all other areas and stimuli.
+
+        :param name: Name of area
+        :param n: Number of neurons in the new area
+        :param k: Number of winners in the new area
+        :param beta: plasticity parameter of connectomes coming INTO this area.
+        :param backend: One of BACKENDS. Chosen by 'choose_backend' if None.
+        """
+        backend = self.choose_backend(n) if backend is None else backend
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {backend}. Expected one of: {", ".join(BACKENDS)}')
+        self.backends[name] = backend
+        self.areas[name] = LazyArea(name, n, k, beta) if backend == 'lazy' else Area(name, n, k, beta)
+        self.connectomes_init_area(self.areas[name], beta)
+
+    def create_connectome(self, source: str, target: str, from_stimulus: bool = False) -> Connectome:
+        """ Generate the random connectome from area (or stimulus) 'source' into area 'target'.
+        Called by LazyConnectomes when the connectome is first used.
+        """
+        target_area = self.areas[target]
+        storage = self.backends[target]
+        if from_stimulus:
+            if storage == 'lazy':
+                return np.empty(0)
+            shape = (self.stimuli[source].k, target_area.n)
+            return self.random_connectome(storage, shape, edge_seed_sequence(self.seed, 'stimulus', source, target))
+        if storage == 'lazy' or self.backends[source] == 'lazy':
+            return self.new_connectome(source, target)
+        shape = (self.areas[source].n, target_area.n)
+        return self.random_connectome(storage, shape, edge_seed_sequence(self.seed, 'area', source, target))
+
+    def random_connectome(self, storage: str, shape, seed_sequence: np.random.SeedSequence) -> Connectome:
+        self.check_memory_budget(estimate_connectome_nbytes(storage, shape, self.p))
+        if storage == 'dense':
+            return dense_random(shape, self.p, seed_sequence, self.init_threads)
+        return CONNECTOME_STORAGES[storage].random(shape, self.p, seed_sequence, self.init_threads)
+
+    def incident_connectomes(self, area_name: str) -> Iterator[ImplicitConnectome]:
+        """ The connectomes generated so far into and out of the (lazy) area 'area_name'. """
+        area = self.areas[area_name]
+        for connectomes in self.connectomes.values():
+            for connectome in connectomes.values():
+                if isinstance(connectome, ImplicitConnectome) and (connectome.source is area or
+                                                                   connectome.target is area):
+                    yield connectome
+
+    def compact(self, area_name: str, idle_rounds: Optional[int] = None, max_wins: Optional[int] = None,
+                keep_potentiated: Optional[bool] = None) -> int:
+        """ LazyBrain.compact for a lazy area. Explicit areas have nothing to compact. """
+        if self.backends[area_name] != 'lazy':
+            return 0
+        return super().compact(area_name, idle_rounds, max_wins, keep_potentiated)
+
+    def project_into(self, area: Area, from_stimuli: List[str], from_areas: List[str]) -> int:
+        """Project multiple stimuli and area assemblies into area 'area' at the same time,
+        using the algorithm of the backend of 'area'.
+
+        :param area: The area projected into
+        :param from_stimuli: The stimuli that we will be applying
+        :param from_areas: List of separate areas whose assemblies we will projected into this area
+        :return: Returns the number of area neurons that were winners for the first time during this projection
+        """
+        if self.backends[area.name] == 'lazy':
+            return super().project_into(area, from_stimuli, from_areas)
+        inputs = self.project_into_calculate_inputs(area, from_stimuli, from_areas)
+        num_first_winners = self.project_into_calculate_winners(area, inputs)
+        self.project_into_update_connectomes(area, from_stimuli, from_areas)
+        return num_first_winners
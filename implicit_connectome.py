@@ -0,0 +1,150 @@
+""" Connectomes whose random synapses are defined implicitly by a counter-based hash.
+
+In LazyBrain, a synapse that was never touched by plasticity is simply an independent Bernoulli(p) edge. Instead of
+drawing and storing these edges whenever the support of an area grows, an ImplicitConnectome defines the edge between
+source neuron i and target neuron j as a deterministic function of (brain seed, source name, target name, i, j):
+the pair (i, j) is mixed with a per-connectome key by the splitmix64 finalizer, and the edge exists iff the resulting
+64 bit value is below p * 2^64. Here i and j are the stable ids of the neurons (see LazyArea.support_ids) rather
+than their current support indices, so that the implicit edges of a neuron survive the compaction of the support.
+
+Edges are therefore generated on demand whenever a projection reads them, and only the synapses whose weight differs
+from the implicit one (the ones decided while sampling the inputs of first time winners, and potentiated ones) are
+stored explicitly, in a SparseOverlay. A connectome between areas that never project into each other costs nothing
+and the whole structure of the brain can be reproduced from its seed.
+"""
+from typing import Optional, Sequence, Tuple
+import hashlib
+import numpy as np
+from numpy import ndarray
+from brain import Area
+from connectome_storage import SparseOverlay
+
+# Overlay entries are keyed by (row << 32) | col, which is independent of the (growing) number of columns.
+_KEY_STRIDE = 1 << 32
+
+
+def _mix64(x: ndarray) -> ndarray:
+    """ The splitmix64 finalizer, a bijection on uint64 with good avalanche properties. """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def connectome_key(seed: int, source: str, target: str) -> Tuple[int, int]:
+    """ A pair of 64 bit keys identifying the connectome from 'source' to 'target' in a brain with seed 'seed'. """
+    digest = hashlib.blake2b(f'{seed}\0{source}\0{target}'.encode(), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+
+
+def implicit_edges(key: Tuple[int, int], p: float, rows: ndarray, cols: ndarray) -> ndarray:
+    """ The implicit random edges of the block rows x cols.
+
+    :param key: The connectome key, as returned by 'connectome_key'
+    :param p: Probability of each edge
+    :param rows: Indices of the source neurons
+    :param cols: Indices of the target neurons
+    :return: Boolean array of shape (len(rows), len(cols))
+    """
+    rows = np.asarray(rows, dtype=np.uint64)
+    cols = np.asarray(cols, dtype=np.uint64)
+    if p >= 1:
+        return np.ones((len(rows), len(cols)), dtype=bool)
+    counters = (rows[:, None] << np.uint64(32)) | cols[None, :]
+    hashed = _mix64(_mix64(counters ^ np.uint64(key[0])) ^ np.uint64(key[1]))
+    return hashed < np.uint64(int(p * 2 ** 64))
+
+
+class ImplicitConnectome:
+    """ The connectome between the supports of two areas, with implicitly defined random edges.
+
+    The shape follows the number of explicit neurons of the source and target areas (the support sizes of lazy
+    areas, or all 'n' neurons of other areas). Entries that were set or potentiated are kept in an overlay, all the
+    others are the implicit Bernoulli(p) edges.
+
+    Attributes:
+        key: The key of this connectome, see 'connectome_key'
+        p: Probability of an implicit edge
+        source: The area of the pre-synaptic neurons (rows). Its 'neuron_ids' give the ids of the rows.
+        target: The area of the post-synaptic neurons (columns). Its 'neuron_ids' give the ids of the columns.
+        overlay: The explicit weights, indexed by row / column indices
+    """
+
+    def __init__(self, key: Tuple[int, int], p: float, source: Area, target: Area):
+        self.key = key
+        self.p = p
+        self.source = source
+        self.target = target
+        self.overlay = SparseOverlay(_KEY_STRIDE)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.source.num_explicit, self.target.num_explicit
+
+    @property
+    def nbytes(self) -> int:
+        return self.overlay.nbytes
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def block(self, rows: Sequence[int], cols: Sequence[int]) -> ndarray:
+        """ The weights of the block rows x cols as a dense float32 array. """
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        cols = np.asarray(cols, dtype=np.int64).reshape(-1)
+        base = implicit_edges(self.key, self.p, self.source.neuron_ids(rows),
+                              self.target.neuron_ids(cols)).astype(np.float32)
+        if len(self.overlay) == 0:
+            return base
+        return self.overlay.get(self.overlay.block_keys(rows, cols), base.reshape(-1)).reshape(base.shape)
+
+    def set_block(self, rows: Sequence[int], cols: Sequence[int], weights: ndarray) -> None:
+        """ Explicitly set the weights of the block rows x cols. """
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        cols = np.asarray(cols, dtype=np.int64).reshape(-1)
+        self.overlay.set(self.overlay.block_keys(rows, cols), np.asarray(weights, dtype=np.float32).reshape(-1))
+
+    def scale_block(self, rows: Sequence[int], cols: Sequence[int], factor: float) -> None:
+        """ Multiply the weights of the block rows x cols by 'factor'. Absent edges stay absent (and implicit). """
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        cols = np.asarray(cols, dtype=np.int64).reshape(-1)
+        if len(rows) == 0 or len(cols) == 0:
+            return
+        keys = self.overlay.block_keys(rows, cols)
+        weights = self.block(rows, cols).reshape(-1)
+        found, _ = self.overlay.lookup(keys)
+        changed = found | (weights != 0)
+        self.overlay.set(keys[changed], weights[changed] * factor)
+
+    def potentiate(self, rows: Sequence[int], cols: Sequence[int], factor: float) -> None:
+        """ Same as 'scale_block', for connectome_storage.potentiate. """
+        self.scale_block(rows, cols, factor)
+
+    def accumulate(self, rows: Optional[Sequence[int]] = None, num_cols: Optional[int] = None) -> ndarray:
+        """ Total weight flowing into each of the first 'num_cols' target neurons when the source neurons 'rows' fire.
+
+        :param rows: Indices of the firing source neurons, or None for all of them
+        :param num_cols: Number of target neurons, by default all explicit ones
+        """
+        rows = np.arange(self.shape[0]) if rows is None else rows
+        num_cols = self.shape[1] if num_cols is None else num_cols
+        return self.block(rows, np.arange(num_cols)).sum(axis=0, dtype=np.float64)
+
+    def to_dense(self) -> ndarray:
+        rows, cols = self.shape
+        return self.block(np.arange(rows), np.arange(cols))
+
+    def __getitem__(self, row: int) -> ndarray:
+        """ A (read only) dense copy of row 'row'. """
+        return self.block([row], np.arange(self.shape[1]))[0]
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None) -> ndarray:
+        dense = self.to_dense()
+        return dense if dtype is None else dense.astype(dtype)
+
+    def __repr__(self) -> str:
+        return (f'ImplicitConnectome({self.source.name}->{self.target.name}, shape={self.shape}, '
+                f'explicit={len(self.overlay)})')
@@ -0,0 +1,100 @@
+""" Read-only, batched readout of a trained brain.
+
+After training, a brain is mostly queried: some stimuli or (partial) assemblies fire, and we look at which neurons of a
+downstream area would win. Doing that with 'Brain.project' runs plasticity and changes the brain, so every query needs
+a copy of it. The functions of this module instead answer Q queries at once without touching the state of the brain:
+the firing neurons of every source are gathered into a sparse (Q, rows) indicator matrix, and the inputs of all the
+queries are a single sparse matrix product with the connectome from that source.
+
+A query maps names of source areas or stimuli to the indices of their firing neurons (None for all of them, the usual
+case for stimuli). For example, firing the stimulus 's' alone, then half of the assembly of area 'A' alone:
+
+    infer_winners(brain, 'B', [{'s': None}, {'A': brain.areas['A'].winners[:k // 2]}])
+
+Connectomes that were never generated (see non_lazy_brain.LazyConnectomes) are generated on lookup, which does not
+change the behaviour of the brain. In lazily represented areas only the neurons of the support are candidates, since
+the others have never been drawn.
+"""
+from typing import Mapping, Optional, Sequence
+import numpy as np
+from numpy import ndarray
+from scipy import sparse
+from connectome_storage import Connectome, accumulate
+from winner_selection import batched_top_k_indices
+
+Query = Mapping[str, Optional[Sequence[int]]]
+
+
+def _indicator(queries: Sequence[Query], source: str, num_rows: int) -> sparse.csr_matrix:
+    """ The (Q, num_rows) 0/1 matrix of the neurons of 'source' firing in every query. """
+    rows = []
+    for query in queries:
+        if source not in query:
+            rows.append(np.empty(0, dtype=np.int64))
+        elif query[source] is None:
+            rows.append(np.arange(num_rows))
+        else:
+            rows.append(np.asarray(query[source], dtype=np.int64))
+    indptr = np.concatenate(([0], np.cumsum([len(r) for r in rows])))
+    indices = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+    return sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(queries), num_rows))
+
+
+def _connectome_inputs(connectome: Connectome, indicator: sparse.csr_matrix, num_cols: int) -> ndarray:
+    """ The (Q, num_cols) inputs flowing through 'connectome' when the rows of every row of 'indicator' fire. """
+    if isinstance(connectome, ndarray):
+        return np.asarray(indicator @ connectome[:, :num_cols], dtype=np.float64)
+    # compact and implicit connectomes have no matrix to multiply with, but accumulate the inputs of a set of rows
+    inputs = np.zeros((indicator.shape[0], num_cols))
+    for query in range(indicator.shape[0]):
+        rows = indicator.indices[indicator.indptr[query]:indicator.indptr[query + 1]]
+        if len(rows):
+            inputs[query] = accumulate(connectome, rows)[:num_cols]
+    return inputs
+
+
+def infer_inputs(brain, area: str, queries: Sequence[Query]) -> ndarray:
+    """ The total input of every candidate neuron of area 'area', for every query, with plasticity off.
+
+    :param brain: A trained brain
+    :param area: Name of the area read out
+    :param queries: Q queries, each mapping source names (areas or stimuli) to their firing neurons, or None for all
+    :return: float64 array of shape (Q, candidates), where the candidates are the explicit neurons of the area
+    """
+    target = brain.areas[area]
+    num_candidates = target.num_explicit
+    inputs = np.zeros((len(queries), num_candidates))
+    sources = {source for query in queries for source in query}
+    for source in sources:
+        if source in brain.stimuli:
+            connectome = brain.stimuli_connectomes[source][area]
+            if isinstance(connectome, ndarray) and connectome.ndim == 1:
+                # a lazy area only keeps the total weight from the (whole) stimulus into every support neuron
+                if any(query.get(source, None) is not None for query in queries):
+                    raise ValueError(f'Only the whole stimulus {source} can fire into the lazy area {area}')
+                fires = np.array([source in query for query in queries])
+                weights = connectome[:num_candidates]
+                inputs[fires, :len(weights)] += weights
+                continue
+            num_rows = brain.stimuli[source].k
+        elif source in brain.areas:
+            connectome = brain.connectomes[source][area]
+            num_rows = brain.areas[source].num_explicit
+        else:
+            raise IndexError(source + " not in brain.stimuli or brain.areas")
+        inputs += _connectome_inputs(connectome, _indicator(queries, source, num_rows), num_candidates)
+    return inputs
+
+
+def infer_winners(brain, area: str, queries: Sequence[Query], k: Optional[int] = None) -> ndarray:
+    """ The winners of area 'area' for every query, with plasticity off and without changing the brain.
+
+    :param brain: A trained brain
+    :param area: Name of the area read out
+    :param queries: Q queries, see 'infer_inputs'
+    :param k: Number of winners per query, the area's k by default
+    :return: int64 array of shape (Q, k), every row ordered like the winners of a projection
+    """
+    inputs = infer_inputs(brain, area, queries)
+    k = brain.areas[area].k if k is None else k
+    return batched_top_k_indices(inputs, min(k, inputs.shape[1]))
@@ -1,25 +1,138 @@
 from brain import Brain, Stimulus, Area
 import logging
-from typing import List, Dict
+from typing import Callable, List, Dict, Iterator, Optional, Sequence, Set
 import numpy as np
-import heapq
 
 from numpy.core._multiarray_umath import ndarray
 from scipy.stats import binom
 from scipy.stats import truncnorm
+from connectome_storage import edge_seed_sequence
+from implicit_connectome import ImplicitConnectome, connectome_key
+from random_source import RandomSource
+from tracing import trace
 import math
 import random
 
+RANDOM_DRAWS = ('global', 'stream', 'prefetch')
+
+# Called with (area, index_map) after a compaction renumbered the support of an area: index_map[i] is the new index of
+# the neuron of old index i, or -1 if it was evicted
+CompactionListener = Callable[[str, ndarray], None]
+
+
+class LazyArea(Area):
+    """ An area of a LazyBrain, with the bookkeeping needed to compact its support.
+
+    Attributes:
+        support_ids: Stable id of every support neuron. The implicit edges of a neuron are defined by its id, so
+            they do not change when the support is renumbered by a compaction. During a projection this also holds
+            the ids of the first winners, which only join the support once the winners are updated.
+        next_id: The id of the next neuron to join the support
+        win_counts: Number of rounds each support neuron was a winner in
+        last_win: The last round each support neuron was a winner in
+        rounds: Number of rounds in which this area was projected into
+        compacted_size: The support size right after the last compaction
+    """
+
+    def __init__(self, name: str, n: int, k: int, beta: float = 0.05):
+        super().__init__(name, n, k, beta)
+        self.support_ids: ndarray = np.empty(0, dtype=np.int64)
+        self.next_id: int = 0
+        self.win_counts: ndarray = np.empty(0, dtype=np.int64)
+        self.last_win: ndarray = np.empty(0, dtype=np.int64)
+        self.rounds: int = 0
+        self.compacted_size: int = 0
+
+    def record_winners(self, winners: ndarray, num_first_winners: int) -> None:
+        """ Give ids to the first winners of the current round and count the wins of all winners. """
+        first_ids = np.arange(self.next_id, self.next_id + num_first_winners)
+        self.support_ids = np.concatenate((self.support_ids[:self.support_size], first_ids))
+        self.next_id += num_first_winners
+        self.win_counts = np.concatenate((self.win_counts[:self.support_size],
+                                          np.zeros(num_first_winners, dtype=np.int64)))
+        self.last_win = np.concatenate((self.last_win[:self.support_size],
+                                        np.zeros(num_first_winners, dtype=np.int64)))
+        self.win_counts[winners] += 1
+        self.last_win[winners] = self.rounds
+
+    @property
+    def num_explicit(self) -> int:
+        return self.support_size
+
+    def neuron_ids(self, indices: ndarray) -> ndarray:
+        return self.support_ids[indices]
+
+    def update_winners(self) -> None:
+        super().update_winners()
+        self.rounds += 1
+
 
 class LazyBrain(Brain):
     """ Represents a simulated brain where the the connectomes are generated lazily, i.e. generated only when needed.
 
     The brain updates by selecting a subgraph of stimuli and areas, and activating only those connections.
 
+    The area to area connectomes are ImplicitConnectomes: a synapse that was never sampled as an input of a first time
+    winner nor potentiated is a Bernoulli(p) edge defined by a hash of (seed, source area, target area, i, j), and is
+    only computed when a projection reads it.
+
+    The seed of the brain defines the implicit random edges of all connectomes.
+
+    Recurrent projection keeps adding neurons to the support. 'compact' evicts the support neurons that have not won
+    for a while, and can run automatically whenever the support of an area grew by 'compaction_growth' neurons.
+
+    Attributes:
+        compaction_growth: Compact an area whenever its support grew by this many neurons since the last compaction.
+            None disables automatic compaction.
+        compaction_idle_rounds: Default number of recent rounds a neuron must not have won in to be evicted
+        compaction_max_wins: Default maximal number of wins of an evicted neuron
+        compaction_keep_potentiated: By default, whether neurons with potentiated outgoing synapses are never evicted
+        random_source: The stream of the random draws of the projections (the inputs of potential new winners, and
+            which inputs fired into the first winners), or None to draw from the global random generators.
+            It is created from the 'random_draws' argument: 'global' (None), 'stream' (a RandomSource derived from
+            the seed of the brain) or 'prefetch' (the same stream, generated ahead on a background thread, with
+            bit-identical results). See random_source.
+        compaction_listeners: Called after every compaction that evicted neurons, e.g. by
+            assembly_registry.AssemblyRegistry to renumber its assemblies
     """
 
-    def __init__(self, p: float):
-        super().__init__(p)
+    def __init__(self, p: float, seed: Optional[int] = None, compaction_growth: Optional[int] = None,
+                 compaction_idle_rounds: int = 10, compaction_max_wins: int = 1,
+                 compaction_keep_potentiated: bool = True, random_draws: str = 'global'):
+        super().__init__(p, seed)
+        if random_draws not in RANDOM_DRAWS:
+            raise ValueError(f'Unknown random draws {random_draws}. Expected one of: {", ".join(RANDOM_DRAWS)}')
+        self.compaction_growth: Optional[int] = compaction_growth
+        self.compaction_idle_rounds: int = compaction_idle_rounds
+        self.compaction_max_wins: int = compaction_max_wins
+        self.compaction_keep_potentiated: bool = compaction_keep_potentiated
+        self.random_source: Optional[RandomSource] = None
+        self.compaction_listeners: List[CompactionListener] = []
+        if random_draws != 'global':
+            self.random_source = RandomSource(edge_seed_sequence(self.seed, 'draws'),
+                                              prefetch=random_draws == 'prefetch')
+
+    def sample(self, population: int, count: int) -> Sequence[int]:
+        """ 'count' distinct indices out of range(population), chosen uniformly at random. """
+        if self.random_source is None:
+            return random.sample(range(population), count)
+        return self.random_source.sample(population, count)
+
+    def new_connectome(self, from_area: str, to_area: str) -> ImplicitConnectome:
+        """ Create the (initially entirely implicit) connectome from area 'from_area' to area 'to_area'. """
+        return ImplicitConnectome(connectome_key(self.seed, from_area, to_area), self.p,
+                                  self.areas[from_area], self.areas[to_area])
+
+    def connectome(self, from_area: str, to_area: str) -> ImplicitConnectome:
+        """ The connectome from area 'from_area' to area 'to_area'. """
+        return self.connectomes[from_area][to_area]
+
+    def incident_connectomes(self, area_name: str) -> Iterator[ImplicitConnectome]:
+        """ All the connectomes into and out of area 'area_name' (the self connectome only once). """
+        for other_area, connectome in self.connectomes[area_name].items():
+            yield connectome
+            if other_area != area_name:
+                yield self.connectomes[other_area][area_name]
 
     def add_stimulus(self, name: str, k: int) -> None:
         """ Initialize a random stimulus with 'k' neurons firing.
@@ -39,7 +152,7 @@ class LazyBrain(Brain):
         # (From here to the end of the function).
         new_connectomes: Dict[str, ndarray] = {}
         for key in self.areas:
-            new_connectomes[key] = np.empty((0, 0))
+            new_connectomes[key] = np.empty(0)
             self.areas[key].stimulus_beta[name] = self.areas[key].beta
         self.stimuli_connectomes[name] = new_connectomes
 
@@ -47,7 +160,7 @@ class LazyBrain(Brain):
         """Add an area to this brain, randomly connected to all other areas and stimulus.
 
         Initialize each synapse weight to have a value of 0 or 1 with probability 'p'.
-        Initialize incoming and outgoing connectomes as empty arrays.
+        Initialize incoming and outgoing connectomes as implicit connectomes (no synapse is stored explicitly).
         Initialize incoming betas as 'beta'.
         Initialize outgoing betas as the target area.beta
 
@@ -58,22 +171,110 @@ class LazyBrain(Brain):
                 The plasticity parameter of connectomes FROM this area INTO other areas are decided by
                 the betas of those other areas.
         """
-        self.areas[name] = Area(name, n, k, beta)
+        self.areas[name] = LazyArea(name, n, k, beta)
 
         # This should be replaced by conectomes_init_area(self, self.areas[name], beta).
         # (From here to the end of the function).
         for stim_name, stim_connectomes in self.stimuli_connectomes.items():
-            stim_connectomes[name] = np.empty(0)  # TODO: Should this be np.empty((0,0))?
+            stim_connectomes[name] = np.empty(0)
             self.areas[name].stimulus_beta[stim_name] = beta
 
-        new_connectomes: Dict[str, ndarray] = {}
+        self.connectomes[name] = {}
         for key in self.areas:
-            new_connectomes[key] = np.empty((0, 0))
+            self.connectomes[name][key] = self.new_connectome(name, key)
             if key != name:
-                self.connectomes[key][name] = np.empty((0, 0))
+                self.connectomes[key][name] = self.new_connectome(key, name)
             self.areas[key].area_beta[name] = self.areas[key].beta
             self.areas[name].area_beta[key] = beta
-        self.connectomes[name] = new_connectomes
+
+    def end_round(self, updated_areas: Set[str]) -> None:
+        """ Compact the supports of the projected areas that grew too much, then check the memory budget. """
+        if self.compaction_growth is not None:
+            for name in updated_areas:
+                area = self.areas[name]
+                if isinstance(area, LazyArea) and area.support_size - area.compacted_size >= self.compaction_growth:
+                    self.compact(name)
+        super().end_round(updated_areas)
+
+    def reclaim_memory(self) -> int:
+        """ Compact the supports of all lazy areas.
+        :return: The number of bytes freed
+        """
+        used = self.memory_report().total
+        for name, area in self.areas.items():
+            if isinstance(area, LazyArea):
+                self.compact(name)
+        return used - self.memory_report().total
+
+    def compact(self, area_name: str, idle_rounds: Optional[int] = None, max_wins: Optional[int] = None,
+                keep_potentiated: Optional[bool] = None) -> int:
+        """ Evict idle neurons from the support of an area, returning them to the implicit pool.
+
+        A neuron is evicted if it did not win in the last 'idle_rounds' rounds of the area and won at most
+        'max_wins' times overall. Its incoming synapses are potentiated in every round it wins, so with max_wins=1
+        they carry the single potentiation step of the round it joined the support (a neuron that won can never be
+        entirely unpotentiated, as its first win strengthens the synapses that made it win). Its outgoing synapses
+        are potentiated in the rounds after its wins, when it fires into the new winners of an area. With
+        keep_potentiated, a neuron with any potentiated outgoing synapse is never evicted. In a recurrent run nearly
+        every winner fires into the next winners, so this mostly evicts neurons that only won from stimuli.
+
+        Compaction changes the results of a simulation: the weights an evicted neuron keeps explicitly are dropped
+        (the potentiation of its first win, which of the previous winners fired into it, and without keep_potentiated
+        what it learned as a source), and if it joins the support again, it has the random weights of any neuron of
+        the implicit pool.
+
+        All connectomes into and out of the area, and the stimulus connectomes into it, are renumbered in one
+        vectorized pass. The current winners are never evicted.
+
+        :param area_name: Name of the area to compact
+        :param idle_rounds: Defaults to self.compaction_idle_rounds
+        :param max_wins: Defaults to self.compaction_max_wins
+        :param keep_potentiated: Defaults to self.compaction_keep_potentiated
+        :return: The number of evicted neurons
+        """
+        area: LazyArea = self.areas[area_name]
+        idle_rounds = self.compaction_idle_rounds if idle_rounds is None else idle_rounds
+        max_wins = self.compaction_max_wins if max_wins is None else max_wins
+        keep_potentiated = self.compaction_keep_potentiated if keep_potentiated is None else keep_potentiated
+        support_size = area.support_size
+        keep = (area.win_counts[:support_size] > max_wins) | \
+               (area.rounds - area.last_win[:support_size] <= idle_rounds)
+        keep[area.winner_array] = True
+        for connectome in self.incident_connectomes(area_name):
+            if keep_potentiated and connectome.source is area:
+                overlay = connectome.overlay
+                potentiated = (overlay.values != 0) & (overlay.values != 1)
+                keep[overlay.keys[potentiated] // overlay.cols] = True
+        num_evicted = int(support_size - np.count_nonzero(keep))
+        area.compacted_size = support_size - num_evicted
+        if num_evicted == 0:
+            return 0
+        index_map = np.full(support_size, -1, dtype=np.int64)
+        index_map[keep] = np.arange(support_size - num_evicted)
+
+        for connectome in self.incident_connectomes(area_name):
+            connectome.overlay.remap(index_map if connectome.source is area else None,
+                                     index_map if connectome.target is area else None)
+            # evicted synapses may have been potentiated, and all potentiated synapses are in the overlay
+            source, target = connectome.source.name, connectome.target.name
+            self.connectome_stats[(source, target)].recompute(connectome.overlay.values,
+                                                              1.0 + self.areas[target].area_beta[source])
+            self.connectome_changed(source, target)
+        for stim, connectomes in self.stimuli_connectomes.items():
+            if area_name in connectomes:
+                stim_inputs = connectomes[area_name]
+                connectomes[area_name] = stim_inputs[keep[:len(stim_inputs)]]
+                self.connectome_changed(stim, area_name, True)
+
+        area.winners = index_map[area.winner_array]
+        area.support_ids = area.support_ids[:support_size][keep]
+        area.win_counts = area.win_counts[:support_size][keep]
+        area.last_win = area.last_win[:support_size][keep]
+        area.support_size = area._new_support_size = support_size - num_evicted
+        trace('compact', area=area_name, evicted=num_evicted, support_size=area.support_size)
+        for listener in self.compaction_listeners:
+            listener(area_name, index_map)
+        return num_evicted
 
     def project_into(self, area: Area, from_stimuli: List[str], from_areas: List[str]) -> int:
         """Project multiple stimuli and area assemblies into area 'area' at the same time.
@@ -92,27 +293,23 @@ class LazyBrain(Brain):
         # TODO Handle case of projecting from an area without previous winners.
         # TODO: there is a bug when adding a new stimulus later on.
         # TODO: Stimulus is updating to somehow represent >100 neurons.
-        logging.info(f'Projecting {",".join(from_stimuli)} and {",".join(from_areas)} into area.name')
+        trace('project_into', logging.INFO, area=area.name, from_stimuli=','.join(from_stimuli),
+              from_areas=','.join(from_areas))
 
-        def calc_prev_winners_input() -> List[float]:
+        def calc_prev_winners_input() -> ndarray:
             """
-            Creates a list of size support_size
+            Creates an array of size support_size
             prev_winners_input[i] := sum of all incoming weights into neuron #i (0 <= i < support_size),
             which can be coming from both stimuli and areas
-            :return: prev_winner_inputs: List[float]
+            :return: prev_winner_inputs: ndarray
             """
-            # TODO: should't this be ndarray? np.zeros?
-            prev_winner_inputs: List[float] = [0.] * area.support_size
+            prev_winner_inputs: ndarray = np.zeros(area.support_size)
             for stim in from_stimuli:
-                stim_inputs = self.stimuli_connectomes[stim][area.name]
-                for i in range(area.support_size):
-                    prev_winner_inputs[i] += stim_inputs[i]
+                prev_winner_inputs += self.stimuli_connectomes[stim][area.name][:area.support_size]
             for from_area in from_areas:
-                connectome = self.connectomes[from_area][area.name]
-                for w in self.areas[from_area].winners:
-                    for i in range(area.support_size):
-                        prev_winner_inputs[i] += connectome[w][i]
-            logging.debug(f'prev_winner_inputs: {prev_winner_inputs}')
+                connectome = self.connectome(from_area, area.name)
+                prev_winner_inputs += connectome.accumulate(self.areas[from_area].winner_array, area.support_size)
+            trace('prev_winner_inputs', area=area.name, inputs=prev_winner_inputs)
             return prev_winner_inputs
 
         def calculate_input_sizes() -> List[int]:
@@ -123,7 +320,7 @@ class LazyBrain(Brain):
             """
             input_sizes: List[int] = [self.stimuli[stim].k for stim in from_stimuli]
             input_sizes += [self.areas[from_area].k for from_area in from_areas]
-            logging.debug(f'total_k = {sum(input_sizes)} and input_sizes = {input_sizes}')
+            trace('input_sizes', area=area.name, total_k=sum(input_sizes), inputs=len(input_sizes))
             return input_sizes
 
         def calc_potential_new_winners(total_k: int) -> List[float]:
@@ -144,7 +341,7 @@ class LazyBrain(Brain):
             # A.k.a the probability that the number of neurons that aren't going to fire in the area will be lower than
             # p * (number of neurons in the area that never fired)
             alpha = binom.ppf((float(effective_n - area.k) / effective_n), total_k, self.p)
-            logging.debug(f'Alpha = {alpha}')
+            trace('alpha', area=area.name, alpha=alpha)
             # Std(Binomial(n,p)) := Sqrt(n * p * (1-p))
             std = math.sqrt(total_k * self.p * (1.0 - self.p))
             mu = total_k * self.p
@@ -152,13 +349,16 @@ class LazyBrain(Brain):
             b = float(total_k - mu) / std  # note that b>=a and corresponds to the maximum value of Bin(total_k,self.p)
             # potential_new_winners := area.k samples of the normal distribution truncated in the range [a,b] and
             # translated by mu, all divided by std
-            potential_new_winners = truncnorm.rvs(a, b, scale=std, loc=mu, size=area.k)
+            if self.random_source is None:
+                potential_new_winners = truncnorm.rvs(a, b, scale=std, loc=mu, size=area.k)
+            else:
+                potential_new_winners = self.random_source.truncated_normal(a, b, mu, std, area.k)
             for i in range(area.k):
                 potential_new_winners[i] = float(round(potential_new_winners[i]))
-            logging.debug(f'potential_new_winners: {potential_new_winners}')
+            trace('potential_new_winners', area=area.name, inputs=potential_new_winners)
             return potential_new_winners.tolist()
 
-        def calc_new_winners(prev_winner_inputs: List[float], potential_new_winners: List[float]) -> List[float]:
+        def calc_new_winners(prev_winner_inputs: ndarray, potential_new_winners: List[float]) -> List[float]:
             """
             find area.k maximal values in both - these are the new winners.
             find the ones that are winners for the first time.
@@ -170,19 +370,17 @@ class LazyBrain(Brain):
             # take max among prev_winner_inputs, potential_new_winners
             # get num_first_winners (think something small)
             # can generate area._new_winners, note the new indices
-            both = prev_winner_inputs + potential_new_winners
-            new_winner_indices = heapq.nlargest(area.k, list(range(len(both))), both.__getitem__)
-            num_first_winners = 0
-            first_winner_inputs = []
-            for i in range(area.k):
-                if new_winner_indices[i] >= area.support_size:  # winner for the first time
-                    # index in potential_new_winners - a new assembly neuron
-                    first_winner_inputs.append(potential_new_winners[new_winner_indices[i] - area.support_size])
-                    new_winner_indices[i] = area.support_size + num_first_winners
-                    num_first_winners += 1
+            both = np.concatenate((prev_winner_inputs, potential_new_winners))
+            new_winner_indices = area.selector.select(both, area.k)
+            # winners for the first time are indices in potential_new_winners - new assembly neurons
+            first = new_winner_indices >= area.support_size
+            first_winner_inputs = both[new_winner_indices[first]].tolist()
+            num_first_winners = len(first_winner_inputs)
+            new_winner_indices[first] = area.support_size + np.arange(num_first_winners)
             area._new_winners = new_winner_indices  # Note that from here on 'new_winner_indices' is not in use.
             area._new_support_size = area.support_size + num_first_winners
-            logging.debug(f'new_winners: {area._new_winners}')
+            area.record_winners(area._new_winners, num_first_winners)
+            trace('new_winners', area=area.name, winners=area._new_winners, num_first_winners=num_first_winners)
             return first_winner_inputs
 
         def calculate_first_winner_to_inputs(num_first_winners: int, input_sizes: List[int]) -> Dict[int, ndarray]:
@@ -202,7 +400,7 @@ class LazyBrain(Brain):
             for i in range(num_first_winners):
                 # first_winner_inputs[i] - how many fired into first winner # i
                 # we randomize the indices that fired
-                input_indices = random.sample(range(0, total_k), int(first_winner_inputs[i]))
+                input_indices = self.sample(total_k, int(first_winner_inputs[i]))
                 # inputs := a randomized array of the input size from each stimuli / area
                 inputs: ndarray = np.zeros(len(input_sizes))
                 total_so_far = 0
@@ -212,7 +410,8 @@ class LazyBrain(Brain):
                     inputs[j] = sum([(total_so_far <= w < (total_so_far + input_sizes[j])) for w in input_indices])
                     total_so_far += input_sizes[j]
                 first_winner_to_inputs[i] = inputs
-                logging.debug(f'for first_winner #{i} with input {first_winner_inputs[i]} split as so: {inputs}')
+                trace('first_winner_inputs', area=area.name, first_winner=i, total=first_winner_inputs[i],
+                      split=inputs)
             return first_winner_to_inputs
 
         def calculate_new_stim_area_connectomes(num_first_winners: int,
@@ -237,86 +436,48 @@ class LazyBrain(Brain):
                         first_winner_to_inputs[i][input_index]
                 beta = area.stimulus_beta[stim]
                 # connectomes of winners are now stronger
-                for i in area._new_winners:
-                    self.stimuli_connectomes[stim][area.name][i] *= (1 + beta)
-                logging.debug(f'stimulus {stim} now looks like: {self.stimuli_connectomes[stim][area.name]}')
+                self.stimuli_connectomes[stim][area.name][area._new_winners] *= (1 + beta)
+                self.connectome_changed(stim, area.name, True)
+                trace('stimulus_connectome', stimulus=stim, area=area.name,
+                      connectome=self.stimuli_connectomes[stim][area.name])
                 input_index += 1
 
         def calculate_new_from_area_area_connectomes(num_first_winners: int,
                                                      first_winner_to_inputs: Dict[int, ndarray]) -> None:
             """
             connectome for each in_area->area
-            add num_first_winners columns
-            for each i in num_first_winners, fill in (1+beta) for chosen neurons
-            for each i in repeat_winners, for j in in_area.winners, connectome[j][i] *= (1+beta)
+            for each i in num_first_winners, set the synapses from in_area.winners: 1 for the ones chosen to have fired
+                into i, and 0 for the rest (since otherwise, they would have fired into i).
+                Synapses from neurons that are not winners stay implicit, i.e. 1 in prob p.
+            for each i in _new_winners, for j in in_area.winners, connectome[j][i] *= (1+beta)
             :param num_first_winners: number of new neurons that won (these connectomes were not generated yet)
             :param first_winner_to_inputs: a list of the number of inputs from each stimuli / area
             :return: none
             """
             nonlocal input_index
             for from_area in from_areas:
-                from_area_support = self.areas[from_area].support_size
-                from_area_winners = self.areas[from_area].winners
-                # add num_first_winners columns to the connectomes
-                self.connectomes[from_area][area.name] = np.pad(self.connectomes[from_area][area.name],
-                                                                ((0, 0), (0, num_first_winners)),
-                                                                'constant', constant_values=0)
-                for i in range(num_first_winners):
-                    # total_in - how many fired from from_area to this first winner (i)
-                    total_in = first_winner_to_inputs[i][input_index]
-                    # randomize which winners in from_area fired to i
-                    sample_indices = random.sample(from_area_winners, int(total_in))
-                    for j in range(from_area_support):
-                        # j that fired has connectome with weight 1 (in prob 1)
-                        if j in sample_indices:
-                            self.connectomes[from_area][area.name][j][area.support_size + i] = 1
-                        # j that is not winner has connectome weight 1 in prob p
-                        if j not in from_area_winners:
-                            self.connectomes[from_area][area.name][j][area.support_size + i] = \
-                                np.random.binomial(1, self.p)
-                        # j that is a winner and did not fire has connectome 0 (since otherwise, it would fire)
+                connectome = self.connectome(from_area, area.name)
+                from_area_winners = self.areas[from_area].winner_array
+                if num_first_winners > 0 and len(from_area_winners) > 0:
+                    fired = np.zeros((len(from_area_winners), num_first_winners))
+                    for i in range(num_first_winners):
+                        # total_in - how many fired from from_area to this first winner (i)
+                        total_in = first_winner_to_inputs[i][input_index]
+                        # randomize which winners in from_area fired to i
+                        fired[self.sample(len(from_area_winners), int(total_in)), i] = 1
+                    connectome.set_block(from_area_winners,
+                                         range(area.support_size, area.support_size + num_first_winners), fired)
 
                 beta = area.area_beta[from_area]
+                self.connectome_stats[(from_area, area.name)].update(
+                    connectome.block(from_area_winners, area._new_winners), 1.0 + beta)
                 # connectomes of winners are now stronger
-                for i in area._new_winners:
-                    for j in from_area_winners:
-                        self.connectomes[from_area][area.name][j][i] *= (1.0 + beta)
-                logging.debug(f'Connectome of {from_area} to {area.name} is now '
-                              f'{self.connectomes[from_area][area.name]}')
+                connectome.scale_block(from_area_winners, area._new_winners, 1.0 + beta)
+                self.connectome_changed(from_area, area.name, rows=from_area_winners)
+                trace('area_connectome', from_area=from_area, area=area.name, connectome=connectome)
                 input_index += 1
 
-        def calculate_new_all_area_area_connectomes(num_first_winners: int) -> None:
-            """
-            expand connectomes from other areas that did not fire into area
-            also expand connectome for area->other_area
-            :param num_first_winners: number of new neurons that won (these connectomes were not generated yet)
-            :return: none
-            """
-            for other_area in self.areas:
-                # expand the other_area->area connectomes for areas that did not fire
-                if other_area not in from_areas:
-                    # add num_first_winners columns to self.connectomes[other_area][name]
-                    self.connectomes[other_area][area.name] = np.pad(self.connectomes[other_area][area.name],
-                                                                     ((0, 0), (0, num_first_winners)), 'constant',
-                                                                     constant_values=0)
-                    for j in range(self.areas[other_area].support_size):
-                        for i in range(area.support_size, area._new_support_size):
-                            # for all new neurons in support, add connectome from other_area with weight 1 in prob p
-                            self.connectomes[other_area][area.name][j][i] = np.random.binomial(1, self.p)
-
-                # expand the area->other_area connectomes for all areas
-                # for all new neurons in support, add connectomes to other areas with weight 1 in prob p
-                self.connectomes[area.name][other_area] = np.pad(self.connectomes[area.name][other_area],
-                                                                 ((0, num_first_winners), (0, 0)), 'constant',
-                                                                 constant_values=0)
-                columns = len(self.connectomes[area.name][other_area][0])
-                for i in range(area.support_size, area._new_support_size):
-                    for j in range(columns):
-                        self.connectomes[area.name][other_area][i][j] = np.random.binomial(1, self.p)
-                logging.debug(f'Connectome of {area.name} to {other_area} is now: '
-                              f'{self.connectomes[area.name][other_area]}')
-
-        prev_winner_inputs: List[float] = calc_prev_winners_input()
+        prev_winner_inputs: ndarray = calc_prev_winners_input()
         input_sizes = calculate_input_sizes()
         total_k = sum(input_sizes)
         potential_new_winners = calc_potential_new_winners(total_k)
@@ -326,6 +487,6 @@ class LazyBrain(Brain):
         input_index = 0
         calculate_new_stim_area_connectomes(num_first_winners, first_winner_to_inputs)
         calculate_new_from_area_area_connectomes(num_first_winners, first_winner_to_inputs)
-        calculate_new_all_area_area_connectomes(num_first_winners)
+        # The connectomes of the first winners to and from all other areas are implicit, so they need no expansion.
 
         return num_first_winners
@@ -0,0 +1,152 @@
+""" A LazyBrain for brains with hundreds of areas, wired by an explicit sparse area graph.
+
+LazyBrain connects every area to every other area: adding the A-th area creates 2A connectomes and plasticity
+parameters, so a brain with hundreds of areas holds O(A^2) connectome objects, most of which are never projected
+along. ManyAreaBrain instead keeps an explicit wiring graph. Areas and stimuli are added unconnected, in O(1), and
+'connect' declares the area to area edges that exist. Connectomes are kept in a flat dictionary keyed by
+(from_area, to_area) tuples, holding only the declared edges, and all per-round work (projection and compaction)
+only touches the edges incident to the areas involved.
+
+Stimulus connectomes of LazyBrain are a single count per support neuron, so they are created the first time a
+stimulus is projected into an area, without having to be declared.
+"""
+from typing import Dict, Iterator, List, Mapping, Optional, Set, Tuple
+import numpy as np
+from brain import Stimulus
+from implicit_connectome import ImplicitConnectome
+from lazy_brain import LazyBrain, LazyArea
+
+
+class OutgoingConnectomes(Mapping):
+    """ Read only view of the connectomes out of a single area of a ManyAreaBrain, keyed by target area. """
+
+    def __init__(self, brain: 'ManyAreaBrain', from_area: str):
+        self.brain = brain
+        self.from_area = from_area
+
+    def __getitem__(self, to_area: str) -> ImplicitConnectome:
+        return self.brain.edge_connectomes[(self.from_area, to_area)]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.brain.outputs[self.from_area])
+
+    def __len__(self) -> int:
+        return len(self.brain.outputs[self.from_area])
+
+
+class WiredConnectomes(Mapping):
+    """ Read only view of the connectomes of a ManyAreaBrain in the nested layout of Brain.connectomes,
+    i.e. connectomes[from_area][to_area]. Only declared edges appear in it.
+    """
+
+    def __init__(self, brain: 'ManyAreaBrain'):
+        self.brain = brain
+
+    def __getitem__(self, from_area: str) -> OutgoingConnectomes:
+        if from_area not in self.brain.outputs:
+            raise KeyError(from_area)
+        return OutgoingConnectomes(self.brain, from_area)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.brain.outputs)
+
+    def __len__(self) -> int:
+        return len(self.brain.outputs)
+
+
+class ManyAreaBrain(LazyBrain):
+    """ A LazyBrain in which areas are only connected along explicitly declared edges.
+
+    Projecting along an edge that was not declared with 'connect' raises an IndexError, unless 'auto_wire' is set,
+    in which case the edge is declared on its first use.
+
+    Attributes:
+        auto_wire: Whether projecting along an undeclared edge declares it
+        edge_connectomes: The connectome of every declared edge, keyed by (from_area, to_area)
+        outputs: For every area, the set of areas it is connected into
+        inputs: For every area, the set of areas connected into it
+        connectomes: Nested read only view of edge_connectomes (see WiredConnectomes)
+    """
+
+    def __init__(self, p: float, seed: Optional[int] = None, auto_wire: bool = False, **kwargs):
+        super().__init__(p, seed, **kwargs)
+        self.auto_wire: bool = auto_wire
+        self.edge_connectomes: Dict[Tuple[str, str], ImplicitConnectome] = {}
+        self.outputs: Dict[str, Set[str]] = {}
+        self.inputs: Dict[str, Set[str]] = {}
+        self.connectomes = WiredConnectomes(self)
+
+    def add_stimulus(self, name: str, k: int) -> None:
+        """ Add a stimulus with 'k' neurons firing, not yet connected to any area.
+
+        :param name: Name used to refer to stimulus
+        :param k: Number of neurons in the stimulus
+        """
+        self.stimuli[name] = Stimulus(k)
+        self.stimuli_connectomes[name] = {}
+
+    def add_area(self, name: str, n: int, k: int, beta: float) -> None:
+        """ Add an area, not yet connected to any other area.
+
+        :param name: Name of area
+        :param n: Number of neurons in the new area
+        :param k: Number of winners in the new area
+        :param beta: plasticity parameter of connectomes coming INTO this area.
+        """
+        self.areas[name] = LazyArea(name, n, k, beta)
+        self.outputs[name] = set()
+        self.inputs[name] = set()
+
+    def connect(self, from_area: str, to_area: str, beta: Optional[float] = None) -> None:
+        """ Declare the edge from area 'from_area' into area 'to_area'. Declaring an existing edge does nothing.
+
+        :param from_area: Name of the source area
+        :param to_area: Name of the target area (may be the same area)
+        :param beta: plasticity parameter of the edge. Defaults to the beta of 'to_area'.
+        """
+        for name in (from_area, to_area):
+            if name not in self.areas:
+                raise IndexError(name + " not in brain.areas")
+        if (from_area, to_area) in self.edge_connectomes:
+            return
+        self.edge_connectomes[(from_area, to_area)] = self.new_connectome(from_area, to_area)
+        self.outputs[from_area].add(to_area)
+        self.inputs[to_area].add(from_area)
+        target = self.areas[to_area]
+        target.area_beta[from_area] = target.beta if beta is None else beta
+
+    def connect_stimulus(self, stim: str, area: str, beta: Optional[float] = None) -> None:
+        """ Connect stimulus 'stim' into area 'area'. This happens automatically on the first projection.
+
+        :param beta: plasticity parameter of the connection. Defaults to the beta of 'area'.
+        """
+        if area in self.stimuli_connectomes[stim]:
+            return
+        self.stimuli_connectomes[stim][area] = np.empty(0)
+        self.areas[area].stimulus_beta[stim] = self.areas[area].beta if beta is None else beta
+
+    def connectome(self, from_area: str, to_area: str) -> ImplicitConnectome:
+        return self.edge_connectomes[(from_area, to_area)]
+
+    def incident_connectomes(self, area_name: str) -> Iterator[ImplicitConnectome]:
+        for to_area in self.outputs[area_name]:
+            yield self.edge_connectomes[(area_name, to_area)]
+        for from_area in self.inputs[area_name]:
+            if from_area != area_name:
+                yield self.edge_connectomes[(from_area, area_name)]
+
+    def project(self, stim_to_area: Mapping[str, List[str]],
+                area_to_area: Mapping[str, List[str]]) -> None:
+        """ Brain.project, restricted to declared edges. See Brain.project for the parameters. """
+        for stim, areas in stim_to_area.items():
+            for area in areas:
+                if stim in self.stimuli and area in self.areas:
+                    self.connect_stimulus(stim, area)
+        for from_area, to_areas in area_to_area.items():
+            for to_area in to_areas:
+                if from_area in self.areas and to_area in self.areas \
+                        and (from_area, to_area) not in self.edge_connectomes:
+                    if not self.auto_wire:
+                        raise IndexError(f'{from_area} is not connected into {to_area}')
+                    self.connect(from_area, to_area)
+        super().project(stim_to_area, area_to_area)
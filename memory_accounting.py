@@ -0,0 +1,157 @@
+""" Accounting of the memory used by a brain, estimates of it ahead of time, and memory budgets.
+
+How much memory a brain needs is hard to predict: a NonLazyBrain holds an n x m matrix for every pair of areas that
+ever project into each other, and the support of a LazyBrain area (with the explicit weights of its synapses) grows
+with every new winner. 'memory_report' breaks down the bytes a brain currently holds, and 'estimate_memory' predicts
+them from the sizes of the areas and the wiring, before anything is allocated. Both return a MemoryReport.
+
+A brain with a 'memory_budget' checks it before generating a connectome and at the end of every round. When the budget
+is exceeded, it either raises a MemoryBudgetExceeded error right away, or (with memory_policy='reclaim') first tries
+to free memory, e.g. by compacting the supports of lazy areas (see Brain.reclaim_memory), and raises only if that did
+not help. Either way the run stops with a clear error instead of being killed by the operating system.
+"""
+from typing import Dict, Iterable, Mapping, Optional, Tuple
+import sys
+import numpy as np
+from connectome_storage import estimate_connectome_nbytes
+
+MEMORY_POLICIES = ('raise', 'reclaim')
+
+# Bytes of an explicitly stored weight of a lazy connectome: an int64 key and a float32 value (see SparseOverlay).
+OVERLAY_ENTRY_NBYTES = 12
+
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+
+def nbytes(value) -> int:
+    """ The memory held by an array, connectome object or list. For lists, only the list itself is counted. """
+    if value is None:
+        return 0
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value)
+    return 0
+
+
+class MemoryReport:
+    """ Bytes used by the parts of a brain.
+
+    Attributes:
+        connectomes: Bytes of every connectome between areas, keyed by (from_area, to_area)
+        stimulus_connectomes: Bytes of every connectome from a stimulus, keyed by (stimulus, area)
+        support: Bytes of the support structures of every area (which neurons are explicit)
+        winner_history: Bytes of the winners and win statistics kept for every area
+    """
+
+    def __init__(self):
+        self.connectomes: Dict[Tuple[str, str], int] = {}
+        self.stimulus_connectomes: Dict[Tuple[str, str], int] = {}
+        self.support: Dict[str, int] = {}
+        self.winner_history: Dict[str, int] = {}
+
+    @property
+    def totals(self) -> Dict[str, int]:
+        return {'connectomes': sum(self.connectomes.values()),
+                'stimulus_connectomes': sum(self.stimulus_connectomes.values()),
+                'support': sum(self.support.values()),
+                'winner_history': sum(self.winner_history.values())}
+
+    @property
+    def total(self) -> int:
+        return sum(self.totals.values())
+
+    def __str__(self) -> str:
+        lines = [f'{"total":<24}{self.total:>16,}']
+        lines += [f'  {name:<22}{value:>16,}' for name, value in self.totals.items()]
+        largest = sorted(self.connectomes.items(), key=lambda item: -item[1])[:5]
+        lines += [f'    {source + "->" + target:<20}{value:>16,}' for (source, target), value in largest]
+        return '\n'.join(lines)
+
+
+def memory_report(brain) -> MemoryReport:
+    """ The memory currently held by 'brain'. Connectomes that were never generated are not counted. """
+    report = MemoryReport()
+    for source, connectomes in brain.connectomes.items():
+        for target, connectome in connectomes.items():
+            report.connectomes[(source, target)] = nbytes(connectome)
+    for stim, connectomes in brain.stimuli_connectomes.items():
+        for target, connectome in connectomes.items():
+            report.stimulus_connectomes[(stim, target)] = nbytes(connectome)
+    for name, area in brain.areas.items():
+        report.support[name] = nbytes(area.support) + nbytes(getattr(area, 'support_ids', None))
+        report.winner_history[name] = nbytes(getattr(area, '_winner_buffers', None)) + \
+            nbytes(getattr(area, 'win_counts', None)) + nbytes(getattr(area, 'last_win', None))
+    return report
+
+
+def estimate_connectome_memory(storage: str, shape: Tuple[int, int], p: float, rounds: Optional[int] = None,
+                               k: Optional[int] = None) -> int:
+    """ Expected bytes of a single connectome.
+
+    :param storage: 'lazy', 'dense' or one of connectome_storage.CONNECTOME_STORAGES
+    :param shape: Shape of the connectome (all neurons of both sides, even for lazy connectomes)
+    :param p: Probability of each synapse
+    :param rounds: For 'lazy', the number of rounds projecting along the connectome
+    :param k: For 'lazy', the number of winners of the target area
+    """
+    if storage != 'lazy':
+        return estimate_connectome_nbytes(storage, shape, p)
+    if rounds is None or k is None:
+        raise ValueError('Estimating a lazy connectome requires the number of rounds and winners')
+    # every round sets the block between the source winners and the new winners, and potentiates it: at most k x k
+    # new explicit entries, and no more than the whole matrix
+    return min(rounds * k * k, shape[0] * shape[1]) * OVERLAY_ENTRY_NBYTES
+
+
+def estimate_memory(p: float, areas: Mapping[str, Tuple[int, int]], stimuli: Optional[Mapping[str, int]] = None,
+                    wiring: Optional[Iterable[Tuple[str, str]]] = None, storage: str = 'dense',
+                    rounds: Optional[int] = None) -> MemoryReport:
+    """ Predict the memory of a brain before creating it.
+
+    :param p: Probability of each synapse
+    :param areas: The (n, k) of every area, by name
+    :param stimuli: The k of every stimulus, by name. Stimuli are assumed to project into every area.
+    :param wiring: The (from_area, to_area) pairs that will be projected along. By default, all pairs of areas.
+    :param storage: How connectomes are stored: 'lazy' (LazyBrain), 'dense' or a compact storage (NonLazyBrain)
+    :param rounds: For 'lazy', the number of rounds of the run. Supports are estimated to grow by at most k
+        neurons per round, i.e. to min(n, k * (rounds + 1)).
+    :return: The predicted MemoryReport
+    """
+    lazy = storage == 'lazy'
+    if lazy and rounds is None:
+        raise ValueError('Estimating a lazy brain requires the number of rounds')
+    stimuli = {} if stimuli is None else stimuli
+    wiring = [(source, target) for source in areas for target in areas] if wiring is None else list(wiring)
+    report = MemoryReport()
+    for name, (n, k) in areas.items():
+        # the support is a bool per neuron, the winners two buffers of k int32 (see brain.Area)
+        winner_buffers_nbytes = 2 * k * np.dtype(np.int32).itemsize
+        if lazy:
+            explicit = min(n, k * (rounds + 1))
+            report.support[name] = n + explicit * np.dtype(np.int64).itemsize
+            report.winner_history[name] = winner_buffers_nbytes + explicit * (np.dtype(np.int64).itemsize * 2)
+        else:
+            report.support[name] = n
+            report.winner_history[name] = winner_buffers_nbytes
+    for source, target in wiring:
+        shape = (areas[source][0], areas[target][0])
+        report.connectomes[(source, target)] = estimate_connectome_memory(storage, shape, p, rounds, areas[target][1])
+    for stim, stim_k in stimuli.items():
+        for target, (n, k) in areas.items():
+            if lazy:
+                explicit = min(n, k * (rounds + 1))
+                report.stimulus_connectomes[(stim, target)] = explicit * np.dtype(np.float64).itemsize
+            else:
+                report.stimulus_connectomes[(stim, target)] = estimate_connectome_memory(storage, (stim_k, n), p)
+    return report
+
+
+def format_nbytes(value: int) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(value) < 1024:
+            return f'{value:.1f} {unit}' if unit != 'B' else f'{value} B'
+        value /= 1024
+    return f'{value:.1f} TiB'
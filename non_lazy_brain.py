@@ -1,22 +1,124 @@
 from brain import Brain, Stimulus, Area
-import logging
-from typing import List, Dict
+from typing import Any, Dict, List, Tuple, Optional
 import numpy as np
-import heapq
 from numpy.core._multiarray_umath import ndarray
+from connectome_storage import CONNECTOME_STORAGES, Connectome, accumulate, potentiate, block, edge_seed_sequence, \
+    dense_random, estimate_connectome_nbytes
+from connectome_cache import ConnectomeCache
+from connectome_pool import ConnectomePool
+from tracing import trace
+
+
+class LazyConnectomes(dict):
+    """ The outgoing connectomes of a single area or stimulus, keyed by the name of the target area.
+
+    A connectome is only generated the first time it is looked up (usually by the first projection that activates it),
+    so that adding areas and stimuli costs nothing and memory is only spent on the connectomes that are used.
+    Iterating over this mapping only yields the connectomes generated so far. If the brain has a connectome cache,
+    every lookup goes through it, and iterating may yield SpilledConnectome placeholders.
+
+    Attributes:
+        brain: The brain the connectomes belong to
+        source: Name of the area or stimulus the connectomes go out of
+        from_stimulus: Whether 'source' is a stimulus
+    """
+
+    def __init__(self, brain: 'NonLazyBrain', source: str, from_stimulus: bool = False):
+        super().__init__()
+        self.brain = brain
+        self.source = source
+        self.from_stimulus = from_stimulus
+
+    def __getitem__(self, target: str) -> Connectome:
+        connectome = super().__getitem__(target)
+        cache = self.brain.connectome_cache
+        if cache is None:
+            return connectome
+        return cache.lookup(self, (self.source, target, self.from_stimulus), connectome)
+
+    def __missing__(self, target: str) -> Connectome:
+        if target not in self.brain.areas:
+            raise KeyError(target)
+        connectome = self.brain.create_connectome(self.source, target, self.from_stimulus)
+        self[target] = connectome
+        return connectome
 
 
 class NonLazyBrain(Brain):
     """ Represents a simulated brain, with it's different areas, stimuli, and all the synapse weights.
-        The connectomes are fully generated when adding a stimulus / area.
+        Every connectome is fully generated, when it is first used.
+
+    Attributes:
+        storage: How connectomes are stored. 'dense' (the default) stores every connectome as a float32 ndarray.
+            The compact modes of connectome_storage ('bitpacked', 'csr') store the random 0/1 base compactly and only
+            the weights of potentiated synapses as floats.
+        init_threads: Number of threads generating a random connectome (connectome_storage.INIT_THREADS if None).
+            The generated connectomes do not depend on it.
+        connectome_cache: If set, keeps the dense connectomes within a memory budget by spilling the least recently
+            used ones to disk (see connectome_cache.ConnectomeCache).
+        connectome_pool: If set, dense connectomes are mapped copy-on-write from this pool of pre-generated ones
+            instead of being generated (see connectome_pool.ConnectomePool).
+        connectome_provenance: The provenance record of every connectome mapped from the pool, keyed by
+            (source, target, from_stimulus)
     """
 
+    def __init__(self, p: float, storage: str = 'dense', seed: Optional[int] = None,
+                 init_threads: Optional[int] = None):
+        super().__init__(p, seed)
+        if storage != 'dense' and storage not in CONNECTOME_STORAGES:
+            raise ValueError(f'Unknown connectome storage {storage}. '
+                             f'Expected one of: dense, {", ".join(CONNECTOME_STORAGES)}')
+        self.storage: str = storage
+        self.init_threads: Optional[int] = init_threads
+        self.connectome_cache: Optional[ConnectomeCache] = None
+        self.connectome_pool: Optional[ConnectomePool] = None
+        self.connectome_provenance: Dict[Tuple[str, str, bool], Dict[str, Any]] = {}
+
+    def random_connectome(self, shape: Tuple[int, int], seed_sequence: np.random.SeedSequence) -> Connectome:
+        """ Generate a random connectome of the given shape in this brain's storage mode.
+        Every synapse exists (has weight 1) with probability p.
+        """
+        if self.storage == 'dense':
+            if self.connectome_pool is not None:
+                return self.connectome_pool.base(shape, self.p, seed_sequence, self.init_threads)
+            return dense_random(shape, self.p, seed_sequence, self.init_threads)
+        return CONNECTOME_STORAGES[self.storage].random(shape, self.p, seed_sequence, self.init_threads)
+
+    def create_connectome(self, source: str, target: str, from_stimulus: bool = False) -> Connectome:
+        """ Generate the random connectome from area (or stimulus) 'source' into area 'target'.
+
+        The connectome is drawn from its own random stream, derived from the brain's seed and the names of its
+        endpoints, so it is the same regardless of when it is generated.
+
+        :raises MemoryBudgetExceeded: if the connectome does not fit the memory budget of the brain
+        """
+        if from_stimulus:
+            shape = (self.stimuli[source].k, self.areas[target].n)
+            seed_sequence = edge_seed_sequence(self.seed, 'stimulus', source, target)
+        else:
+            shape = (self.areas[source].n, self.areas[target].n)
+            seed_sequence = edge_seed_sequence(self.seed, 'area', source, target)
+        self.check_memory_budget(estimate_connectome_nbytes(self.storage, shape, self.p))
+        connectome = self.random_connectome(shape, seed_sequence)
+        if self.connectome_pool is not None and self.storage == 'dense':
+            self.connectome_provenance[(source, target, from_stimulus)] = \
+                self.connectome_pool.provenance(shape, self.p, seed_sequence)
+        return connectome
+
+    def reclaim_memory(self) -> int:
+        """ Spill all the dense connectomes to disk, if there is a connectome cache.
+        :return: The number of bytes spilled
+        """
+        if self.connectome_cache is None:
+            return 0
+        return self.connectome_cache.evict(self, 0)
+
     def add_stimulus(self, name: str, k: int) -> None:
         """ Initialize a random stimulus with 'k' neurons firing.
         This stimulus can later be applied to different areas of the brain,
         also updating its outgoing connectomes in the process.
 
-        Connectomes to all areas is initialized as an empty numpy array.
+        Connectomes to all areas are generated when first used.
         For every target area, which are all existing areas, set the plasticity coefficient,
         beta, to equal that area's beta.
 
@@ -30,7 +132,7 @@ class NonLazyBrain(Brain):
         """Add an area to this brain, randomly connected to all other areas and stimulus.
 
         Initialize each synapse weight to have a value of 0 or 1 with probability 'p'.
-        Initialize incoming and outgoing connectomes as empty arrays.
+        Incoming and outgoing connectomes are generated when first used.
         Initialize incoming betas as 'beta'.
         Initialize outgoing betas as the target area.beta
 
@@ -45,63 +147,47 @@ class NonLazyBrain(Brain):
         self.connectomes_init_area(self.areas[name], beta)
 
     def connectomes_init_area(self, area: Area, beta: float):
-        # TODO: Add docs.
-        #       Perhaps numpy.random.Generator.integers is faster.
-        # self.connectomes: Dict[str, Dict[str, ndarray]] = {}
-        # self.connectomes[area.name][other_area] = neurons: ndarray (of size (area.n, other_area.n))
-        # ndarray[i][j] = weight of connectome from neuron i (in area) to neuron j (in other area)
+        """ Set up the connectomes of a newly added area and the plasticity parameters of its synapses.
+
+        self.connectomes[area.name][other_area] is the ndarray of size (area.n, other_area.n), in which
+        ndarray[i][j] = weight of connectome from neuron i (in area) to neuron j (in other area).
+        The connectomes themselves are generated lazily, see LazyConnectomes.
+        """
         name = area.name
-        for stim_name, stim_connectomes in self.stimuli_connectomes.items():
-            stimulus: Stimulus = self.stimuli[stim_name]
-            stim_connectomes[name] = np.random.binomial(1, self.p, (stimulus.k, area.n)).astype(dtype='f')
-            self.areas[name].stimulus_beta[stim_name] = beta
+        for stim_name in self.stimuli:
+            area.stimulus_beta[stim_name] = beta
 
-        new_connectomes: Dict[str, ndarray] = {}
         for other_area_name, other_area in self.areas.items():
-            new_connectomes[other_area_name] = np.random.binomial(1, self.p, (area.n, other_area.n)).astype(dtype='f')
-            if other_area is not area:
-                self.connectomes[other_area_name][name] = np.random.binomial(1, self.p, (other_area.n, area.n)).astype(
-                    dtype='f')
             other_area.area_beta[name] = other_area.beta
             area.area_beta[other_area_name] = beta
-        self.connectomes[name] = new_connectomes
+        self.connectomes[name] = LazyConnectomes(self, name)
 
     def connectomes_init_stimulus(self, stimulus: Stimulus, name: str):
-        # self.stimuli_connectomes: Dict[str, Dict[str, ndarray]] = {}
-        # self.connectomes[self.stimuli[name]][other_area] = neurons: ndarray (of size (stimuli.k, other_area.n))
-        # ndarray[i][j] = weight of connectome from neuron i (in stimulus) to neuron j (in other area)
-        new_connectomes: Dict[str, ndarray] = {}
-        for area_name, area in self.areas.items():
-            new_connectomes[area_name] = np.random.binomial(1, self.p, (stimulus.k, area.n)).astype(dtype='f')
-            self.areas[area_name].stimulus_beta[name] = self.areas[area_name].beta
-        self.stimuli_connectomes[name] = new_connectomes
-
-    def project_into_calculate_inputs(self, area: Area, from_stimuli: List[str], from_areas: List[str]) -> List[float]:
+        """ Set up the connectomes of a newly added stimulus and the plasticity parameters of its synapses.
+
+        self.stimuli_connectomes[name][area] is the ndarray of size (stimulus.k, area.n), in which
+        ndarray[i][j] = weight of connectome from neuron i (in stimulus) to neuron j (in area).
+        The connectomes themselves are generated lazily, see LazyConnectomes.
+        """
+        for area in self.areas.values():
+            area.stimulus_beta[name] = area.beta
+        self.stimuli_connectomes[name] = LazyConnectomes(self, name, from_stimulus=True)
+
+    def project_into_calculate_inputs(self, area: Area, from_stimuli: List[str], from_areas: List[str]) -> ndarray:
         """ Calculates the total input for each neuron from other given areas' winners and given stimuli.
         Said total inputs list is saved in prev_winner_inputs
         The parameters are the same as the project_into method parameters.
         """
-        # TODO: wrong type - pay attention to pycharm's notifications
-        prev_winner_inputs: List[float] = np.zeros(area.n)
-
-        if from_areas:
-            for from_area in from_areas:
-                area_connectomes = self.connectomes[from_area][area.name]
-                for winner in self.areas[from_area].winners:
-                    prev_winner_inputs += area_connectomes[winner]
-
-        if from_stimuli:
-            prev_winner_inputs += sum([
-                np.dot(
-                    np.ones(
-                        self.stimuli[stim].k
-                    ),
-                    self.stimuli_connectomes[stim][area.name]
-                )
-                for stim in from_stimuli
-            ])
-
-        logging.debug(f'prev_winner_inputs: {prev_winner_inputs}')
+        prev_winner_inputs: ndarray = np.zeros(area.n)
+
+        for from_area in from_areas:
+            prev_winner_inputs += accumulate(self.connectomes[from_area][area.name], self.areas[from_area].winner_array)
+
+        # all the neurons of a stimulus fire
+        for stim in from_stimuli:
+            prev_winner_inputs += accumulate(self.stimuli_connectomes[stim][area.name])
+
+        trace('prev_winner_inputs', area=area.name, inputs=prev_winner_inputs)
         return prev_winner_inputs
 
     @staticmethod
@@ -111,14 +197,19 @@ class NonLazyBrain(Brain):
         update area._new_winners, area.support and area._new_support_size
         :return: number of winners that weren't in area.support before
         """
-        area._new_winners = heapq.nlargest(area.k, list(range(len(inputs))), inputs.__getitem__)
-        num_first_winners: int = 0
-        for winner in area._new_winners:
-            if not area.support[winner]:
-                num_first_winners += 1
-            area.support[winner] = 1
+        return NonLazyBrain.project_into_record_winners(area, area.selector.select(inputs, area.k))
+
+    @staticmethod
+    def project_into_record_winners(area: Area, new_winners: ndarray) -> int:
+        """
+        set area._new_winners to new_winners, and update area.support and area._new_support_size accordingly
+        :return: number of winners that weren't in area.support before
+        """
+        area._new_winners = new_winners
+        num_first_winners = int(np.count_nonzero(~area.support[area._new_winners]))
+        area.support[area._new_winners] = True
         area._new_support_size = num_first_winners + area.support_size
-        logging.debug(f'new_winners: {area._new_winners}')
+        trace('new_winners', area=area.name, winners=area._new_winners, num_first_winners=num_first_winners)
         return num_first_winners
 
     def project_into_update_connectomes(self, area: Area, from_stimuli: List[str], from_areas: List[str]) -> None:
@@ -126,21 +217,28 @@ class NonLazyBrain(Brain):
         # for i in new_winners, stimulus_inputs[i] *= (1+beta)
         for stim in from_stimuli:
             beta = area.stimulus_beta[stim]
-            for i in area._new_winners:
-                for j in range(self.stimuli[stim].k):
-                    self.stimuli_connectomes[stim][area.name][j][i] *= (1 + beta)
-            logging.debug(f'stimulus {stim} now looks like: {self.stimuli_connectomes[stim][area.name]}')
+            connectome = self.stimuli_connectomes[stim][area.name]
+            stimulus_neurons = range(self.stimuli[stim].k)
+            self.stimulus_connectome_stats[(stim, area.name)].update(
+                block(connectome, stimulus_neurons, area._new_winners), 1 + beta)
+            potentiate(connectome, stimulus_neurons, area._new_winners, 1 + beta)
+            self.connectome_changed(stim, area.name, True, stimulus_neurons)
+            trace('stimulus_connectome', stimulus=stim, area=area.name,
+                  connectome=self.stimuli_connectomes[stim][area.name])
 
         # connectome for each in_area->area
         # for each i in _new_winners, for j in in_area.winners, connectome[j][i] *= (1+beta)
         for from_area in from_areas:
             from_area_winners = self.areas[from_area]._new_winners
             beta = area.area_beta[from_area]
+            connectome = self.connectomes[from_area][area.name]
+            self.connectome_stats[(from_area, area.name)].update(
+                block(connectome, from_area_winners, area._new_winners), 1 + beta)
             # connectomes of winners are now stronger
-            for i in area._new_winners:
-                for j in from_area_winners:
-                    self.connectomes[from_area][area.name][j][i] *= (1 + beta)
-            logging.debug(f'Connectome of {from_area} to {area.name} is now {self.connectomes[from_area][area.name]}')
+            potentiate(connectome, from_area_winners, area._new_winners, 1 + beta)
+            self.connectome_changed(from_area, area.name, rows=from_area_winners)
+            trace('area_connectome', from_area=from_area, area=area.name,
+                  connectome=self.connectomes[from_area][area.name])
 
     def project_into(self, area: Area, from_stimuli: List[str], from_areas: List[str]) -> int:
         """Project multiple stimuli and area assemblies into area 'area' at the same time.
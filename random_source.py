@@ -0,0 +1,111 @@
+""" Deterministic random draws for LazyBrain projections, optionally prefetched on a background thread.
+
+Every LazyBrain round draws truncated normal inputs for the potential new winners of every area it projects into, and
+samples which inputs fired into each first winner. By default these come from the global random generators (numpy's
+and Python's). A RandomSource draws them from a stream of its own instead, derived from the seed of the brain, so the
+run is reproducible. All the draws are transformations of uniform samples of that stream: the truncated normal
+samples by the inverse CDF, and random subsets by ordering uniform keys. The parameters of the transformations are
+only known during the round (they depend on the support sizes and the first winners), but the uniform samples are not.
+
+With prefetch=True, a background thread fills a queue of chunks of uniform samples ahead of the rounds, so generating
+them is off the critical path of the projection. A chunk is consumed in the same order either way, and drawing n
+doubles from a numpy Generator consumes exactly n steps of its bit generator, so the draws (and the whole run) are
+bit-identical with and without prefetching, whatever the chunk size.
+"""
+import queue
+import threading
+import weakref
+import numpy as np
+from numpy import ndarray
+from scipy.stats import truncnorm
+
+# Number of uniform samples per chunk, by default
+CHUNK_SIZE = 1 << 16
+
+
+def _produce(rng: np.random.Generator, chunks: queue.Queue, stop: threading.Event, chunk_size: int) -> None:
+    """ Fill 'chunks' with uniform samples until 'stop' is set. Takes no reference to the RandomSource, so that it
+    can be collected (which stops this thread).
+    """
+    while not stop.is_set():
+        chunk = rng.random(chunk_size)
+        while not stop.is_set():
+            try:
+                chunks.put(chunk, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+
+class RandomSource:
+    """ A stream of uniform samples and the draws LazyBrain makes from it.
+
+    Attributes:
+        seed_sequence: The seed sequence of the stream
+        prefetch: Whether chunks of samples are generated ahead on a background thread
+        chunk_size: Number of samples per chunk
+        depth: Number of chunks generated ahead, when prefetching
+        consumed: Number of samples drawn so far
+    """
+
+    def __init__(self, seed_sequence: np.random.SeedSequence, prefetch: bool = False, chunk_size: int = CHUNK_SIZE,
+                 depth: int = 2, consumed: int = 0):
+        self.seed_sequence = seed_sequence
+        self.prefetch = prefetch
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.consumed = consumed
+        rng = np.random.default_rng(seed_sequence)
+        rng.bit_generator.advance(consumed)
+        self._rng = rng
+        self._buffer: ndarray = np.empty(0)
+        self._position = 0
+        if prefetch:
+            self._chunks: queue.Queue = queue.Queue(maxsize=depth)
+            stop = threading.Event()
+            threading.Thread(target=_produce, args=(rng, self._chunks, stop, chunk_size), daemon=True).start()
+            self._stop = weakref.finalize(self, stop.set)
+
+    def _next_chunk(self) -> ndarray:
+        return self._chunks.get() if self.prefetch else self._rng.random(self.chunk_size)
+
+    def uniforms(self, count: int) -> ndarray:
+        """ The next 'count' uniform samples in [0, 1). """
+        parts = []
+        while count > 0:
+            if self._position == len(self._buffer):
+                self._buffer, self._position = self._next_chunk(), 0
+            taken = min(count, len(self._buffer) - self._position)
+            parts.append(self._buffer[self._position:self._position + taken])
+            self._position += taken
+            self.consumed += taken
+            count -= taken
+        return np.concatenate(parts) if parts else np.empty(0)
+
+    def truncated_normal(self, a: float, b: float, loc: float, scale: float, size: int) -> ndarray:
+        """ Samples of a normal distribution truncated to [a, b] (in standard deviations), like scipy's truncnorm. """
+        return truncnorm.ppf(self.uniforms(size), a, b, loc=loc, scale=scale)
+
+    def sample(self, population: int, count: int) -> ndarray:
+        """ 'count' distinct indices out of range(population), chosen uniformly at random.
+
+        They are the indices of the 'count' smallest of 'population' uniform keys, by increasing key. Only those are
+        sorted (after a linear time partition), but all the keys are drawn, so every call consumes 'population'
+        samples of the stream whatever 'count' is.
+        """
+        keys = self.uniforms(population)
+        if count >= population:
+            return np.argsort(keys, kind='stable')
+        if count <= 0:
+            return np.empty(0, dtype=np.intp)
+        chosen = np.argpartition(keys, count - 1)[:count]
+        return chosen[np.argsort(keys[chosen], kind='stable')]
+
+    def close(self) -> None:
+        """ Stop prefetching. """
+        if self.prefetch:
+            self._stop()
+
+    def __reduce__(self):
+        # resume the stream right after the samples drawn so far, dropping the prefetched ones
+        return RandomSource, (self.seed_sequence, self.prefetch, self.chunk_size, self.depth, self.consumed)
@@ -0,0 +1,232 @@
+""" A content-addressed on-disk cache of simulation results.
+
+Parameter sweeps rerun the same points over and over, across notebooks and nightly jobs. A ResultCache stores the
+result of every simulation call under a key derived from:
+    - the identity of the simulation function (its module and qualified name),
+    - its parameters, bound to its signature with the defaults filled in and normalized (e.g. 1.0 == 1, tuples are
+      lists, numpy scalars are Python numbers), so equivalent calls share an entry,
+    - the version of the library: a digest of the sources of its modules, and a digest of the source file of the
+      simulation function itself (which may live outside of the library, e.g. in a sweep script), so results are
+      recomputed once the code that produced them changes.
+Wrap a simulation with 'ResultCache.memoize' and repeated points come back from disk instead of being simulated again.
+
+A simulation with a 'seed' parameter is only cached when it is given a seed: with seed=None every call is a fresh
+random sample, and caching it would silently turn it into a fixed one.
+
+Entries are pickles, one file per key. They are written to a temporary file in the cache directory and renamed into
+place, so concurrent processes never see a partial entry (at worst, two of them compute the same point, and the last
+rename wins). Reading an entry marks it as recently used, and once the entries exceed 'max_bytes', the least recently
+used ones are deleted.
+
+Creating a ResultCache (e.g. at the import of a module of memoized simulations) has no side effects: its directory is
+only created, and the library version only digested, on first use.
+"""
+from functools import lru_cache, wraps
+from typing import Any, Callable, Dict, Mapping, Optional, Sequence, Tuple
+import fcntl
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import tempfile
+import time
+import numpy as np
+
+ENTRY_SUFFIX = '.pkl'
+
+
+@lru_cache(maxsize=None)
+def library_version() -> str:
+    """ A digest of the sources of all the modules of the library (the .py files next to this one, but tests). """
+    digest = hashlib.blake2b(digest_size=16)
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        if os.path.basename(path).startswith('test'):
+            continue
+        digest.update(os.path.basename(path).encode() + b'\0')
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _file_digest(path: str, mtime_ns: int) -> str:
+    # keyed by the modification time too, so a file edited while the process runs is digested again
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def source_version(function: Callable) -> Optional[str]:
+    """ A digest of the source file defining 'function', or None if it has none (e.g. a builtin). """
+    try:
+        path = inspect.getsourcefile(inspect.unwrap(function))
+    except TypeError:
+        return None
+    if path is None or not os.path.exists(path):
+        return None
+    return _file_digest(path, os.stat(path).st_mtime_ns)
+
+
+def normalize(value: Any) -> Any:
+    """ A canonical JSON-compatible form of a parameter value, equal for values that simulate the same. """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else value
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, Mapping):
+        return {str(key): normalize(item) for key, item in sorted(value.items(), key=lambda item: str(item[0]))}
+    raise TypeError(f'Cannot use a parameter of type {type(value).__name__} in a cache key')
+
+
+class ResultCache:
+    """ Stores the results of simulation calls on disk, keyed by content.
+
+    Attributes:
+        directory: Directory of the entries
+        max_bytes: Maximal total size of the entries. The least recently used entries are deleted beyond it.
+        version: The library version in the keys, library_version() (computed on first use) by default
+        hits: Number of calls answered from the cache by this process
+        misses: Number of calls computed and stored by this process
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30, version: Optional[str] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._version = version
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @property
+    def version(self) -> str:
+        if self._version is None:
+            self._version = library_version()
+        return self._version
+
+    def _make_directory(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, function: Callable, args: Sequence[Any] = (), kwargs: Optional[Mapping[str, Any]] = None) -> str:
+        """ The key of calling 'function' with the given arguments. """
+        arguments = inspect.signature(function).bind(*args, **(kwargs or {}))
+        arguments.apply_defaults()
+        identity = {'function': f'{function.__module__}.{function.__qualname__}',
+                    'parameters': normalize(dict(arguments.arguments)),
+                    'version': self.version,
+                    'source': source_version(function)}
+        return hashlib.blake2b(json.dumps(identity, sort_keys=True).encode(), digest_size=20).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    @staticmethod
+    def _touch(path: str) -> None:
+        # the modification time of an entry is its last use, set explicitly since file systems may only keep coarse
+        # timestamps
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """ Look up an entry, marking it as recently used.
+
+        :return: (found, value)
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            self._touch(path)
+        except (FileNotFoundError, EOFError):
+            # missing, or evicted by another process meanwhile
+            return False, None
+        return True, value
+
+    def put(self, key: str, value: Any) -> None:
+        """ Store an entry atomically, then evict least recently used entries beyond 'max_bytes'. """
+        self._make_directory()
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            self._touch(temp_path)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.evict()
+
+    def entries(self) -> Dict[str, os.stat_result]:
+        """ The stats of all entries, by path. """
+        entries = {}
+        for path in glob.glob(os.path.join(self.directory, '*' + ENTRY_SUFFIX)):
+            try:
+                entries[path] = os.stat(path)
+            except FileNotFoundError:
+                pass
+        return entries
+
+    @property
+    def nbytes(self) -> int:
+        return sum(stat.st_size for stat in self.entries().values())
+
+    def evict(self, max_bytes: Optional[int] = None) -> int:
+        """ Delete the least recently used entries until the rest fit 'max_bytes' (self.max_bytes by default).
+
+        :return: The number of entries deleted
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        self._make_directory()
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            # one process evicts at a time, so that they do not all delete entries for the same excess
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self.entries().items(), key=lambda entry: entry[1].st_mtime_ns)
+            total = sum(stat.st_size for _, stat in entries)
+            evicted = 0
+            for path, stat in entries:
+                if total <= max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    evicted += 1
+                except FileNotFoundError:
+                    pass
+                total -= stat.st_size
+        return evicted
+
+    def clear(self) -> None:
+        self.evict(0)
+
+    def memoize(self, function: Callable) -> Callable:
+        """ Wrap a simulation function so that its calls go through the cache. The wrapper's 'uncached' attribute
+        is the original function.
+        """
+        seeded = 'seed' in inspect.signature(function).parameters
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if seeded:
+                arguments = inspect.signature(function).bind(*args, **kwargs)
+                arguments.apply_defaults()
+                if arguments.arguments['seed'] is None:
+                    return function(*args, **kwargs)
+            key = self.key(function, args, kwargs)
+            found, value = self.get(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            value = function(*args, **kwargs)
+            self.put(key, value)
+            return value
+
+        wrapper.uncached = function
+        return wrapper
@@ -0,0 +1,168 @@
+""" Per-round metrics of a brain, streamed while it runs, and a chunked on-disk writer for them.
+
+Simulations used to collect their per-round data (e.g. support sizes) in Python lists that grow for the whole run and
+are only returned at the end, so a crash loses everything. Instead, a brain calls its metrics listeners with a
+RoundMetrics record at the end of every round (see Brain.add_metrics_listener), or the rounds of a run are iterated
+with 'stream_metrics'. Records are only computed when someone listens.
+
+A ChunkedMetricsWriter is a listener that appends the records to a directory in fixed size columnar chunks
+(one .npz file per chunk, plus an index), so its memory stays constant, and 'read_metrics' can read the chunks written
+so far while the run is still going.
+"""
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Tuple, Union
+import json
+import os
+import numpy as np
+from numpy import ndarray
+
+INDEX_FILE = 'index.json'
+
+# A metric of an area: an int, or a list of ints with the value of every trial of an EnsembleBrain
+AreaValue = Union[int, List[int]]
+
+
+class RoundMetrics:
+    """ The metrics of a single round (a single call to Brain.project).
+
+    Attributes:
+        round: Index of the round, starting from 0
+        wall_time: Duration of the round in seconds
+        support_size: The support size of every area after the round
+        num_first_winners: The number of first time winners of every area projected into in the round
+        overlap: The number of winners of every area projected into that were also winners in the previous round
+
+    For an EnsembleBrain, every value of an area is a list with the value of every trial.
+    """
+
+    def __init__(self, round: int, wall_time: float, support_size: Dict[str, AreaValue],
+                 num_first_winners: Dict[str, AreaValue], overlap: Dict[str, AreaValue]):
+        self.round = round
+        self.wall_time = wall_time
+        self.support_size = support_size
+        self.num_first_winners = num_first_winners
+        self.overlap = overlap
+
+    def columns(self) -> Dict[str, float]:
+        """ The record as flat columns: 'round', 'wall_time', and '<area>.<metric>' for every area
+        ('<area>.<metric>.<trial>' for every trial of an EnsembleBrain).
+        """
+        columns = {'round': self.round, 'wall_time': self.wall_time}
+        for name in ('support_size', 'num_first_winners', 'overlap'):
+            for area, value in getattr(self, name).items():
+                if isinstance(value, list):
+                    for trial, trial_value in enumerate(value):
+                        columns[f'{area}.{name}.{trial}'] = trial_value
+                else:
+                    columns[f'{area}.{name}'] = value
+        return columns
+
+    def __repr__(self) -> str:
+        return f'RoundMetrics({self.columns()})'
+
+
+MetricsListener = Callable[[RoundMetrics], None]
+
+
+def _area_value(value) -> AreaValue:
+    """ A metric of an area as an int, or as a list of ints for the per-trial arrays of an EnsembleArea. """
+    value = np.asarray(value)
+    return int(value) if value.ndim == 0 else value.tolist()
+
+
+def collect_round_metrics(brain, round: int, updated_areas: Iterable[str], wall_time: float) -> RoundMetrics:
+    """ The metrics of a round, computed once the new winners of 'updated_areas' are known but before they replace
+    the previous winners.
+    """
+    num_first_winners, overlap = {}, {}
+    for name in updated_areas:
+        area = brain.areas[name]
+        num_first_winners[name] = _area_value(area.num_first_winners)
+        # per trial for the (trials, k) winners of an EnsembleArea
+        shared = area._new_winners[..., :, None] == area.winner_array[..., None, :]
+        overlap[name] = _area_value(np.count_nonzero(shared.any(axis=-1), axis=-1))
+    support_size = {name: _area_value(area._new_support_size if name in num_first_winners else area.support_size)
+                    for name, area in brain.areas.items()}
+    return RoundMetrics(round, wall_time, support_size, num_first_winners, overlap)
+
+
+def stream_metrics(brain, rounds: int, stim_to_area: Mapping[str, List[str]],
+                   area_to_area: Mapping[str, List[str]]) -> Iterator[RoundMetrics]:
+    """ Project 'rounds' times with the same stimuli and areas, yielding the metrics of every round as it ends. """
+    records: List[RoundMetrics] = []
+    listener = records.append
+    brain.add_metrics_listener(listener)
+    try:
+        for _ in range(rounds):
+            brain.project(stim_to_area, area_to_area)
+            yield records.pop()
+    finally:
+        brain.remove_metrics_listener(listener)
+
+
+class ChunkedMetricsWriter:
+    """ Appends round metrics to a directory, in columnar chunks of 'chunk_size' rounds.
+
+    Every full chunk is written as 'chunk_<index>.npz', holding one array per column, and then added to the index file,
+    which is replaced atomically. A reader therefore only ever sees complete chunks. Use the writer as a metrics
+    listener of a brain, and close it (or use it as a context manager) to write the last, partial, chunk.
+
+    Attributes:
+        directory: Directory of the chunks and the index
+        chunk_size: Number of rounds per chunk
+    """
+
+    def __init__(self, directory: str, chunk_size: int = 1024):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+        self._chunks: List[Dict[str, int]] = []
+        self._buffer: List[Dict[str, float]] = []
+
+    def __call__(self, metrics: RoundMetrics) -> None:
+        self._buffer.append(metrics.columns())
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Write the buffered rounds as a chunk, even if it is not full. """
+        if not self._buffer:
+            return
+        names = list(dict.fromkeys(name for record in self._buffer for name in record))
+        columns = {name: np.array([record.get(name, -1) for record in self._buffer]) for name in names}
+        file_name = f'chunk_{len(self._chunks):06d}.npz'
+        np.savez(os.path.join(self.directory, file_name), **columns)
+        self._chunks.append({'file': file_name, 'rows': len(self._buffer)})
+        self._buffer = []
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'chunks': self._chunks}, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self) -> 'ChunkedMetricsWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def read_metrics(directory: str) -> Dict[str, ndarray]:
+    """ Read the chunks written so far by a ChunkedMetricsWriter.
+
+    :return: Every column, concatenated over all chunks. Values of columns missing in some chunks (e.g. of areas
+        added during the run) are -1 in those chunks.
+    """
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        chunks = json.load(f)['chunks']
+    loaded: List[Tuple[int, Dict[str, ndarray]]] = []
+    for chunk in chunks:
+        with np.load(os.path.join(directory, chunk['file'])) as data:
+            loaded.append((chunk['rows'], {name: data[name] for name in data.files}))
+    names = list(dict.fromkeys(name for _, columns in loaded for name in columns))
+    return {name: np.concatenate([columns.get(name, np.full(rows, -1)) for rows, columns in loaded])
+            for name in names}
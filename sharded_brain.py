@@ -0,0 +1,228 @@
+""" NonLazyBrain areas partitioned into shards owned by worker processes.
+
+An area with n = 10^7 neurons does not fit the memory or the throughput of a single process. In a ShardedBrain,
+the neurons of a sharded area are split into contiguous ranges, one per worker process. Every connectome into a
+sharded area lives in shared memory, and each worker owns the columns of its range. A projection into a sharded
+area runs as follows:
+    1. The coordinator (the brain) sends every worker the firing rows of each incoming connectome.
+    2. Each worker computes the inputs of its own neurons and returns its local top-k (indices and inputs).
+    3. The coordinator merges the local results into the global top-k. Every neuron of the global top-k is in the
+       top-k of its own shard, so the merge is exact, including the tie breaking by index of the unsharded brain.
+    4. The coordinator broadcasts the new winners, and every worker applies the Hebbian update to its columns.
+The results are identical to those of NonLazyBrain with the same seed.
+
+Workers are only ever addressed through messages (plain tuples) sent over a ShardConnection, so that a transport to
+workers on other hosts, owning their column blocks in local memory instead of attaching to shared memory, can be
+plugged in without changing the brain's API.
+"""
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Optional, Tuple
+import multiprocessing
+import weakref
+import numpy as np
+from numpy import ndarray
+from brain import Area
+from connectome_storage import Connectome, block, dense_random, edge_seed_sequence, estimate_connectome_nbytes
+from non_lazy_brain import NonLazyBrain
+from winner_selection import top_k_indices
+
+
+def _attach(segment_name: str) -> shared_memory.SharedMemory:
+    """ Attach to a shared memory segment owned (and eventually unlinked) by the brain, without tracking it. """
+    segment = shared_memory.SharedMemory(name=segment_name)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def _shard_worker(connection, start: int, end: int) -> None:
+    """ Main loop of a worker process owning the neurons [start, end) of every sharded area. """
+    segments: Dict[str, shared_memory.SharedMemory] = {}
+    connectomes: Dict[str, ndarray] = {}
+    try:
+        while True:
+            message = connection.recv()
+            command = message[0]
+            if command == 'attach':
+                _, key, segment_name, shape = message
+                segments[key] = _attach(segment_name)
+                connectomes[key] = np.ndarray(shape, dtype=np.float32, buffer=segments[key].buf)
+                connection.send(None)
+            elif command == 'top_k':
+                _, terms, k = message
+                inputs = np.zeros(end - start)
+                for key, rows in terms:
+                    connectome = connectomes[key]
+                    columns = connectome[:, start:end] if rows is None else connectome[rows, start:end]
+                    inputs += columns.sum(axis=0, dtype=np.float64)
+                local = top_k_indices(inputs, k)
+                connection.send((local + start, inputs[local]))
+            elif command == 'potentiate':
+                _, key, rows, cols, factor = message
+                local = cols[(cols >= start) & (cols < end)]
+                connectomes[key][np.ix_(rows, local)] *= factor
+                connection.send(None)
+            elif command == 'close':
+                break
+    finally:
+        connectomes.clear()
+        for segment in segments.values():
+            segment.close()
+        connection.close()
+
+
+class ShardConnection:
+    """ A worker process owning a range of neurons, reached through a pipe.
+
+    Attributes:
+        start, end: The range [start, end) of neuron indices the worker owns in every sharded area
+    """
+
+    def __init__(self, context, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=_shard_worker, args=(worker_connection, start, end), daemon=True)
+        self.process.start()
+        worker_connection.close()
+
+    def send(self, message: tuple) -> None:
+        self.connection.send(message)
+
+    def recv(self):
+        return self.connection.recv()
+
+    def close(self) -> None:
+        if self.process.is_alive():
+            try:
+                self.connection.send(('close',))
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.connection.close()
+
+
+def _release(workers: Dict[str, List[ShardConnection]], segments: List[shared_memory.SharedMemory]) -> None:
+    for connections in workers.values():
+        for connection in connections:
+            connection.close()
+    workers.clear()
+    for segment in segments:
+        segment.close()
+        segment.unlink()
+    segments.clear()
+
+
+class ShardedBrain(NonLazyBrain):
+    """ A NonLazyBrain in which some areas are partitioned into shards, each owned by a worker process.
+
+    Sharded areas are added with 'add_area(..., shards=S)'. Only dense storage is supported for connectomes into
+    sharded areas. The workers and shared memory segments are released by 'close' (or when the brain is garbage
+    collected). A ShardedBrain cannot be pickled or copied.
+
+    Attributes:
+        mp_context: The multiprocessing context used to start workers
+        shard_workers: The worker connections of every sharded area, in the order of their neuron ranges
+    """
+
+    def __init__(self, p: float, seed: Optional[int] = None, init_threads: Optional[int] = None,
+                 mp_context: Optional[str] = None):
+        super().__init__(p, 'dense', seed, init_threads)
+        self.mp_context = multiprocessing.get_context(mp_context)
+        self.shard_workers: Dict[str, List[ShardConnection]] = {}
+        self._segments: List[shared_memory.SharedMemory] = []
+        self._finalizer = weakref.finalize(self, _release, self.shard_workers, self._segments)
+
+    def add_area(self, name: str, n: int, k: int, beta: float, shards: int = 1) -> None:
+        """ Add an area, see NonLazyBrain.add_area.
+
+        :param shards: Number of worker processes the neurons of the area are split between. 1 for no sharding.
+        """
+        super().add_area(name, n, k, beta)
+        if shards > 1:
+            bounds = np.linspace(0, n, shards + 1).astype(int)
+            self.shard_workers[name] = [ShardConnection(self.mp_context, int(bounds[i]), int(bounds[i + 1]))
+                                        for i in range(shards)]
+
+    @staticmethod
+    def shared_key(source: str, target: str, from_stimulus: bool = False) -> str:
+        """ The name by which workers refer to the connectome from 'source' to 'target'. """
+        return f'{"stimulus" if from_stimulus else "area"}:{source}->{target}'
+
+    def create_connectome(self, source: str, target: str, from_stimulus: bool = False) -> Connectome:
+        """ Connectomes into sharded areas are generated in shared memory and attached by all of the area's workers.
+        """
+        if target not in self.shard_workers:
+            return super().create_connectome(source, target, from_stimulus)
+        if from_stimulus:
+            shape = (self.stimuli[source].k, self.areas[target].n)
+            seed_sequence = edge_seed_sequence(self.seed, 'stimulus', source, target)
+        else:
+            shape = (self.areas[source].n, self.areas[target].n)
+            seed_sequence = edge_seed_sequence(self.seed, 'area', source, target)
+        self.check_memory_budget(estimate_connectome_nbytes('dense', shape, self.p))
+        segment = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1] * 4))
+        self._segments.append(segment)
+        connectome = np.ndarray(shape, dtype=np.float32, buffer=segment.buf)
+        dense_random(shape, self.p, seed_sequence, self.init_threads, out=connectome)
+        self._broadcast(target, ('attach', self.shared_key(source, target, from_stimulus), segment.name, shape))
+        return connectome
+
+    def _broadcast(self, area_name: str, message: tuple) -> list:
+        """ Send a message to all workers of an area, and collect their replies. """
+        workers = self.shard_workers[area_name]
+        for worker in workers:
+            worker.send(message)
+        return [worker.recv() for worker in workers]
+
+    def project_into(self, area: Area, from_stimuli: List[str], from_areas: List[str]) -> int:
+        """ NonLazyBrain.project_into, distributed over the workers of 'area' if it is sharded. """
+        if area.name not in self.shard_workers:
+            return super().project_into(area, from_stimuli, from_areas)
+        terms: List[Tuple[str, Optional[ndarray]]] = []
+        for from_area in from_areas:
+            self.connectomes[from_area][area.name]  # make sure the connectome exists and is attached
+            terms.append((self.shared_key(from_area, area.name), self.areas[from_area].winner_array))
+        for stim in from_stimuli:
+            self.stimuli_connectomes[stim][area.name]
+            terms.append((self.shared_key(stim, area.name, from_stimulus=True), None))
+
+        local_results = self._broadcast(area.name, ('top_k', terms, area.k))
+        indices = np.concatenate([result[0] for result in local_results])
+        inputs = np.concatenate([result[1] for result in local_results])
+        order = np.lexsort((indices, -inputs))[:area.k]
+        num_first_winners = self.project_into_record_winners(area, indices[order])
+
+        winners = area._new_winners
+        for stim in from_stimuli:
+            rows, factor = np.arange(self.stimuli[stim].k), 1 + area.stimulus_beta[stim]
+            self.stimulus_connectome_stats[(stim, area.name)].update(
+                block(self.stimuli_connectomes[stim][area.name], rows, winners), factor)
+            self._broadcast(area.name, ('potentiate', self.shared_key(stim, area.name, from_stimulus=True),
+                                        rows, winners, factor))
+            self.connectome_changed(stim, area.name, True, rows)
+        for from_area in from_areas:
+            rows, factor = self.areas[from_area]._new_winners, 1 + area.area_beta[from_area]
+            self.connectome_stats[(from_area, area.name)].update(
+                block(self.connectomes[from_area][area.name], rows, winners), factor)
+            self._broadcast(area.name, ('potentiate', self.shared_key(from_area, area.name), rows, winners, factor))
+            self.connectome_changed(from_area, area.name, rows=rows)
+        return num_first_winners
+
+    def close(self) -> None:
+        """ Stop all workers and release the shared memory. The connectomes of sharded areas become invalid. """
+        for connectomes in list(self.connectomes.values()) + list(self.stimuli_connectomes.values()):
+            for target in list(connectomes):
+                if target in self.shard_workers:
+                    del connectomes[target]
+        self._finalizer()
+
+    def __enter__(self) -> 'ShardedBrain':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __getstate__(self):
+        raise TypeError('ShardedBrain holds worker processes and shared memory, and cannot be pickled or copied')
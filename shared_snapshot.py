@@ -0,0 +1,231 @@
+""" Snapshots of a brain in shared memory, attached read-only and without copying by other local processes.
+
+Handing a trained brain to analysis workers by pickling it (brain_util.sim_save, multiprocessing queues) gives every
+worker a full private copy. Instead, 'publish' copies the brain once into named shared memory segments:
+    - every dense connectome (and every other numpy array connectome) into a segment of its own,
+    - the support of every area as a bool array,
+    - the overlay (explicit entries) of every implicit connectome of a LazyBrain, as its keys and values arrays,
+    - a manifest segment with everything else: the parameters of the brain, the areas (winners, betas, ...), the
+      stimuli, the names of the array segments, the key and p of every implicit connectome (which the view rebuilds
+      on its own areas), and the (usually small) connectome objects of other storage modes.
+Any local process then calls 'attach' with the name of the snapshot to get a SharedBrainView: a read-only Brain whose
+connectomes are numpy arrays backed directly by the shared segments, e.g. for the readout of inference.infer_winners.
+
+Lifetime: the manifest holds the number of attached views, updated under a file lock, which the publisher creates and
+removes with the snapshot. The publisher owns the segments and unlinks them when it closes the snapshot, or when it
+exits (or drops the snapshot). Unlinking only removes the names:
+processes that are already attached keep their mappings until they close their views, so new attaches fail, but
+existing readers are never cut off.
+"""
+from typing import Any, Dict, List, Tuple
+from multiprocessing import resource_tracker, shared_memory
+import copy
+import fcntl
+import os
+import pickle
+import struct
+import tempfile
+import weakref
+import numpy as np
+from numpy import ndarray
+from brain import Brain
+from implicit_connectome import ImplicitConnectome
+
+# Manifest layout: reference count (int64) and payload length (int64), followed by the pickled payload.
+_HEADER = struct.Struct('<qq')
+
+ArrayKey = Tuple[str, str, str]
+
+
+def _lock_path(name: str) -> str:
+    return os.path.join(tempfile.gettempdir(), f'{name}.lock')
+
+
+def _update_references(manifest: shared_memory.SharedMemory, delta: int) -> int:
+    """ Atomically add 'delta' to the reference count of a snapshot, across processes. """
+    try:
+        # never create the lock: once the publisher released the snapshot, the count is only read by its views
+        descriptor = os.open(_lock_path(manifest.name), os.O_RDWR)
+    except FileNotFoundError:
+        descriptor = None
+    try:
+        if descriptor is not None:
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+        references, length = _HEADER.unpack_from(manifest.buf)
+        references += delta
+        _HEADER.pack_into(manifest.buf, 0, references, length)
+        return references
+    finally:
+        if descriptor is not None:
+            os.close(descriptor)
+
+
+def _attach_segment(name: str) -> shared_memory.SharedMemory:
+    """ Attach to a segment owned by the publisher, without letting this process' resource tracker unlink it. """
+    segment = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def _release(segments: List[shared_memory.SharedMemory], lock_path: str) -> None:
+    for segment in segments:
+        segment.close()
+        segment.unlink()
+    segments.clear()
+    if os.path.exists(lock_path):
+        os.remove(lock_path)
+
+
+class SharedBrainSnapshot:
+    """ The publisher side of a snapshot, owning its shared memory segments.
+
+    Attributes:
+        name: The name by which other processes attach the snapshot
+    """
+
+    def __init__(self, brain: Brain):
+        self._segments: List[shared_memory.SharedMemory] = []
+        arrays: Dict[ArrayKey, Tuple[str, Tuple[int, ...], str]] = {}
+        objects: Dict[ArrayKey, Any] = {}
+        implicit: Dict[ArrayKey, Tuple[Tuple[int, int], float]] = {}
+
+        def share(key: ArrayKey, array: ndarray) -> None:
+            array = np.ascontiguousarray(array)
+            segment = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            self._segments.append(segment)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+            arrays[key] = (segment.name, array.shape, array.dtype.str)
+
+        for kind, all_connectomes in (('area', brain.connectomes), ('stimulus', brain.stimuli_connectomes)):
+            for source, connectomes in all_connectomes.items():
+                for target in connectomes:
+                    connectome = connectomes[target]
+                    if isinstance(connectome, ndarray):
+                        share((kind, source, target), connectome)
+                    elif isinstance(connectome, ImplicitConnectome):
+                        # shared without its areas, which the view has of its own
+                        share(('overlay_keys', source, target), connectome.overlay.keys)
+                        share(('overlay_values', source, target), connectome.overlay.values)
+                        implicit[(kind, source, target)] = (connectome.key, connectome.p)
+                    else:
+                        objects[(kind, source, target)] = connectome
+        areas = {}
+        for name, area in brain.areas.items():
+            share(('support', name, ''), np.asarray(area.support, dtype=bool))
+            areas[name] = copy.copy(area)
+            areas[name].support = None
+        payload = pickle.dumps({'type': type(brain).__name__, 'p': brain.p, 'seed': brain.seed, 'areas': areas,
+                                'stimuli': brain.stimuli, 'arrays': arrays, 'objects': objects,
+                                'implicit': implicit,
+                                'area_names': list(brain.connectomes),
+                                'stimulus_names': list(brain.stimuli_connectomes)})
+        manifest = shared_memory.SharedMemory(create=True, size=_HEADER.size + len(payload))
+        _HEADER.pack_into(manifest.buf, 0, 0, len(payload))
+        manifest.buf[_HEADER.size:_HEADER.size + len(payload)] = payload
+        self._segments.append(manifest)
+        self._manifest = manifest
+        self.name: str = manifest.name
+        os.close(os.open(_lock_path(self.name), os.O_RDWR | os.O_CREAT, 0o600))
+        self._finalizer = weakref.finalize(self, _release, self._segments, _lock_path(self.name))
+
+    @property
+    def readers(self) -> int:
+        """ The number of views currently attached to the snapshot. """
+        return _update_references(self._manifest, 0)
+
+    def close(self) -> None:
+        """ Unlink the snapshot. Views that are already attached stay valid until they are closed. """
+        self._finalizer()
+
+    def __enter__(self) -> 'SharedBrainSnapshot':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __getstate__(self):
+        raise TypeError('SharedBrainSnapshot owns shared memory. Pass its name to other processes instead.')
+
+
+def publish(brain: Brain) -> SharedBrainSnapshot:
+    """ Copy the state of 'brain' into shared memory, for other processes to 'attach'.
+    Connectomes that were never generated are not published.
+    """
+    return SharedBrainSnapshot(brain)
+
+
+class SharedBrainView(Brain):
+    """ A read-only brain attached to a snapshot in shared memory.
+
+    Connectomes stored as numpy arrays are read-only views of the shared segments. The supports of the areas are
+    read-only bool arrays. Projecting raises a TypeError.
+
+    Attributes:
+        snapshot_name: The name of the snapshot
+        brain_type: The name of the class of the published brain
+    """
+
+    def __init__(self, name: str):
+        manifest = _attach_segment(name)
+        _, length = _HEADER.unpack_from(manifest.buf)
+        payload = pickle.loads(bytes(manifest.buf[_HEADER.size:_HEADER.size + length]))
+        super().__init__(payload['p'], payload['seed'])
+        self.snapshot_name: str = name
+        self.brain_type: str = payload['type']
+        self._manifest = manifest
+        self._segments: List[shared_memory.SharedMemory] = []
+        self.stimuli = payload['stimuli']
+        self.areas = payload['areas']
+        self.connectomes = {source: {} for source in payload['area_names']}
+        self.stimuli_connectomes = {source: {} for source in payload['stimulus_names']}
+        overlays: Dict[ArrayKey, ndarray] = {}
+        for (kind, source, target), (segment_name, shape, dtype) in payload['arrays'].items():
+            segment = _attach_segment(segment_name)
+            self._segments.append(segment)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+            array.flags.writeable = False
+            if kind == 'support':
+                self.areas[source].support = array
+            elif kind.startswith('overlay_'):
+                overlays[(kind, source, target)] = array
+            else:
+                (self.connectomes if kind == 'area' else self.stimuli_connectomes)[source][target] = array
+        for (kind, source, target), connectome in payload['objects'].items():
+            (self.connectomes if kind == 'area' else self.stimuli_connectomes)[source][target] = connectome
+        for (kind, source, target), (key, p) in payload['implicit'].items():
+            connectome = ImplicitConnectome(key, p, self.areas[source], self.areas[target])
+            connectome.overlay.keys = overlays[('overlay_keys', source, target)]
+            connectome.overlay.values = overlays[('overlay_values', source, target)]
+            self.connectomes[source][target] = connectome
+        _update_references(manifest, 1)
+        self._closed = False
+
+    def project(self, stim_to_area, area_to_area) -> None:
+        raise TypeError('A SharedBrainView is read-only')
+
+    def close(self) -> None:
+        """ Detach from the snapshot. The arrays of this view must not be used afterwards. """
+        if self._closed:
+            return
+        self._closed = True
+        _update_references(self._manifest, -1)
+        self.connectomes, self.stimuli_connectomes = {}, {}
+        for area in self.areas.values():
+            area.support = None
+        for segment in self._segments + [self._manifest]:
+            try:
+                segment.close()
+            except BufferError:
+                # arrays of the view are still referenced elsewhere, the mapping is released with them
+                pass
+
+    def __enter__(self) -> 'SharedBrainView':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def attach(name: str) -> SharedBrainView:
+    """ Attach a read-only view of the snapshot published under 'name'. """
+    return SharedBrainView(name)
@@ -0,0 +1,427 @@
+""" A local simulation service keeping named brains warm in memory, and a thin client for it.
+
+Every experiment script pays for its own imports, brain construction and connectome generation, and throws it all away
+when it exits. Instead, a SimulationService runs as a long lived process (python simulation_service.py <socket path>)
+holding named brains, and any number of clients send it jobs over a Unix socket:
+    - create / load: build a brain (or load one saved with brain_util.sim_save) under a name
+    - project: run rounds of Brain.project and return the new winners
+    - readout: the winners of an area for a list of queries, see inference.infer_winners (read-only)
+    - fork: copy a brain under a new name, e.g. to try several continuations of the same training
+    - checkpoint: save a brain with brain_util.sim_save
+    - drop / list / shutdown
+
+The protocol is one JSON object per line. A request carries an 'id', chosen by the client, and an 'op', and its
+response carries the same 'id' and either a 'result' or an 'error'. A request line longer than the line limit of the
+service is skipped and answered with an error (with its id, if the line starts with it as the client's lines do).
+Responses are sent as soon as their job is done, so they may arrive out of order, and a client can pipeline many
+requests before reading any response.
+
+The jobs of a brain run one at a time, in the order they arrived, in a worker thread (jobs of different brains run
+concurrently). Readouts of the same area that are waiting together at the head of the queue of a brain are coalesced
+into a single batched inference.infer_winners call, which is much cheaper than answering them one by one.
+"""
+from collections import deque
+from typing import Any, Deque, Dict, List, Mapping, Optional, Sequence, Tuple
+import asyncio
+import copy
+import json
+import os
+import re
+import socket
+import sys
+import numpy as np
+from brain import Brain
+from brain_util import sim_load, sim_save
+from inference import infer_winners
+from lazy_brain import LazyBrain
+from non_lazy_brain import NonLazyBrain
+
+BRAIN_TYPES = {'lazy': LazyBrain, 'non_lazy': NonLazyBrain}
+
+# Operations that run on the queue of an existing brain
+BRAIN_OPS = ('project', 'readout', 'fork', 'checkpoint', 'drop')
+
+# Default maximal length of a request line, in bytes (readouts with many queries make long lines)
+LINE_LIMIT = 1 << 26
+
+# The id at the start of a request line, to answer a line too long to be parsed
+_LEADING_ID = re.compile(rb'\s*\{\s*"id"\s*:\s*(-?\d+)')
+
+
+class ServiceError(Exception):
+    pass
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _dumps(message: Mapping[str, Any]) -> bytes:
+    return json.dumps(message, default=_encode).encode() + b'\n'
+
+
+class _Job:
+    def __init__(self, request: Dict[str, Any], writer: asyncio.StreamWriter):
+        self.request = request
+        self.writer = writer
+
+    @property
+    def op(self) -> str:
+        return self.request['op']
+
+    def readout_key(self) -> Tuple[str, Optional[int]]:
+        return self.request['area'], self.request.get('k')
+
+
+class SimulationService:
+    """ Serves jobs on named brains over a Unix socket.
+
+    Attributes:
+        path: Path of the Unix socket
+        batch_window: Seconds to wait for more readouts to arrive before answering a readout, so that readouts sent
+            together are coalesced even if the first one arrives alone. With 0, only the readouts already waiting
+            are coalesced.
+        line_limit: Maximal length of a request line, in bytes
+        brains: The brains held by the service, by name
+        readout_batches: Number of batched readout calls made so far
+        readouts: Number of readout requests answered so far
+    """
+
+    def __init__(self, path: str, batch_window: float = 0.0, line_limit: int = LINE_LIMIT):
+        self.path = path
+        self.batch_window = batch_window
+        self.line_limit = line_limit
+        self.brains: Dict[str, Brain] = {}
+        self.readout_batches: int = 0
+        self.readouts: int = 0
+        self._queues: Dict[str, Deque[_Job]] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped: Optional[asyncio.Event] = None
+
+    async def serve(self) -> None:
+        """ Serve until 'stop' is called or a client sends 'shutdown'. """
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self._handle_client, path=self.path, limit=self.line_limit)
+        try:
+            async with server:
+                await self._stopped.wait()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def stop(self) -> None:
+        """ Stop serving. Safe to call from any thread. """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _read_line(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bytes:
+        """ The next request line, answering and skipping the lines longer than the line limit. b'' at the end. """
+        while True:
+            try:
+                return await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                return e.partial
+            except asyncio.LimitOverrunError as e:
+                # the line is left in the buffer: read its start, for the id, and skip the rest
+                try:
+                    start = await reader.readexactly(min(e.consumed, 64))
+                except asyncio.IncompleteReadError:
+                    return b''
+                match = _LEADING_ID.match(start)
+                request_id = int(match.group(1)) if match else None
+                if not await self._skip_line(reader, e.consumed - len(start)):
+                    return b''
+                self._respond(writer, {'id': request_id,
+                                       'error': f'LimitOverrunError: request longer than {self.line_limit} bytes'})
+
+    @staticmethod
+    async def _skip_line(reader: asyncio.StreamReader, consumed: int) -> bool:
+        """ Skip the rest of a line of which 'consumed' bytes can be discarded. :return: False at the end """
+        while True:
+            try:
+                await reader.readexactly(consumed)
+                await reader.readuntil(b'\n')
+                return True
+            except asyncio.IncompleteReadError:
+                return False
+            except asyncio.LimitOverrunError as e:
+                consumed = e.consumed
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await self._read_line(reader, writer):
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    self._respond(writer, {'id': None, 'error': f'JSONDecodeError: {e}'})
+                    continue
+                await self._dispatch(_Job(request, writer))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _respond(writer: asyncio.StreamWriter, message: Mapping[str, Any]) -> None:
+        if not writer.is_closing():
+            writer.write(_dumps(message))
+
+    def _succeed(self, job: _Job, result: Any) -> None:
+        self._respond(job.writer, {'id': job.request.get('id'), 'result': result})
+
+    def _fail(self, job: _Job, error: BaseException) -> None:
+        self._respond(job.writer, {'id': job.request.get('id'), 'error': f'{type(error).__name__}: {error}'})
+
+    async def _dispatch(self, job: _Job) -> None:
+        op = job.request.get('op')
+        try:
+            if op in BRAIN_OPS:
+                name = job.request['brain']
+                if name not in self.brains:
+                    raise KeyError(f'No brain named {name}')
+                self._queues[name].append(job)
+                if name not in self._workers:
+                    self._workers[name] = asyncio.create_task(self._run_brain(name))
+            elif op in ('create', 'load'):
+                name = job.request['brain']
+                if name in self.brains:
+                    raise ValueError(f'A brain named {name} already exists')
+                build = self._create if op == 'create' else self._load
+                brain = await asyncio.to_thread(build, job.request)
+                if name in self.brains:
+                    raise ValueError(f'A brain named {name} already exists')
+                self._add_brain(name, brain)
+                self._succeed(job, name)
+            elif op == 'list':
+                self._succeed(job, {name: type(brain).__name__ for name, brain in self.brains.items()})
+            elif op == 'shutdown':
+                self._succeed(job, None)
+                self._stopped.set()
+            else:
+                raise ValueError(f'Unknown operation {op}')
+        except Exception as e:
+            self._fail(job, e)
+
+    def _add_brain(self, name: str, brain: Brain) -> None:
+        self.brains[name] = brain
+        self._queues[name] = deque()
+
+    @staticmethod
+    def _create(request: Mapping[str, Any]) -> Brain:
+        brain_type = BRAIN_TYPES[request.get('type', 'non_lazy')]
+        brain = brain_type(request['p'], **request.get('options', {}))
+        for stim, k in request.get('stimuli', {}).items():
+            brain.add_stimulus(stim, k)
+        for area, (n, k, beta) in request.get('areas', {}).items():
+            brain.add_area(area, n, k, beta)
+        return brain
+
+    @staticmethod
+    def _load(request: Mapping[str, Any]) -> Brain:
+        brain = sim_load(request['path'])
+        if not isinstance(brain, Brain):
+            raise TypeError(f'{request["path"]} does not hold a brain')
+        return brain
+
+    async def _run_brain(self, name: str) -> None:
+        """ Run the jobs of a brain one at a time, coalescing consecutive readouts. """
+        queue = self._queues[name]
+        try:
+            while queue:
+                if queue[0].op == 'readout':
+                    # let readouts sent together with this one arrive before answering it
+                    await asyncio.sleep(self.batch_window)
+                    jobs = []
+                    while queue and queue[0].op == 'readout':
+                        jobs.append(queue.popleft())
+                    await self._readout(self.brains[name], jobs)
+                    continue
+                job = queue.popleft()
+                try:
+                    self._succeed(job, await self._run_job(name, job.request))
+                except Exception as e:
+                    self._fail(job, e)
+                await self._drain(job.writer)
+        finally:
+            if self._workers.get(name) is asyncio.current_task():
+                del self._workers[name]
+
+    async def _run_job(self, name: str, request: Mapping[str, Any]) -> Any:
+        brain = self.brains[name]
+        op = request['op']
+        if op == 'project':
+            return await asyncio.to_thread(self._project, brain, request)
+        if op == 'fork':
+            new_name = request['name']
+            if new_name in self.brains:
+                raise ValueError(f'A brain named {new_name} already exists')
+            forked = await asyncio.to_thread(copy.deepcopy, brain)
+            if new_name in self.brains:
+                raise ValueError(f'A brain named {new_name} already exists')
+            self._add_brain(new_name, forked)
+            return new_name
+        if op == 'checkpoint':
+            await asyncio.to_thread(sim_save, request['path'], brain)
+            return request['path']
+        # drop: the jobs still queued for the brain fail, and the name can be reused right away
+        del self.brains[name]
+        del self._workers[name]
+        queue = self._queues.pop(name)
+        while queue:
+            self._fail(queue.popleft(), KeyError(f'Brain {name} was dropped'))
+        return name
+
+    @staticmethod
+    def _project(brain: Brain, request: Mapping[str, Any]) -> Dict[str, List[int]]:
+        stim_to_area = request.get('stim_to_area', {})
+        area_to_area = request.get('area_to_area', {})
+        for _ in range(request.get('rounds', 1)):
+            brain.project(stim_to_area, area_to_area)
+        targets = set(area for areas in stim_to_area.values() for area in areas)
+        targets.update(area for areas in area_to_area.values() for area in areas)
+        return {area: brain.areas[area].winners for area in sorted(targets)}
+
+    async def _readout(self, brain: Brain, jobs: List[_Job]) -> None:
+        """ Answer readouts of a brain, with a single batched call for all those of the same area and k. """
+        groups: Dict[Tuple[str, Optional[int]], List[_Job]] = {}
+        for job in jobs:
+            groups.setdefault(job.readout_key(), []).append(job)
+        for (area, k), group in groups.items():
+            queries = [query for job in group for query in job.request['queries']]
+            try:
+                winners = await asyncio.to_thread(infer_winners, brain, area, queries, k)
+            except Exception as e:
+                for job in group:
+                    self._fail(job, e)
+                continue
+            self.readout_batches += 1
+            self.readouts += len(group)
+            start = 0
+            for job in group:
+                end = start + len(job.request['queries'])
+                self._succeed(job, winners[start:end])
+                start = end
+        for writer in {job.writer for job in jobs}:
+            await self._drain(writer)
+
+    @staticmethod
+    async def _drain(writer: asyncio.StreamWriter) -> None:
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class SimulationClient:
+    """ A blocking client of a SimulationService.
+
+    Every method sends a request and waits for its response. To pipeline requests (e.g. to have many readouts
+    coalesced), 'submit' them all first and then collect their 'result's, in any order.
+    """
+
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(path)
+        self._file = self._socket.makefile('rwb')
+        self._next_id = 0
+        self._responses: Dict[int, Dict[str, Any]] = {}
+
+    def submit(self, op: str, **params) -> int:
+        """ Send a request without waiting for its response.
+
+        :return: The id of the request, to pass to 'result'
+        """
+        request_id = self._next_id
+        self._next_id += 1
+        self._file.write(_dumps({'id': request_id, 'op': op, **params}))
+        self._file.flush()
+        return request_id
+
+    def result(self, request_id: int) -> Any:
+        """ Wait for the response to a submitted request, keeping the responses to other requests that arrive first. """
+        while request_id not in self._responses:
+            line = self._file.readline()
+            if not line:
+                raise ConnectionError('The simulation service closed the connection')
+            response = json.loads(line)
+            self._responses[response['id']] = response
+        response = self._responses.pop(request_id)
+        if 'error' in response:
+            raise ServiceError(response['error'])
+        return response['result']
+
+    def request(self, op: str, **params) -> Any:
+        return self.result(self.submit(op, **params))
+
+    def create(self, brain: str, p: float, type: str = 'non_lazy', stimuli: Optional[Mapping[str, int]] = None,
+               areas: Optional[Mapping[str, Tuple[int, int, float]]] = None, **options) -> str:
+        """ Create a brain.
+
+        :param brain: Name of the brain
+        :param p: Probability of each synapse
+        :param type: 'non_lazy' or 'lazy'
+        :param stimuli: The k of every stimulus to add, by name
+        :param areas: The (n, k, beta) of every area to add, by name
+        :param options: Other arguments of the constructor of the brain, e.g. seed or storage
+        """
+        return self.request('create', brain=brain, p=p, type=type, stimuli=stimuli or {}, areas=areas or {},
+                            options=options)
+
+    def load(self, brain: str, path: str) -> str:
+        return self.request('load', brain=brain, path=path)
+
+    def project(self, brain: str, stim_to_area: Mapping[str, List[str]], area_to_area: Mapping[str, List[str]],
+                rounds: int = 1) -> Dict[str, List[int]]:
+        """ Project 'rounds' times, see Brain.project.
+
+        :return: The winners of every area projected into, after the last round
+        """
+        return self.request('project', brain=brain, stim_to_area=stim_to_area, area_to_area=area_to_area,
+                            rounds=rounds)
+
+    def readout(self, brain: str, area: str, queries: Sequence[Mapping[str, Optional[Sequence[int]]]],
+                k: Optional[int] = None) -> List[List[int]]:
+        """ The winners of 'area' for every query, see inference.infer_winners. """
+        return self.request('readout', brain=brain, area=area, queries=queries, k=k)
+
+    def fork(self, brain: str, name: str) -> str:
+        return self.request('fork', brain=brain, name=name)
+
+    def checkpoint(self, brain: str, path: str) -> str:
+        return self.request('checkpoint', brain=brain, path=path)
+
+    def drop(self, brain: str) -> str:
+        return self.request('drop', brain=brain)
+
+    def list_brains(self) -> Dict[str, str]:
+        return self.request('list')
+
+    def shutdown(self) -> None:
+        self.request('shutdown')
+
+    def close(self) -> None:
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self) -> 'SimulationClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit(f'usage: {sys.argv[0]} <socket path>')
+    asyncio.run(SimulationService(sys.argv[1]).serve())
@@ -1,7 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import copy
+import heapq
+import importlib.util
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import time
+import numpy as np
+import pytest
 from brain import *
 from non_lazy_brain import *
 from lazy_brain import LazyBrain
-import numpy as np
+from assembly_registry import AssemblyRegistry
+import checkpointing
+from checkpointing import DeltaCheckpointer, load_compact, restore, save_compact
+from connectome_cache import ConnectomeCache, SpilledConnectome
+from connectome_pool import ConnectomePool, check_independent
+from connectome_stats import potentiation_levels
+import connectome_storage
+from connectome_storage import BitPackedConnectome, CSRConnectome, CompactConnectome, dense_random, \
+    edge_seed_sequence, to_dense
+from ensemble_brain import EnsembleBrain
+from hybrid_brain import HybridBrain
+from implicit_connectome import ImplicitConnectome, connectome_key, implicit_edges
+from inference import infer_winners
+from many_area_brain import ManyAreaBrain
+from memory_accounting import MemoryBudgetExceeded, estimate_memory
+from random_source import RandomSource
+from result_cache import ResultCache
+from round_metrics import ChunkedMetricsWriter, read_metrics, stream_metrics
+from sharded_brain import ShardedBrain
+from shared_snapshot import attach, publish
+from simulation_service import ServiceError, SimulationClient, SimulationService
+import tracing
+from winner_selection import ThresholdTopK, batched_top_k_indices, top_k_indices
 # ____// NON LAZY TESTS //____
 
 
@@ -205,3 +240,930 @@ def test_small_area(brain_cls):
             print('FAILED test_small_area for class' + brain_cls.__name__)
             break
 
+
+
+def test_top_k_matches_nlargest():
+    rng = np.random.default_rng(0)
+    selector = ThresholdTopK()
+    for _ in range(20):
+        inputs = rng.integers(0, 10, 200).astype(float)
+        expected = heapq.nlargest(15, list(range(len(inputs))), inputs.__getitem__)
+        assert top_k_indices(inputs, 15).tolist() == expected
+        assert selector.select(inputs, 15).tolist() == expected
+    assert top_k_indices(np.array([1., 2.]), 5).tolist() == [1, 0]
+
+
+def test_threshold_top_k_uses_candidates():
+    rng = np.random.default_rng(1)
+    inputs = rng.random(10000)
+    inputs[:50] += 10
+    selector = ThresholdTopK()
+    assert sorted(selector.select(inputs, 50).tolist()) == list(range(50))
+    inputs[:50] *= 1.01
+    assert sorted(selector.select(inputs, 50).tolist()) == list(range(50))
+    assert selector.hits == 1 and selector.fallbacks == 1
+
+
+def test_compact_connectomes_match_dense():
+    weights = np.random.default_rng(2).binomial(1, 0.3, (20, 30)).astype('f')
+    for storage in [BitPackedConnectome, CSRConnectome]:
+        dense = weights.copy()
+        compact = storage.from_dense(dense)
+        for rows, cols in [([1, 4, 7], [0, 2, 29]), ([4, 5], [2, 3]), (range(20), [11])]:
+            dense[np.ix_(list(rows), cols)] *= 1.1
+            compact.potentiate(rows, cols, 1.1)
+        assert np.allclose(compact.to_dense(), dense)
+        assert np.allclose(compact.accumulate([1, 4, 19]), dense[[1, 4, 19]].sum(axis=0))
+        assert np.allclose(compact.accumulate(), dense.sum(axis=0))
+        assert np.allclose(storage.from_dense(dense).to_dense(), dense)
+
+
+def test_incomplete_compact_connectome():
+
+    class RowSumOnly(CompactConnectome):
+        def _base_row_sum(self, rows):
+            return np.zeros(self.shape[1])
+
+    with pytest.raises(TypeError):
+        RowSumOnly((3, 4))
+
+
+def test_compact_storage_brain():
+    for storage in ['bitpacked', 'csr']:
+        brain = NonLazyBrain(p=0.1, storage=storage)
+        brain.add_stimulus('s', 10)
+        brain.add_area('a', n=500, k=10, beta=0.1)
+        for _ in range(5):
+            brain.project({'s': ['a']}, {'a': ['a']})
+        assert len(set(brain.areas['a'].winners)) == 10
+        assert np.max(brain.connectomes['a']['a']) > 1
+        p = np.count_nonzero(brain.connectomes['a']['a'].to_dense()) / 500 ** 2
+        assert 0.08 < p < 0.12
+
+
+def test_implicit_connectome_edges():
+    key = connectome_key(7, 'a', 'b')
+    edges = implicit_edges(key, 0.1, np.arange(300), np.arange(300))
+    assert 0.09 < edges.mean() < 0.11
+    assert np.array_equal(edges[10:20, 5:9], implicit_edges(key, 0.1, np.arange(10, 20), np.arange(5, 9)))
+    assert not np.array_equal(edges, implicit_edges(connectome_key(7, 'b', 'a'), 0.1, np.arange(300), np.arange(300)))
+
+
+def test_lazy_brain_structure_from_seed():
+    def run(area_names):
+        brain = LazyBrain(p=0.1, seed=5, random_draws='stream')
+        for name in area_names:
+            brain.add_area(name, n=1000, k=10, beta=0.1)
+        brain.add_stimulus('s', k=10)
+        brain.project({'s': ['a', 'b']}, {})
+        brain.project({'s': ['a']}, {'a': ['a']})
+        return brain
+
+    # the structure does not depend on the order in which the areas were added
+    brain, other = run(['a', 'b']), run(['b', 'a'])
+    connectome, other_connectome = brain.connectomes['a']['b'], other.connectomes['a']['b']
+    assert len(connectome.overlay) == 0
+    rows, cols = range(brain.areas['a'].support_size), range(brain.areas['b'].support_size)
+    assert np.array_equal(connectome.block(rows, cols), other_connectome.block(rows, cols))
+    assert len(brain.connectomes['a']['a'].overlay) > 0
+    assert np.max(brain.connectomes['a']['a']) > 1
+
+
+def test_non_lazy_connectomes_allocated_lazily():
+    brain = NonLazyBrain(p=0.2, seed=11)
+    for name in ['a', 'b', 'c']:
+        brain.add_area(name, n=40, k=4, beta=0.1)
+    brain.add_stimulus('s', k=4)
+    assert all(len(connectomes) == 0 for connectomes in brain.connectomes.values())
+    brain.project({'s': ['a']}, {})
+    brain.project({}, {'a': ['b']})
+    assert list(brain.connectomes['a'].keys()) == ['b']
+    assert list(brain.stimuli_connectomes['s'].keys()) == ['a']
+    other = NonLazyBrain(p=0.2, seed=11)
+    other.add_stimulus('s', k=4)
+    for name in ['c', 'b', 'a']:
+        other.add_area(name, n=40, k=4, beta=0.1)
+    assert np.array_equal(other.connectomes['c']['a'], brain.connectomes['c']['a'])
+    assert np.array_equal(other.stimuli_connectomes['s']['b'], brain.stimuli_connectomes['s']['b'])
+    for clone in [copy.deepcopy(brain), pickle.loads(pickle.dumps(brain))]:
+        assert np.array_equal(clone.connectomes['a']['b'], brain.connectomes['a']['b'])
+        assert clone.connectomes['b'].brain is clone
+
+
+def test_random_connectomes_independent_of_threads():
+    chunk_elements = connectome_storage.CHUNK_ELEMENTS
+    connectome_storage.CHUNK_ELEMENTS = 1000
+    try:
+        seed = np.random.SeedSequence(3)
+        dense = dense_random((300, 200), 0.1, seed, threads=1)
+        assert dense.dtype == np.float32 and 0.09 < dense.mean() < 0.11
+        assert np.array_equal(dense, dense_random((300, 200), 0.1, seed, threads=4))
+        for storage in [BitPackedConnectome, CSRConnectome]:
+            single = storage.random((300, 200), 0.1, seed, threads=1).to_dense()
+            assert np.array_equal(single, storage.random((300, 200), 0.1, seed, threads=4).to_dense())
+            assert 0.09 < single.mean() < 0.11
+    finally:
+        connectome_storage.CHUNK_ELEMENTS = chunk_elements
+
+
+def test_trace_sink(tmp_path):
+    path = str(tmp_path / 'trace.bin')
+    assert not tracing.trace_enabled()
+    with tracing.BinaryTraceSink(path):
+        assert tracing.trace_enabled()
+        brain = NonLazyBrain(p=0.1)
+        brain.add_stimulus('s', k=5)
+        brain.add_area('a', n=100, k=5, beta=0.1)
+        brain.project({'s': ['a']}, {})
+    assert not tracing.trace_enabled()
+    records = list(tracing.read_trace(path))
+    events = [record['event'] for record in records]
+    assert events == ['prev_winner_inputs', 'new_winners', 'stimulus_connectome']
+    assert records[0]['fields']['inputs']['shape'] == [100]
+    assert records[1]['fields']['winners']['shape'] == [5]
+    assert records[2]['fields']['connectome']['shape'] == [5, 100]
+
+
+def test_lazy_brain_compact():
+    brain = LazyBrain(p=0.05, seed=3)
+    brain.add_stimulus('s', k=20)
+    brain.add_area('a', n=10000, k=20, beta=0.1)
+    brain.add_area('b', n=10000, k=20, beta=0.1)
+    brain.project({'s': ['a']}, {})
+    for _ in range(15):
+        brain.project({}, {'a': ['a', 'b']})
+    a = brain.areas['a']
+    weights_aa = brain.connectomes['a']['a'].to_dense()
+    weights_ab = brain.connectomes['a']['b'].to_dense()
+    # by default, neurons that learned as sources (potentiated outgoing synapses) are kept
+    learned = a.support_ids[np.flatnonzero(np.any(weights_aa > 1, axis=1) | np.any(weights_ab > 1, axis=1))]
+    brain.compact('a', idle_rounds=3, max_wins=1)
+    assert len(learned) > 0 and np.isin(learned, a.support_ids).all()
+
+    support_size = a.support_size
+    ids = a.support_ids.copy()
+    winner_ids = ids[a.winners]
+    weights_aa = brain.connectomes['a']['a'].to_dense()
+    weights_ab = brain.connectomes['a']['b'].to_dense()
+    assert brain.compact('a', idle_rounds=3, max_wins=1, keep_potentiated=False) > 0
+    assert a.support_size < support_size and len(a.support_ids) == a.support_size
+    assert np.array_equal(a.support_ids[a.winners], winner_ids)
+    kept = np.flatnonzero(np.isin(ids, a.support_ids))
+    assert np.array_equal(brain.connectomes['a']['a'].to_dense(), weights_aa[np.ix_(kept, kept)])
+    assert np.array_equal(brain.connectomes['a']['b'].to_dense(), weights_ab[kept])
+    for _ in range(3):
+        brain.project({}, {'a': ['a', 'b']})
+    assert len(set(a.winners)) == a.k
+
+
+def test_lazy_brain_auto_compact():
+    brain = LazyBrain(p=0.05, seed=3, compaction_growth=100, compaction_idle_rounds=2,
+                      compaction_keep_potentiated=False)
+    brain.add_stimulus('s', k=20)
+    brain.add_area('a', n=10000, k=20, beta=0.1)
+    brain.project({'s': ['a']}, {})
+    for _ in range(40):
+        brain.project({}, {'a': ['a']})
+    assert brain.areas['a'].support_size < 300
+
+
+def test_many_area_brain_wiring():
+    brain = ManyAreaBrain(p=0.05, seed=1, compaction_growth=50)
+    for i in range(300):
+        brain.add_area(f'a{i}', n=10000, k=10, beta=0.1)
+    brain.add_stimulus('s', k=10)
+    for i in range(299):
+        brain.connect(f'a{i}', f'a{i + 1}')
+    brain.connect('a0', 'a0')
+    assert len(brain.edge_connectomes) == 300
+    brain.project({'s': ['a0']}, {})
+    for _ in range(10):
+        brain.project({'s': ['a0']}, {'a0': ['a0', 'a1'], 'a1': ['a2']})
+    assert len(set(brain.areas['a2'].winners)) == 10
+    assert set(brain.connectomes['a0']) == {'a0', 'a1'}
+    assert len(brain.connectomes['a1']['a2'].overlay) > 0
+    assert list(brain.stimuli_connectomes['s']) == ['a0']
+    with pytest.raises(IndexError):
+        brain.project({}, {'a2': ['a0']})
+    brain.auto_wire = True
+    brain.project({}, {'a2': ['a0']})
+    assert 'a0' in brain.outputs['a2']
+
+
+def test_hybrid_brain_matches_non_lazy():
+    brains = [NonLazyBrain(p=0.1, seed=4), HybridBrain(p=0.1, seed=4)]
+    for brain in brains:
+        brain.add_stimulus('s', k=10)
+        brain.add_area('a', n=300, k=10, beta=0.1)
+        brain.add_area('b', n=200, k=10, beta=0.1)
+        brain.project({'s': ['a']}, {})
+        for _ in range(5):
+            brain.project({'s': ['a']}, {'a': ['a', 'b'], 'b': ['b']})
+    assert brains[1].backends == {'a': 'dense', 'b': 'dense'}
+    assert brains[0].areas['b'].winners == brains[1].areas['b'].winners
+    assert np.array_equal(brains[0].connectomes['a']['b'], brains[1].connectomes['a']['b'])
+
+
+def test_hybrid_brain_mixed_backends():
+    brain = HybridBrain(p=0.05, seed=2, area_memory_budget=10 ** 6)
+    brain.add_stimulus('s', k=30)
+    brain.add_area('small', n=400, k=30, beta=0.1)
+    brain.add_area('medium', n=2000, k=30, beta=0.1)
+    brain.add_area('huge', n=10 ** 7, k=30, beta=0.1)
+    brain.add_area('csr', n=1000, k=30, beta=0.1, backend='csr')
+    assert brain.backends == {'small': 'dense', 'medium': 'bitpacked', 'huge': 'lazy', 'csr': 'csr'}
+    brain.project({'s': ['huge']}, {})
+    for _ in range(5):
+        brain.project({'s': ['huge']}, {'huge': ['huge', 'small', 'csr'], 'small': ['medium']})
+    brain.project({}, {'small': ['huge'], 'medium': ['small'], 'csr': ['medium']})
+    for name, area in brain.areas.items():
+        assert len(set(area.winners)) == area.k, name
+    assert isinstance(brain.connectomes['huge']['small'], ImplicitConnectome)
+    assert brain.connectomes['huge']['small'].shape == (brain.areas['huge'].support_size, 400)
+    assert isinstance(brain.connectomes['small']['medium'], type(brain.connectomes['csr']['medium']))
+    assert np.max(brain.connectomes['huge']['small']) > 1
+    assert 'medium' not in brain.connectomes['huge']
+    assert brain.compact('small', idle_rounds=0, max_wins=10, keep_potentiated=False) == 0
+    unkept = copy.deepcopy(brain)
+    assert unkept.compact('huge', idle_rounds=0, max_wins=10, keep_potentiated=False) > \
+        brain.compact('huge', idle_rounds=0, max_wins=10)
+
+
+def test_sharded_brain_matches_non_lazy():
+    reference = NonLazyBrain(p=0.1, seed=6)
+    with ShardedBrain(p=0.1, seed=6) as sharded:
+        for brain, shards in ((reference, {}), (sharded, {'shards': 3})):
+            brain.add_stimulus('s', k=10)
+            brain.add_area('a', n=301, k=10, beta=0.1, **shards)
+            brain.add_area('b', n=200, k=10, beta=0.1)
+            brain.project({'s': ['a']}, {})
+            for _ in range(5):
+                brain.project({'s': ['a']}, {'a': ['a', 'b'], 'b': ['a', 'b']})
+        assert len(sharded.shard_workers['a']) == 3
+        for name in ('a', 'b'):
+            assert reference.areas[name].winners == sharded.areas[name].winners
+            assert reference.areas[name].support_size == sharded.areas[name].support_size
+        for source, target in (('a', 'a'), ('b', 'a'), ('a', 'b')):
+            assert np.array_equal(reference.connectomes[source][target], sharded.connectomes[source][target])
+        assert np.array_equal(reference.stimuli_connectomes['s']['a'], sharded.stimuli_connectomes['s']['a'])
+        reference_stats, sharded_stats = reference.connectome_stats[('b', 'a')], sharded.connectome_stats[('b', 'a')]
+        assert (reference_stats.max_weight, reference_stats.num_potentiated) == \
+               (sharded_stats.max_weight, sharded_stats.num_potentiated)
+
+
+def test_batched_top_k():
+    inputs = np.random.default_rng(0).integers(0, 4, (6, 40)).astype(float)
+    for k in (1, 7, 40):
+        batched = batched_top_k_indices(inputs, k)
+        for row in range(len(inputs)):
+            assert batched[row].tolist() == top_k_indices(inputs[row], k).tolist()
+
+
+def test_global_seed_makes_runs_reproducible():
+    winners = []
+    for seed in (12, 12, 13):
+        np.random.seed(seed)
+        brain = NonLazyBrain(p=0.1)
+        brain.add_stimulus('s', k=10)
+        brain.add_area('a', n=300, k=10, beta=0.1)
+        for _ in range(3):
+            brain.project({'s': ['a']}, {'a': ['a']})
+        winners.append(brain.areas['a'].winners)
+    assert winners[0] == winners[1] != winners[2]
+
+
+def test_ensemble_brain_matches_trials():
+    ensemble = EnsembleBrain(p=0.1, trials=3, seed=8)
+    brains = [ensemble] + [NonLazyBrain(p=0.1, seed=seed) for seed in ensemble.trial_seeds]
+    for brain in brains:
+        brain.add_stimulus('s', k=10)
+        brain.add_area('a', n=200, k=10, beta=0.1)
+        brain.add_area('b', n=150, k=10, beta=0.1)
+        brain.project({'s': ['a']}, {})
+        for _ in range(5):
+            brain.project({'s': ['a']}, {'a': ['a', 'b'], 'b': ['a']})
+    assert ensemble.connectomes['a']['b'].shape == (3, 200, 150)
+    for trial, brain in enumerate(brains[1:]):
+        for name in ('a', 'b'):
+            assert ensemble.areas[name].trial_winners(trial) == brain.areas[name].winners
+            assert ensemble.areas[name].support_size[trial] == brain.areas[name].support_size
+        assert np.array_equal(ensemble.connectomes['b']['a'][trial], brain.connectomes['b']['a'])
+        assert np.array_equal(ensemble.stimuli_connectomes['s']['a'][trial], brain.stimuli_connectomes['s']['a'])
+        for key in (('a', 'a'), ('a', 'b'), ('b', 'a')):
+            stats, expected = ensemble.connectome_stats[key][trial], brain.connectome_stats[key]
+            assert (stats.max_weight, stats.num_potentiated) == (expected.max_weight, expected.num_potentiated)
+            assert np.array_equal(stats.level_histogram, expected.level_histogram)
+        assert ensemble.stimulus_connectome_stats[('s', 'a')][trial].num_potentiated == \
+            brain.stimulus_connectome_stats[('s', 'a')].num_potentiated
+    assert not np.array_equal(ensemble.connectomes['a']['a'][0], ensemble.connectomes['a']['a'][1])
+
+
+def test_infer_winners_is_read_only():
+    for storage in ('dense', 'csr'):
+        brain = NonLazyBrain(p=0.1, storage=storage, seed=9)
+        brain.add_stimulus('s', k=10)
+        brain.add_area('a', n=200, k=10, beta=0.1)
+        brain.add_area('b', n=200, k=10, beta=0.1)
+        for _ in range(5):
+            brain.project({'s': ['a']}, {'a': ['a', 'b']})
+        queries = [{'s': None}, {'a': brain.areas['a'].winners}, {'s': None, 'a': brain.areas['a'].winners[:5]}]
+        expected = []
+        for stim_to_area, area_to_area in (({'s': ['b']}, {}), ({}, {'a': ['b']})):
+            copied = copy.deepcopy(brain)
+            copied.project(stim_to_area, area_to_area)
+            expected.append(copied.areas['b'].winners)
+        weights = np.array(brain.connectomes['a']['b'])
+        winners_before = list(brain.areas['b'].winners)
+        winners = infer_winners(brain, 'b', queries)
+        assert winners.shape == (3, 10)
+        assert [winners[0].tolist(), winners[1].tolist()] == expected
+        assert np.array_equal(np.array(brain.connectomes['a']['b']), weights)
+        assert brain.areas['b'].winners == winners_before
+
+
+def test_infer_winners_lazy_brain():
+    brain = LazyBrain(p=0.1, seed=3)
+    brain.add_stimulus('s', k=20)
+    brain.add_area('a', n=10 ** 5, k=20, beta=0.2)
+    for _ in range(10):
+        brain.project({'s': ['a']}, {'a': ['a']})
+    winners = infer_winners(brain, 'a', [{'s': None, 'a': brain.areas['a'].winners}])
+    assert set(winners[0].tolist()) == set(brain.areas['a'].winners)
+
+
+def test_assembly_registry():
+    registry = AssemblyRegistry('a')
+    registry.register([1, 2, 3, 4], name='x')
+    registry.register([3, 4, 5, 6])
+    registry.register([10, 11, 12, 13])
+    assert registry.best_match([2, 3, 4, 5]) == ('x', 3)
+    assert registry.matches([3, 4, 5, 6], 0.5) == [('a#1', 4), ('x', 2)]
+    assert registry.overlap_histogram([3, 4, 5, 6]).tolist() == [1, 0, 1, 0, 1]
+    assert registry.best_match([20, 21]) is None
+    assert registry['x'].tolist() == [1, 2, 3, 4]
+
+
+def test_assembly_registry_observes_converged_winners():
+    brain = NonLazyBrain(p=0.1, seed=5)
+    brain.add_stimulus('s', k=10)
+    brain.add_stimulus('t', k=10)
+    brain.add_area('a', n=300, k=10, beta=0.3)
+    registry = AssemblyRegistry('a')
+    for stim in ('s', 't'):
+        for _ in range(10):
+            brain.project({stim: ['a']}, {})
+            registry.observe(brain.areas['a'].winners)
+    assert len(registry) == 2
+    assert registry.best_match(brain.areas['a'].winners) == ('a#1', 10)
+
+
+def test_assembly_registry_follows_compaction():
+    brain = LazyBrain(p=0.05, seed=5, random_draws='stream')
+    brain.add_stimulus('s', k=20)
+    brain.add_area('a', n=10 ** 5, k=20, beta=0.3)
+    registry = AssemblyRegistry('a')
+    registry.attach(brain)
+    brain.project({'s': ['a']}, {})
+    for _ in range(10):
+        brain.project({'s': ['a']}, {'a': ['a']})
+    assert len(registry) == 1
+    a = brain.areas['a']
+    assembly_ids = a.support_ids[registry['a#0']]
+    assert brain.compact('a', idle_rounds=0, max_wins=1, keep_potentiated=False) > 0
+    assert np.array_equal(a.support_ids[registry['a#0']], assembly_ids)
+    assert registry.best_match(a.winners) == ('a#0', 20)
+    registry.detach()
+    assert not brain.metrics_listeners and not brain.compaction_listeners
+
+
+def check_connectome_stats(stats, weights, factor):
+    weights = np.asarray(weights)
+    potentiated = weights[weights > 1]
+    assert stats.max_weight == max(1.0, float(np.max(weights)))
+    assert stats.num_potentiated == len(potentiated)
+    expected = np.bincount(potentiation_levels(potentiated, factor), minlength=len(stats.level_histogram))
+    assert stats.level_histogram.tolist() == expected.tolist()
+
+
+def test_connectome_stats():
+    for storage in ('dense', 'bitpacked'):
+        brain = NonLazyBrain(p=0.1, storage=storage, seed=10)
+        brain.add_stimulus('s', k=10)
+        brain.add_area('a', n=300, k=10, beta=0.1)
+        brain.add_area('b', n=300, k=10, beta=0.2)
+        brain.project({'s': ['a']}, {})
+        for _ in range(8):
+            brain.project({'s': ['a']}, {'a': ['a', 'b']})
+        check_connectome_stats(brain.connectome_stats[('a', 'a')], brain.connectomes['a']['a'], 1.1)
+        check_connectome_stats(brain.connectome_stats[('a', 'b')], brain.connectomes['a']['b'], 1.2)
+        check_connectome_stats(brain.stimulus_connectome_stats[('s', 'a')], brain.stimuli_connectomes['s']['a'], 1.1)
+        assert brain.connectome_stats[('a', 'a')].level_histogram[8] > 0
+
+    brain = LazyBrain(p=0.05, seed=10, compaction_growth=1.5, compaction_idle_rounds=2,
+                      compaction_keep_potentiated=False)
+    brain.add_stimulus('s', k=20)
+    brain.add_area('a', n=10 ** 5, k=20, beta=0.1)
+    for _ in range(4):
+        brain.project({'s': ['a']}, {'a': ['a']})
+    assert brain.compact('a', idle_rounds=0, max_wins=1) > 0
+    for _ in range(3):
+        brain.project({'s': ['a']}, {'a': ['a']})
+    check_connectome_stats(brain.connectome_stats[('a', 'a')], brain.connectomes['a']['a'].overlay.values, 1.1)
+
+
+def test_assembly_density():
+    brain = NonLazyBrain(p=0.2, seed=11)
+    brain.add_stimulus('s', k=20)
+    brain.add_area('a', n=500, k=20, beta=0.1)
+    brain.project({'s': ['a']}, {})
+    for _ in range(5):
+        brain.project({'s': ['a']}, {'a': ['a']})
+    winners = brain.areas['a'].winners
+    connectome = brain.connectomes['a']['a']
+    edges = sum(1 for i in winners for j in winners if connectome[i][j] != 0)
+    assert brain.assembly_density('a') == edges / 20 ** 2
+
+
+def test_memory_report_and_estimate():
+    brain = NonLazyBrain(p=0.1, seed=12)
+    brain.add_stimulus('s', k=10)
+    brain.add_area('a', n=300, k=10, beta=0.1)
+    brain.add_area('b', n=100, k=10, beta=0.1)
+    brain.project({'s': ['a']}, {})
+    brain.project({'s': ['a']}, {'a': ['a', 'b']})
+    report = brain.memory_report()
+    assert report.connectomes == {('a', 'a'): 300 * 300 * 4, ('a', 'b'): 300 * 100 * 4}
+    assert report.stimulus_connectomes == {('s', 'a'): 10 * 300 * 4}
+    assert report.total > report.totals['connectomes'] > 0
+    estimate = estimate_memory(0.1, {'a': (300, 10), 'b': (100, 10)}, {'s': 10}, wiring=[('a', 'a'), ('a', 'b')])
+    assert estimate.connectomes == report.connectomes
+    assert estimate.support == report.support
+    assert 'connectomes' in str(report)
+
+
+def test_memory_budget():
+    brain = NonLazyBrain(p=0.1, seed=12)
+    brain.add_stimulus('s', k=10)
+    brain.add_area('a', n=1000, k=10, beta=0.1)
+    brain.memory_budget = 10 ** 5
+    brain.project({'s': ['a']}, {})
+    with pytest.raises(MemoryBudgetExceeded):
+        brain.project({}, {'a': ['a']})
+    assert 'a' not in brain.connectomes['a']
+
+    brain = LazyBrain(p=0.05, seed=12, compaction_idle_rounds=0, compaction_keep_potentiated=False)
+    brain.add_stimulus('s', k=20)
+    brain.add_area('a', n=10 ** 4, k=20, beta=0.1)
+    for _ in range(5):
+        brain.project({'s': ['a']}, {'a': ['a']})
+    used = brain.memory_report().total
+    brain.memory_budget = used
+    brain.memory_policy = 'reclaim'
+    assert brain.areas['a'].compacted_size == 0
+    for _ in range(3):
+        brain.project({'s': ['a']}, {'a': ['a']})
+    assert brain.areas['a'].compacted_size > 0
+
+
+def test_round_metrics_stream_and_writer(tmp_path):
+    brain = NonLazyBrain(p=0.1, seed=13)
+    brain.add_stimulus('s', k=10)
+    brain.add_area('a', n=300, k=10, beta=0.1)
+    brain.add_area('b', n=300, k=10, beta=0.1)
+    writer = ChunkedMetricsWriter(str(tmp_path), chunk_size=4)
+    brain.add_metrics_listener(writer)
+    records = list(stream_metrics(brain, 10, {'s': ['a']}, {'a': ['a']}))
+    assert [record.round for record in records] == list(range(10))
+    assert records[-1].support_size == {'a': brain.areas['a'].support_size, 'b': 0}
+    assert records[0].overlap == {'a': 0} and records[-1].overlap['a'] == 10
+    assert len(read_metrics(str(tmp_path))['round']) == 8
+    brain.project({}, {'a': ['b']})
+    writer.close()
+    metrics = read_metrics(str(tmp_path))
+    assert metrics['round'].tolist() == list(range(11))
+    assert metrics['a.support_size'][-1] == brain.areas['a'].support_size
+    assert metrics['b.num_first_winners'].tolist() == [-1] * 10 + [10]
+    assert brain.metrics_listeners == [writer]
+
+
+def test_connectome_cache_spills_and_restores():
+    reference = NonLazyBrain(p=0.1, seed=14)
+    brain = NonLazyBrain(p=0.1, seed=14)
+    connectome_nbytes = 200 * 200 * 4
+    brain.connectome_cache = ConnectomeCache(budget=2 * connectome_nbytes)
+    for b in (reference, brain):
+        b.add_stimulus('s', k=10)
+        for name in ('a', 'b', 'c'):
+            b.add_area(name, n=200, k=10, beta=0.1)
+        b.project({'s': ['a', 'b']}, {})
+        for _ in range(3):
+            b.project({'s': ['a']}, {'a': ['c']})
+            b.project({'s': ['b']}, {'b': ['c']})
+        b.project({}, {'a': ['c'], 'b': ['c']})
+    cache = brain.connectome_cache
+    assert cache.evictions > 0 and cache.misses > 0 and cache.hits > 0
+    assert cache.resident_nbytes <= cache.budget
+    assert any(isinstance(connectome, SpilledConnectome) for connectome in brain.stimuli_connectomes['s'].values())
+    assert brain.areas['c'].winners == reference.areas['c'].winners
+    for source in ('a', 'b'):
+        assert np.array_equal(brain.connectomes[source]['c'], reference.connectomes[source]['c'])
+    assert np.array_equal(brain.stimuli_connectomes['s']['a'], reference.stimuli_connectomes['s']['a'])
+    directory = cache.directory
+    cache.close()
+    assert not os.path.exists(directory)
+
+
+def test_connectome_cache_spill_names():
+    brain = NonLazyBrain(p=0.1, seed=15)
+    brain.connectome_cache = ConnectomeCache(budget=0)
+    brain.add_stimulus('s', k=10)
+    for name in ('a', 'b', 'c', 'a-b', 'b-c'):
+        brain.add_area(name, n=100, k=10, beta=0.1)
+    brain.project({'s': ['a', 'a-b']}, {})
+    brain.project({}, {'a-b': ['c'], 'a': ['b-c']})
+    expected = {source: np.array(brain.connectomes[source][target])
+                for source, target in (('a-b', 'c'), ('a', 'b-c'))}
+    brain.connectome_cache.evict(brain, 0)
+    spilled = [dict.__getitem__(brain.connectomes[source], target) for source, target in (('a-b', 'c'), ('a', 'b-c'))]
+    assert all(isinstance(connectome, SpilledConnectome) for connectome in spilled)
+    assert spilled[0].path != spilled[1].path
+    for source, target in (('a-b', 'c'), ('a', 'b-c')):
+        assert np.array_equal(brain.connectomes[source][target], expected[source])
+
+
+def _read_snapshot(name, queue):
+    with attach(name) as view:
+        queue.put((infer_winners(view, 'b', [{'a': view.areas['a'].winners}]).tolist(),
+                   view.connectomes['a']['b'].flags.writeable))
+
+
+def test_shared_snapshot():
+    brain = NonLazyBrain(p=0.1, seed=15)
+    brain.add_stimulus('s', k=10)
+    brain.add_area('a', n=300, k=10, beta=0.1)
+    brain.add_area('b', n=300, k=10, beta=0.1)
+    for _ in range(5):
+        brain.project({'s': ['a']}, {'a': ['a', 'b']})
+    expected = infer_winners(brain, 'b', [{'a': brain.areas['a'].winners}]).tolist()
+    with publish(brain) as snapshot:
+        view = attach(snapshot.name)
+        assert snapshot.readers == 1
+        assert np.array_equal(view.connectomes['a']['b'], brain.connectomes['a']['b'])
+        assert view.areas['a'].winners == brain.areas['a'].winners
+        assert view.areas['a'].support.sum() == brain.areas['a'].support_size
+        with pytest.raises(TypeError):
+            view.project({'s': ['a']}, {})
+        queue = multiprocessing.get_context().Queue()
+        process = multiprocessing.get_context().Process(target=_read_snapshot, args=(snapshot.name, queue))
+        process.start()
+        assert queue.get(timeout=30) == (expected, False)
+        process.join()
+        view.close()
+        assert snapshot.readers == 0
+        name = snapshot.name
+    with pytest.raises(FileNotFoundError):
+        attach(name)
+
+
+def test_shared_snapshot_lazy_brain():
+    brain = LazyBrain(p=0.1, seed=16)
+    brain.add_stimulus('s', k=10)
+    brain.add_area('a', n=10000, k=10, beta=0.1)
+    for _ in range(5):
+        brain.project({'s': ['a']}, {'a': ['a']})
+    snapshot = publish(brain)
+    view = attach(snapshot.name)
+    lock_path = os.path.join(tempfile.gettempdir(), f'{snapshot.name}.lock')
+    connectome = view.connectomes['a']['a']
+    # the implicit connectome is rebuilt on the areas of the view, with the overlay in shared memory
+    assert connectome.source is view.areas['a'] and not connectome.overlay.values.flags.writeable
+    assert np.array_equal(connectome.to_dense(), brain.connectomes['a']['a'].to_dense())
+    snapshot.close()
+    assert not os.path.exists(lock_path)
+    # a reader closing after the publisher does not leave a lock file behind
+    view.close()
+    assert not os.path.exists(lock_path)
+
+
+def test_simulation_service(tmp_path):
+    path = str(tmp_path / 'service.sock')
+    service = SimulationService(path, batch_window=0.05)
+    thread = threading.Thread(target=asyncio.run, args=(service.serve(),))
+    thread.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    with SimulationClient(path, timeout=30) as client:
+        client.create('x', p=0.1, stimuli={'s': 10}, areas={'a': (200, 10, 0.1), 'b': (200, 10, 0.1)}, seed=21)
+        winners = client.project('x', {'s': ['a']}, {'a': ['a', 'b']}, rounds=5)
+        brain = NonLazyBrain(p=0.1, seed=21)
+        brain.add_stimulus('s', k=10)
+        brain.add_area('a', n=200, k=10, beta=0.1)
+        brain.add_area('b', n=200, k=10, beta=0.1)
+        for _ in range(5):
+            brain.project({'s': ['a']}, {'a': ['a', 'b']})
+        assert winners == {'a': brain.areas['a'].winners, 'b': brain.areas['b'].winners}
+        assert client.fork('x', 'y') == 'y'
+        client.project('y', {'s': ['a']}, {})
+        queries = [[{'a': brain.areas['a'].winners[:i + 1]}] for i in range(8)]
+        ids = [client.submit('readout', brain='x', area='b', queries=query) for query in queries]
+        for request_id, query in zip(reversed(ids), reversed(queries)):
+            assert client.result(request_id) == infer_winners(brain, 'b', query).tolist()
+        assert service.readouts == 8 and service.readout_batches < 8
+        client.checkpoint('x', str(tmp_path / 'x.pkl'))
+        client.load('z', str(tmp_path / 'x.pkl'))
+        assert client.list_brains() == {'x': 'NonLazyBrain', 'y': 'NonLazyBrain', 'z': 'NonLazyBrain'}
+        client.drop('y')
+        with pytest.raises(ServiceError):
+            client.project('y', {'s': ['a']}, {})
+        client.shutdown()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+
+
+def test_simulation_service_long_lines(tmp_path):
+    path = str(tmp_path / 'service.sock')
+    service = SimulationService(path, line_limit=1024)
+    thread = threading.Thread(target=asyncio.run, args=(service.serve(),))
+    thread.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    with SimulationClient(path, timeout=30) as client:
+        client.create('x', p=0.1, stimuli={'s': 10}, areas={'a': (200, 10, 0.1)}, seed=22)
+        pending = client.submit('project', brain='x', stim_to_area={'s': ['a']}, area_to_area={})
+        with pytest.raises(ServiceError, match='LimitOverrunError'):
+            client.readout('x', 'a', [{'a': list(range(200))}] * 20)
+        # the connection, and the jobs in flight on it, survive the long line
+        assert list(client.result(pending)) == ['a']
+        assert client.list_brains() == {'x': 'NonLazyBrain'}
+        client.shutdown()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+
+
+def _checkpointed_state(brain):
+    return {'winners': {name: list(area.winners) for name, area in brain.areas.items()},
+            'support_size': {name: area.support_size for name, area in brain.areas.items()},
+            'connectomes': {target: to_dense(brain.connectomes['a'][target]).copy() for target in ('a', 'b')},
+            'stimulus': to_dense(brain.stimuli_connectomes['s']['a']).copy()}
+
+
+@pytest.mark.parametrize('make_brain', [lambda: NonLazyBrain(p=0.1, seed=31),
+                                        lambda: NonLazyBrain(p=0.1, storage='csr', seed=31),
+                                        lambda: LazyBrain(p=0.1, seed=31, compaction_growth=30)])
+def test_delta_checkpoints(tmp_path, make_brain):
+    brain = make_brain()
+    brain.add_stimulus('s', k=10)
+    brain.add_area('a', n=400, k=10, beta=0.1)
+    brain.add_area('b', n=400, k=10, beta=0.1)
+    brain.project({'s': ['a']}, {'a': ['a', 'b']})
+    with DeltaCheckpointer(brain, str(tmp_path), every=3) as checkpointer:
+        checkpointer.checkpoint()
+        for _ in range(8):
+            brain.project({'s': ['a']}, {'a': ['a', 'b']})
+    expected = _checkpointed_state(brain)
+    assert checkpointer.segments == 4 and not brain.change_listeners
+    if isinstance(brain, NonLazyBrain):
+        segments = sorted(tmp_path.glob('segment_*.pkl'))
+        assert segments[-1].stat().st_size * 10 < segments[0].stat().st_size
+    restored = restore(str(tmp_path))
+    assert type(restored) is type(brain) and restored.rounds == 9
+    actual = _checkpointed_state(restored)
+    assert actual['winners'] == expected['winners'] and actual['support_size'] == expected['support_size']
+    for target in ('a', 'b'):
+        assert np.array_equal(actual['connectomes'][target], expected['connectomes'][target])
+    assert np.array_equal(actual['stimulus'], expected['stimulus'])
+    if isinstance(brain, NonLazyBrain):
+        restored.project({'s': ['a']}, {'a': ['a', 'b']})
+        brain.project({'s': ['a']}, {'a': ['a', 'b']})
+        assert restored.areas['b'].winners == brain.areas['b'].winners
+
+
+@pytest.mark.parametrize('storage', ['dense', 'bitpacked', 'csr'])
+def test_compact_snapshot(tmp_path, storage):
+    brain = NonLazyBrain(p=0.1, storage=storage, seed=41)
+    brain.add_stimulus('s', k=10)
+    brain.add_area('a', n=300, k=10, beta=0.1)
+    brain.add_area('b', n=300, k=10, beta=0.05)
+    for _ in range(6):
+        brain.project({'s': ['a']}, {'a': ['a', 'b']})
+    brain.areas['b'].area_beta['a'] = 0.2
+    brain.project({}, {'a': ['b']})
+    path = str(tmp_path / 'brain.snapshot')
+    save_compact(brain, path)
+    restored = load_compact(path)
+    for target in ('a', 'b'):
+        assert np.array_equal(to_dense(restored.connectomes['a'][target]), to_dense(brain.connectomes['a'][target]))
+    assert np.array_equal(to_dense(restored.stimuli_connectomes['s']['a']),
+                          to_dense(brain.stimuli_connectomes['s']['a']))
+    assert restored.areas['b'].winners == brain.areas['b'].winners
+    if storage == 'dense':
+        assert os.path.getsize(path) * 20 < brain.memory_report().total
+    restored.project({'s': ['a']}, {'a': ['a', 'b']})
+    brain.project({'s': ['a']}, {'a': ['a', 'b']})
+    assert restored.areas['b'].winners == brain.areas['b'].winners
+
+
+def _support_sizes(n, k, p, beta, t, seed=None):
+    brain = NonLazyBrain(p, seed=seed)
+    brain.add_stimulus('s', k)
+    brain.add_area('a', n, k, beta)
+    sizes = []
+    for _ in range(t):
+        brain.project({'s': ['a']}, {'a': ['a']})
+        sizes.append(brain.areas['a'].support_size)
+    return np.array(sizes)
+
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=1 << 20)
+    simulate = cache.memoize(_support_sizes)
+    assert not os.path.exists(cache.directory)
+    first = simulate(300, 10, 0.1, 0.1, 5, seed=1)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert np.array_equal(simulate(300, 10, 0.1, 0.1, t=5.0, seed=np.int64(1)), first)
+    assert (cache.hits, cache.misses) == (1, 1)
+    simulate(300, 10, 0.1, 0.1, 5, seed=2)
+    simulate(300, 10, 0.1, 0.1, 5)
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.key(_support_sizes, (300, 10, 0.1, 0.1, 5)) != \
+        ResultCache(str(tmp_path / 'cache'), version='other').key(_support_sizes, (300, 10, 0.1, 0.1, 5))
+    size = cache.nbytes // 2
+    cache.get(cache.key(_support_sizes, (300, 10, 0.1, 0.1, 5), {'seed': 1}))
+    assert cache.evict(size) == 1
+    assert cache.get(cache.key(_support_sizes, (300, 10, 0.1, 0.1, 5), {'seed': 1}))[0]
+    assert not cache.get(cache.key(_support_sizes, (300, 10, 0.1, 0.1, 5), {'seed': 2}))[0]
+
+
+def test_result_cache_source_version(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    path = tmp_path / 'sweep.py'
+
+    def load(body, mtime_ns):
+        path.write_text(f'def sweep(seed=None):\n    return {body}\n')
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+        spec = importlib.util.spec_from_file_location('sweep', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return cache.memoize(module.sweep)
+
+    assert load('1', 10 ** 18)(seed=0) == 1
+    # editing the sweep changes the key, although the library did not change
+    assert load('2', 2 * 10 ** 18)(seed=0) == 2
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_connectome_pool(tmp_path):
+    pool = ConnectomePool(str(tmp_path))
+
+    def run(seed, beta, use_pool=True):
+        brain = NonLazyBrain(p=0.1, seed=seed)
+        if use_pool:
+            brain.connectome_pool = pool
+        brain.add_stimulus('s', k=10)
+        brain.add_area('a', n=300, k=10, beta=beta)
+        for _ in range(5):
+            brain.project({'s': ['a']}, {'a': ['a']})
+        return brain
+
+    first = run(7, 0.05)
+    assert (pool.hits, pool.misses) == (0, 2)
+    second = run(7, 0.2)
+    assert (pool.hits, pool.misses) == (2, 2)
+    assert second.areas['a'].winners == run(7, 0.2, use_pool=False).areas['a'].winners
+    # plasticity only changed the private copies of the brains
+    assert not np.array_equal(first.connectomes['a']['a'], second.connectomes['a']['a'])
+    base = pool.base((300, 300), 0.1, edge_seed_sequence(7, 'area', 'a', 'a'))
+    assert np.array_equal(base, dense_random((300, 300), 0.1, edge_seed_sequence(7, 'area', 'a', 'a')))
+    assert first.connectome_provenance[('a', 'a', False)]['digest'] == \
+        second.connectome_provenance[('a', 'a', False)]['digest']
+    with pytest.raises(ValueError):
+        check_independent(first, second)
+    check_independent(first, run(8, 0.05))
+
+
+def test_connectome_pool_concurrent_generation(tmp_path):
+    pool = ConnectomePool(str(tmp_path))
+    seed_sequence = edge_seed_sequence(9, 'area', 'a', 'a')
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        bases = list(executor.map(lambda _: pool.base((400, 400), 0.1, seed_sequence), range(8)))
+    expected = dense_random((400, 400), 0.1, seed_sequence)
+    assert all(np.array_equal(base, expected) for base in bases)
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_random_source_prefetch():
+    sync = RandomSource(np.random.SeedSequence(3), chunk_size=7)
+    prefetched = RandomSource(np.random.SeedSequence(3), prefetch=True, chunk_size=5)
+    for count in (3, 0, 11, 1, 20):
+        assert np.array_equal(sync.uniforms(count), prefetched.uniforms(count))
+    assert np.array_equal(copy.deepcopy(prefetched).uniforms(9), sync.uniforms(9))
+    prefetched.close()
+    sampled, keys = RandomSource(np.random.SeedSequence(4)), RandomSource(np.random.SeedSequence(4))
+    for population, count in ((50, 7), (50, 0), (10, 10), (1000, 999)):
+        sample = sampled.sample(population, count)
+        assert np.array_equal(sample, np.argsort(keys.uniforms(population), kind='stable')[:count])
+    assert sampled.consumed == keys.consumed == 1110
+
+    def run(random_draws, rounds=8):
+        brain = LazyBrain(p=0.05, seed=51, random_draws=random_draws)
+        brain.add_stimulus('s', k=20)
+        brain.add_area('a', n=10000, k=20, beta=0.1)
+        brain.add_area('b', n=10000, k=20, beta=0.1)
+        winners = []
+        for _ in range(rounds):
+            brain.project({'s': ['a']}, {'a': ['a', 'b']})
+            winners.append((list(brain.areas['a'].winners), list(brain.areas['b'].winners)))
+        return brain, winners
+
+    brain, winners = run('prefetch')
+    assert winners == run('stream')[1]
+    resumed = copy.deepcopy(brain)
+    for continued in (brain, resumed):
+        continued.project({'s': ['a']}, {'a': ['a', 'b']})
+    assert resumed.areas['b'].winners == brain.areas['b'].winners
+
+
+@pytest.mark.parametrize('brain_type', [NonLazyBrain, LazyBrain])
+def test_double_buffered_winners(brain_type):
+    brain = brain_type(p=0.1, seed=21)
+    brain.add_stimulus('s', k=10)
+    brain.add_area('a', n=1000, k=10, beta=0.1)
+    area = brain.areas['a']
+    buffers = area._winner_buffers
+    metrics = []
+    brain.add_metrics_listener(metrics.append)
+    brain.project({'s': ['a']}, {})
+    previous = list(area.winners)
+    for _ in range(3):
+        brain.project({'s': ['a']}, {'a': ['a']})
+        assert area._winner_buffers is buffers
+        assert area.winner_array.dtype == np.int32 and area.winner_array.base is buffers
+        assert area.winners == area.winner_array.tolist() and isinstance(area.winners, list)
+        # outside of a projection, the new winners are the committed ones
+        assert np.array_equal(area._new_winners, area.winner_array)
+        assert metrics[-1].overlap['a'] == len(set(previous) & set(area.winners))
+        previous = list(area.winners)
+
+    with pytest.raises(TypeError):
+        area.winners.append(0)
+    with pytest.raises(TypeError):
+        area.winners[0] = 0
+    area.winners = previous[::-1]
+    assert area.winner_array.tolist() == previous[::-1]
+    area.winners = previous
+
+    # areas pickled with the winners as plain lists still load
+    legacy = {key: value for key, value in area.__dict__.items() if key not in
+              ('_winner_buffers', '_front', '_num_winners', '_num_new_winners', '_pending')}
+    legacy['winners'] = legacy['_new_winners'] = previous
+    restored = object.__new__(type(area))
+    restored.__setstate__(legacy)
+    assert restored.winners == previous and np.array_equal(restored._new_winners, previous)
+    assert pickle.loads(pickle.dumps(area)).winners == previous
+
+
+def test_delta_checkpoint_write_failure(tmp_path, monkeypatch):
+    brain = NonLazyBrain(p=0.1, seed=32)
+    brain.add_stimulus('s', k=10)
+    brain.add_area('a', n=200, k=10, beta=0.1)
+    brain.project({'s': ['a']}, {'a': ['a']})
+    checkpointer = DeltaCheckpointer(brain, str(tmp_path))
+    checkpointer.checkpoint().result()
+    expected = list(brain.areas['a'].winners)
+
+    def fail(*args, **kwargs):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(checkpointing.pickle, 'dump', fail)
+    brain.project({'s': ['a']}, {'a': ['a']})
+    failed = checkpointer.checkpoint()
+    with pytest.raises(OSError):
+        failed.result()
+    monkeypatch.setattr(checkpointing.pickle, 'dump', pickle.dump)
+    brain.project({'s': ['a']}, {'a': ['a']})
+    with pytest.raises(RuntimeError):
+        checkpointer.checkpoint()
+    with pytest.raises(OSError):
+        checkpointer.close()
+    # the checkpoint on disk is still the last complete one, without the delta written after the failure
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['index.json', 'segment_000000.pkl']
+    assert restore(str(tmp_path)).areas['a'].winners == expected
+
+
+def test_ensemble_round_metrics(tmp_path):
+    brain = EnsembleBrain(p=0.1, trials=3, seed=51)
+    brain.add_stimulus('s', k=10)
+    brain.add_area('a', n=200, k=10, beta=0.1)
+    metrics = []
+    brain.add_metrics_listener(metrics.append)
+    with ChunkedMetricsWriter(str(tmp_path)) as writer:
+        brain.add_metrics_listener(writer)
+        brain.project({'s': ['a']}, {})
+        previous = [brain.areas['a'].trial_winners(trial) for trial in range(3)]
+        brain.project({'s': ['a']}, {'a': ['a']})
+    assert metrics[-1].overlap['a'] == [len(set(previous[trial]) & set(brain.areas['a'].trial_winners(trial)))
+                                        for trial in range(3)]
+    assert metrics[0].num_first_winners['a'] == [10, 10, 10] and metrics[0].overlap['a'] == [0, 0, 0]
+    assert metrics[-1].support_size['a'] == brain.areas['a'].support_size.tolist()
+    columns = read_metrics(str(tmp_path))
+    assert columns['a.support_size.2'].tolist() == [record.support_size['a'][2] for record in metrics]
@@ -0,0 +1,160 @@
+""" Structured, zero-cost-when-disabled tracing for the brain implementations.
+
+The projection code traces events such as the inputs of an area or the new state of a connectome. Formatting these
+eagerly (e.g. 'logging.debug(f"... {connectome}")') costs a full repr of every array on every round, even when debug
+output is off. Instead, brain code calls
+
+    trace('new_winners', area=area.name, winners=area._new_winners)
+
+which returns immediately unless the event's level is enabled, either on the 'brain.trace' logger or on one of the
+registered sinks. Only then are the fields summarized: arrays and connectomes are reduced to their shape, counts and
+a few statistics rather than printed in full.
+
+A BinaryTraceSink appends every enabled event to a file of binary framed records, which 'read_trace' reads back for
+offline inspection.
+"""
+from typing import Any, Dict, Iterator, List
+import json
+import logging
+import struct
+import time
+import numpy as np
+from numpy import ndarray
+
+logger = logging.getLogger('brain.trace')
+
+# Arrays with more elements than this are summarized by their shape only, to keep tracing cheap.
+STATS_MAX_SIZE = 1 << 20
+
+_sinks: List['BinaryTraceSink'] = []
+
+
+def trace_enabled(level: int = logging.DEBUG) -> bool:
+    """ Whether an event of the given level would be emitted anywhere. """
+    return logger.isEnabledFor(level) or any(level >= sink.level for sink in _sinks)
+
+
+def summarize(value: Any) -> Any:
+    """ A compact, JSON serializable summary of a traced value.
+
+    Arrays are summarized by their shape and, if not too large, their sum, minimum, maximum and number of non zeros.
+    Connectome objects are summarized by their shape, size in bytes and number of explicitly stored synapses.
+    Sequences are summarized by their length. Scalars and strings are kept as they are.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, ndarray):
+        summary: Dict[str, Any] = {'shape': list(value.shape)}
+        if 0 < value.size <= STATS_MAX_SIZE:
+            summary.update(sum=float(value.sum()), min=float(value.min()), max=float(value.max()),
+                           nonzero=int(np.count_nonzero(value)))
+        return summary
+    if hasattr(value, 'shape') and hasattr(value, 'nbytes'):
+        summary = {'type': type(value).__name__, 'shape': list(value.shape), 'nbytes': int(value.nbytes)}
+        if hasattr(value, 'overlay'):
+            summary['explicit'] = len(value.overlay)
+        return summary
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return {'len': len(value)}
+    return repr(value)
+
+
+class _Fields:
+    """ Formats the summarized fields of an event only if a log record is actually emitted. """
+
+    def __init__(self, fields: Dict[str, Any]):
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return ' '.join(f'{name}={value}' for name, value in self.fields.items())
+
+
+def trace(event: str, level: int = logging.DEBUG, **fields: Any) -> None:
+    """ Trace an event.
+
+    Nothing is computed unless 'level' is enabled on the 'brain.trace' logger or on a registered sink.
+
+    :param event: Name of the event
+    :param level: Logging level of the event
+    :param fields: Values describing the event. They are summarized, see 'summarize'.
+    """
+    log = logger.isEnabledFor(level)
+    sinks = [sink for sink in _sinks if level >= sink.level]
+    if not log and not sinks:
+        return
+    summary = {name: summarize(value) for name, value in fields.items()}
+    if log:
+        logger.log(level, '%s: %s', event, _Fields(summary))
+    for sink in sinks:
+        sink.write(level, event, summary)
+
+
+_HEADER = struct.Struct('<IdH')
+_MAGIC = b'BRAINTRC'
+
+
+class BinaryTraceSink:
+    """ Appends trace events to a file as binary framed records.
+
+    The file starts with a magic string. Every record is a header (payload length as uint32, time stamp as float64,
+    level as uint16) followed by the payload: the event name and its summarized fields as UTF-8 JSON.
+
+    Attributes:
+        path: Path of the trace file
+        level: Minimal level of the events written
+    """
+
+    def __init__(self, path: str, level: int = logging.DEBUG):
+        self.path = path
+        self.level = level
+        self._file = open(path, 'wb')
+        self._file.write(_MAGIC)
+
+    def write(self, level: int, event: str, fields: Dict[str, Any]) -> None:
+        payload = json.dumps({'event': event, 'fields': fields}).encode()
+        self._file.write(_HEADER.pack(len(payload), time.time(), level))
+        self._file.write(payload)
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        remove_sink(self)
+        self._file.close()
+
+    def __enter__(self) -> 'BinaryTraceSink':
+        add_sink(self)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def add_sink(sink: BinaryTraceSink) -> None:
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def remove_sink(sink: BinaryTraceSink) -> None:
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def read_trace(path: str) -> Iterator[Dict[str, Any]]:
+    """ Read the records of a trace file written by a BinaryTraceSink.
+
+    :return: Iterator over the records, dictionaries with the keys 'time', 'level', 'event' and 'fields'
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f'{path} is not a brain trace file')
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            length, timestamp, level = _HEADER.unpack(header)
+            record = json.loads(f.read(length))
+            record.update(time=timestamp, level=level)
+            yield record
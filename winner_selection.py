@@ -0,0 +1,115 @@
+""" Selection of the 'k' winners of an area out of the inputs flowing into it.
+
+Every round, both brain implementations compute an input value per candidate neuron and keep the 'k' largest.
+Once an assembly has converged, the set of winners (and therefore the k-th largest input) barely changes from one
+round to the next. 'ThresholdTopK' exploits that: it remembers the k-th largest input of the previous round and
+first looks only at the candidates that lie above a safety margin below it. Only when that cheap pass does not
+produce a sensible number of candidates does it fall back to a full selection over all inputs.
+
+The result is always exactly the one of a full selection, including the order of the winners:
+by decreasing input, ties broken in favour of the lower index (the same order 'heapq.nlargest' produces).
+"""
+from typing import Optional
+import numpy as np
+from numpy import ndarray
+
+
+def top_k_indices(inputs: ndarray, k: int) -> ndarray:
+    """ Returns the indices of the 'k' largest values in 'inputs'.
+
+    The indices are ordered by decreasing value, and equal values are ordered by increasing index.
+
+    :param inputs: 1-dimensional array of input values
+    :param k: number of indices to select. If larger than len(inputs), all indices are returned.
+    :return: int64 array of the selected indices
+    """
+    inputs = np.asarray(inputs)
+    k = min(k, len(inputs))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(inputs):
+        # kth is the smallest value that is surely a winner. Anything above it wins, the ties with it are broken
+        # by index.
+        kth = inputs[np.argpartition(-inputs, k - 1)[k - 1]]
+        above = np.flatnonzero(inputs > kth)
+        ties = np.flatnonzero(inputs == kth)[:k - len(above)]
+        selected = np.concatenate((above, ties))
+    else:
+        selected = np.arange(len(inputs))
+    return selected[np.lexsort((selected, -inputs[selected]))]
+
+
+def batched_top_k_indices(inputs: ndarray, k: int) -> ndarray:
+    """ 'top_k_indices' of every row of a 2-dimensional array, in a constant number of vectorized passes.
+
+    :param inputs: array of shape (batch, n) of input values
+    :param k: number of indices to select in every row, at most n
+    :return: int64 array of shape (batch, k), every row ordered as by 'top_k_indices'
+    """
+    inputs = np.asarray(inputs)
+    batch, n = inputs.shape
+    if k <= 0:
+        return np.empty((batch, 0), dtype=np.int64)
+    kth = np.partition(inputs, n - k, axis=1)[:, n - k, None]
+    above = inputs > kth
+    ties = inputs == kth
+    # of the values equal to the k-th largest, keep the ones with the lowest indices
+    missing = k - above.sum(axis=1, keepdims=True)
+    selected = above | (ties & (np.cumsum(ties, axis=1) <= missing))
+    indices = np.flatnonzero(selected).reshape(batch, k) % n
+    # indices are increasing along every row, so a stable sort by decreasing value breaks ties by index
+    order = np.argsort(-np.take_along_axis(inputs, indices, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(indices, order, axis=1)
+
+
+class ThresholdTopK:
+    """ Incremental top-k selector that tracks the k-th largest input of the previous round.
+
+    The candidates are the inputs that are at least 'threshold - margin * max(|threshold|, 1)', where 'threshold' is
+    the previous k-th largest input. If there are at least 'k' such candidates, the top-k among them is exactly the
+    top-k of all the inputs, so only the candidates need to be partitioned. If there are fewer than 'k' candidates
+    (the inputs dropped) or more than 'max_candidates_factor * k' (the pass saves nothing), a full selection is
+    performed instead.
+
+    Attributes:
+        margin: relative safety margin below the previous threshold
+        max_candidates_factor: fall back to a full selection if there are more than this many times 'k' candidates
+        threshold: the k-th largest input of the last selection, or None before the first one
+        hits: number of selections that were answered from the candidates only
+        fallbacks: number of selections that needed a full pass
+    """
+
+    def __init__(self, margin: float = 0.1, max_candidates_factor: float = 4.0):
+        self.margin = margin
+        self.max_candidates_factor = max_candidates_factor
+        self.threshold: Optional[float] = None
+        self.hits: int = 0
+        self.fallbacks: int = 0
+
+    def reset(self) -> None:
+        """ Forget the tracked threshold, so that the next selection is a full one. """
+        self.threshold = None
+
+    def select(self, inputs: ndarray, k: int) -> ndarray:
+        """ Select the 'k' largest inputs.
+
+        :param inputs: 1-dimensional array of input values, one per candidate neuron
+        :param k: number of winners
+        :return: int64 array of winner indices, ordered as by 'top_k_indices'
+        """
+        inputs = np.asarray(inputs)
+        k = min(k, len(inputs))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        winners = None
+        if self.threshold is not None:
+            cutoff = self.threshold - self.margin * max(abs(self.threshold), 1.0)
+            candidates = np.flatnonzero(inputs >= cutoff)
+            if k <= len(candidates) <= self.max_candidates_factor * k:
+                winners = candidates[top_k_indices(inputs[candidates], k)]
+                self.hits += 1
+        if winners is None:
+            winners = top_k_indices(inputs, k)
+            self.fallbacks += 1
+        self.threshold = float(inputs[winners[-1]])
+        return winners